@@ -1,16 +1,30 @@
 import pandas as pd
 import numpy as np
+from data.spatial.centroid_distances import lookup_distances, calculate_distances
 
 def configure(context):
     context.stage("data.od.cleaned")
     context.stage("data.spatial.centroid_distances")
+    context.stage("data.spatial.municipalities")
 
 def execute(context):
     df_distances = context.stage("data.spatial.centroid_distances")
     result = {}
 
     for df_data, name in zip(context.stage("data.od.cleaned"), ("work", "education")):
-        df_data = pd.merge(df_data, df_distances, on = ["origin_id", "destination_id"])
+        if isinstance(df_distances, dict):
+            df_data = df_data.copy()
+            df_data["centroid_distance"] = lookup_distances(df_distances, df_data["origin_id"], df_data["destination_id"])
+        else:
+            df_data = pd.merge(df_data, df_distances, on = ["origin_id", "destination_id"], how = "left")
+
+            # Pairs beyond centroid_distances_threshold are not in the long format
+            f_missing = df_data["centroid_distance"].isna()
+
+            if np.any(f_missing):
+                df_data.loc[f_missing, "centroid_distance"] = calculate_distances(
+                    context.stage("data.spatial.municipalities"),
+                    df_data.loc[f_missing, "origin_id"], df_data.loc[f_missing, "destination_id"])
 
         df_data = df_data[["centroid_distance", "weight"]]
         df_data = df_data.sort_values(by = "centroid_distance")
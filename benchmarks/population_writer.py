@@ -0,0 +1,113 @@
+import argparse, hashlib, time
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+from matsim.scenario.population import write_population, write_population_columnar
+
+"""
+Compares the default and the columnar MATSim population writer on a synthetic
+population. Both outputs are verified to be byte-identical.
+
+    python3 -m benchmarks.population_writer --persons 1000000
+"""
+
+class Progress:
+    def update(self, amount = 1):
+        pass
+
+class HashingOutput:
+    def __init__(self):
+        self.hash = hashlib.md5()
+        self.size = 0
+
+    def write(self, content):
+        self.hash.update(content)
+        self.size += len(content)
+
+def create_population(random, number_of_persons):
+    person_ids = np.arange(number_of_persons)
+
+    df_persons = pd.DataFrame(dict(
+        person_id = person_ids,
+        household_income = random.random_sample(number_of_persons) * 5000.0,
+        car_availability = random.choice(["all", "some", "none"], number_of_persons),
+        bike_availability = random.choice(["all", "some", "none"], number_of_persons),
+        census_household_id = person_ids // 2,
+        census_person_id = person_ids,
+        household_id = person_ids // 2,
+        has_license = random.random_sample(number_of_persons) < 0.7,
+        has_pt_subscription = random.random_sample(number_of_persons) < 0.4,
+        is_passenger = random.random_sample(number_of_persons) < 0.1,
+        hts_id = random.randint(10000, size = number_of_persons),
+        hts_household_id = random.randint(10000, size = number_of_persons),
+        age = random.randint(100, size = number_of_persons),
+        employed = random.random_sample(number_of_persons) < 0.5,
+        sex = random.choice(["male", "female"], number_of_persons)
+    ))
+
+    activity_counts = random.randint(1, 6, size = number_of_persons)
+    number_of_activities = np.sum(activity_counts)
+
+    activity_offsets = np.repeat(np.cumsum(activity_counts) - activity_counts, activity_counts)
+    activity_indices = np.arange(number_of_activities) - activity_offsets
+    is_last = activity_indices == np.repeat(activity_counts - 1, activity_counts)
+
+    start_times = 6.0 * 3600.0 + activity_indices * 3600.0 + random.randint(1800, size = number_of_activities)
+    start_times[activity_indices == 0] = np.nan
+
+    end_times = start_times + random.randint(3600, size = number_of_activities)
+    end_times[activity_indices == 0] = 6.0 * 3600.0 + random.randint(1800, size = np.sum(activity_indices == 0))
+    end_times[is_last] = np.nan
+
+    location_ids = random.randint(100000, size = number_of_activities).astype(object)
+    location_ids[random.random_sample(number_of_activities) < 0.1] = -1
+
+    df_activities = pd.DataFrame(dict(
+        person_id = np.repeat(person_ids, activity_counts),
+        start_time = start_times, end_time = end_times,
+        purpose = random.choice(["home", "work", "education", "shop", "leisure", "other"], number_of_activities),
+        geometry = gpd.points_from_xy(
+            random.random_sample(number_of_activities) * 1e5,
+            random.random_sample(number_of_activities) * 1e5),
+        location_id = location_ids
+    ))
+
+    trip_persons = np.repeat(person_ids, activity_counts - 1)
+    departure_times = end_times[~is_last]
+
+    df_trips = pd.DataFrame(dict(
+        person_id = trip_persons,
+        mode = random.choice(["car", "pt", "walk", "bike", "car_passenger"], len(trip_persons)),
+        departure_time = departure_times,
+        travel_time = random.randint(60, 3600, size = len(trip_persons)).astype(float)
+    ))
+
+    df_vehicles = pd.DataFrame(dict(
+        owner_id = np.repeat(person_ids, 2),
+        vehicle_id = ["%d:%s" % item for item in zip(np.repeat(person_ids, 2), np.tile(["car", "bike"], number_of_persons))],
+        mode = np.tile(["car", "bike"], number_of_persons)
+    ))
+
+    return df_persons, df_activities, df_trips, df_vehicles
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark of the MATSim population writers")
+    parser.add_argument("--persons", type = int, default = 100000)
+    parser.add_argument("--seed", type = int, default = 0)
+    arguments = parser.parse_args()
+
+    data = create_population(np.random.RandomState(arguments.seed), arguments.persons)
+    results = {}
+
+    for name, function in (("default", write_population), ("columnar", write_population_columnar)):
+        output = HashingOutput()
+
+        start_time = time.time()
+        function(output, *data, Progress())
+        results[name] = output.hash.hexdigest()
+
+        print("%s: %.2fs (%d bytes)" % (name, time.time() - start_time, output.size))
+
+    assert results["default"] == results["columnar"]
+    print("Outputs are identical")
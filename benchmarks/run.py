@@ -0,0 +1,128 @@
+import argparse, datetime, json, os, platform
+import synpp
+
+import documentation.meta_output as meta_output
+import documentation.profiling as profiling
+from tests import testdata
+
+"""
+Runs the hot stages of the pipeline on a scaled synthetic data set and stores
+their runtime and memory per sampling rate as JSON, so that results can be
+compared between commits.
+
+    python3 -m benchmarks.run --scale medium --sampling-rates 0.001 0.01 0.1 1.0
+
+The data set of a scale is generated once in the working directory, which is
+also used as the pipeline cache. Stages are timed in isolation, their
+dependencies are not included in the measurements.
+"""
+
+DEPARTMENTS = ["1A", "1B", "1C", "1D", "2A", "2B", "2C", "2D"]
+
+SCALES = {
+    "small": dict(
+        municipality_grid = 5, iris_step = 4,
+        census_households = 1000, census_weight = 10.0, hts_households = 300,
+        bpe_observations = 1000, commute_flow_observations = 1000,
+        address_observations = 5000, sirene_observations = 5000
+    ),
+    "medium": dict(
+        municipality_grid = 10, iris_step = 4,
+        census_households = 10000, census_weight = 20.0, hts_households = 2000,
+        bpe_observations = 10000, commute_flow_observations = 10000,
+        address_observations = 50000, sirene_observations = 50000
+    ),
+    "large": dict(
+        municipality_grid = 20, iris_step = 4,
+        census_households = 50000, census_weight = 40.0, hts_households = 5000,
+        bpe_observations = 50000, commute_flow_observations = 50000,
+        address_observations = 200000, sirene_observations = 200000
+    )
+}
+
+STAGES = [
+    "synthesis.population.sampled",
+    "synthesis.population.matched",
+    "synthesis.population.income.uniform",
+    "synthesis.population.spatial.home.locations",
+    "synthesis.population.spatial.primary.locations",
+    "synthesis.population.spatial.secondary.locations",
+    "matsim.scenario.population"
+]
+
+def create_data(data_path, scale):
+    parameters = dict(scale)
+    iris_step = parameters.pop("iris_step")
+
+    parameters["iris_municipalities"] = [
+        "%s%03d" % (department, index + 1) for department in DEPARTMENTS
+        for index in range(0, parameters["municipality_grid"]**2, iris_step)
+    ]
+
+    os.makedirs(data_path)
+    testdata.create(data_path, **parameters)
+
+def run_benchmark(working_directory, scale, sampling_rates, processes, update = {}):
+    data_path = "%s/data" % working_directory
+
+    if not os.path.exists(data_path):
+        create_data(data_path, SCALES[scale])
+
+    cache_path = "%s/cache" % working_directory
+    os.makedirs(cache_path, exist_ok = True)
+
+    results = []
+
+    for sampling_rate in sampling_rates:
+        config = dict(
+            data_path = data_path, output_path = working_directory,
+            regions = [10, 11], sampling_rate = sampling_rate, hts = "entd",
+            random_seed = 1000, processes = processes,
+            secloc_maximum_iterations = 10
+        )
+        config.update(update)
+
+        with profiling.profile(working_directory, "benchmark_", processes) as profiler:
+            df_persons = synpp.run([dict(descriptor = stage) for stage in STAGES], config, working_directory = cache_path)[0]
+
+        for record in profiler.records:
+            if record["stage"] in STAGES:
+                results.append(dict(
+                    sampling_rate = sampling_rate, persons = len(df_persons),
+                    stage = record["stage"], wall_time = record["wall_time"],
+                    cpu_time = record["cpu_time"], worker_cpu_time = record["worker_cpu_time"],
+                    peak_rss_mb = record["peak_rss_mb"]
+                ))
+
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark of the hot stages of the pipeline")
+    parser.add_argument("--scale", choices = list(SCALES.keys()), default = "small")
+    parser.add_argument("--sampling-rates", type = float, nargs = "+", default = [0.001, 0.01, 0.1, 1.0])
+    parser.add_argument("--processes", type = int, default = 1)
+    parser.add_argument("--working-directory", default = "benchmark_cache")
+    parser.add_argument("--output", default = None)
+    arguments = parser.parse_args()
+
+    working_directory = os.path.realpath("%s/%s" % (arguments.working_directory, arguments.scale))
+    os.makedirs(working_directory, exist_ok = True)
+
+    results = run_benchmark(working_directory, arguments.scale, arguments.sampling_rates, arguments.processes)
+
+    commit = meta_output.get_commit()
+    output_path = arguments.output
+
+    if output_path is None:
+        output_path = "benchmark_%s_%s.json" % (arguments.scale, commit[:8])
+
+    with open(output_path, "w+") as f:
+        json.dump(dict(
+            commit = commit, version = meta_output.get_version(),
+            created = datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            machine = platform.platform(), processes = arguments.processes,
+            scale = arguments.scale, dataset = SCALES[arguments.scale],
+            results = results
+        ), f, indent = 4)
+
+    print("Benchmark results written to %s" % output_path)
@@ -3,6 +3,8 @@ import pandas as pd
 import geopandas as gpd
 import numpy as np
 
+import data.raw_cache as raw_cache
+
 """
 This stage loads the raw data from the new French address registry (BAN).
 """
@@ -12,6 +14,7 @@ def configure(context):
 
     context.config("data_path")
     context.config("ban_path", "ban_idf")
+    context.config("raw_cache_path", None)
 
 BAN_DTYPES = {
     "code_insee": str,
@@ -28,11 +31,8 @@ def execute(context):
     df_ban = []
 
     for source_path in find_ban("{}/{}".format(context.config("data_path"), context.config("ban_path"))):
-        print("Reading {} ...".format(source_path))
+        df_partial = read_ban(context, source_path, requested_departments)
 
-        df_partial = pd.read_csv(source_path, 
-            compression = "gzip", sep = ";", usecols = BAN_DTYPES.keys(), dtype = BAN_DTYPES)
-        
         # Filter by departments
         df_partial["department_id"] = df_partial["code_insee"].str[:2]
         df_partial = df_partial[["department_id", "x", "y"]]
@@ -51,6 +51,28 @@ def execute(context):
 
     return df_ban[["geometry"]]
 
+def read_ban(context, source_path, requested_departments):
+    cache_path = raw_cache.get_cache_path(context, "ban", [source_path], dict(dtypes = BAN_DTYPES))
+
+    if not cache_path is None and raw_cache.is_cached(cache_path):
+        print("Reading {} from cache ...".format(source_path))
+        return raw_cache.read_partitions(cache_path, requested_departments, columns = BAN_DTYPES.keys())
+
+    print("Reading {} ...".format(source_path))
+
+    df_partial = pd.read_csv(source_path, 
+        compression = "gzip", sep = ";", usecols = BAN_DTYPES.keys(), dtype = BAN_DTYPES)
+
+    if cache_path is None:
+        return df_partial
+
+    # Store the whole file partitioned by department for later runs
+    writer = raw_cache.PartitionWriter(cache_path, BAN_DTYPES)
+    writer.write(df_partial, df_partial["code_insee"].str[:2])
+    writer.close()
+
+    return df_partial
+
 def find_ban(path):
     candidates = sorted(list(glob.glob("{}/*.csv.gz".format(path))))
 
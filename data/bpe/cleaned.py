@@ -1,5 +1,6 @@
 import numpy as np
-import shapely.geometry as geo
+import pandas as pd
+import shapely
 import data.spatial.utils as spatial_utils
 import geopandas as gpd
 
@@ -17,6 +18,7 @@ def configure(context):
     context.stage("data.spatial.municipalities")
 
     context.config("bpe_random_seed", 0)
+    context.config("bpe_sampling_method", "rejection")
 
 ACTIVITY_TYPE_MAP = [
     ("A", "other"),         # Police, post office, etc ...
@@ -29,20 +31,27 @@ ACTIVITY_TYPE_MAP = [
     ("G", "other"),         # Tourism, hotels, etc. (Hôtel = G102)
 ]
 
-def find_outside(context, commune_id):
-    df_municipalities = context.data("df_municipalities")
-    df = context.data("df")
+def find_outside(df, df_municipalities):
+    """
+    Returns the indices of the observations that are not inside their municipality,
+    ordered by municipality in order of appearance and then by observation.
+    """
+    df_municipalities = df_municipalities.drop_duplicates("commune_id")
 
-    df = df[df["commune_id"] == commune_id]
-    zone = df_municipalities[df_municipalities["commune_id"] == commune_id]["geometry"].values[0]
+    commune_ids = df["commune_id"].astype(str).values
+    zone_indices = pd.Index(df_municipalities["commune_id"].astype(str).values).get_indexer(commune_ids)
+    assert np.all(zone_indices >= 0)
 
-    indices = [
-        index for index, x, y in df[["x", "y"]].itertuples()
-        if not zone.contains(geo.Point(x, y))
-    ]
+    zones = np.asarray(df_municipalities["geometry"].values, dtype = object)
+    shapely.prepare(zones)
 
-    context.progress.update()
-    return indices
+    f_outside = ~shapely.contains_xy(zones[zone_indices], df["x"].values, df["y"].values)
+
+    commune_order = pd.Index(pd.unique(commune_ids)).get_indexer(commune_ids)
+    outside = np.flatnonzero(f_outside)
+    outside = outside[np.argsort(commune_order[outside], kind = "stable")]
+
+    return list(df.index[outside])
 
 def execute(context):
     df = context.stage("data.bpe.raw")
@@ -107,12 +116,14 @@ def execute(context):
     if np.count_nonzero(f_missing & ~f_undefined) > 0:
         # Impute missing coordinates for known IRIS
         df.update(spatial_utils.sample_from_zones(
-            context, df_iris, df[f_missing & ~f_undefined], "iris_id", random, label = "Imputing IRIS coordinates ..."))
+            context, df_iris, df[f_missing & ~f_undefined], "iris_id", random, label = "Imputing IRIS coordinates ...",
+            method = context.config("bpe_sampling_method")))
 
     if np.count_nonzero(f_missing & f_undefined) > 0:
         # Impute missing coordinates for unknown IRIS
         df.update(spatial_utils.sample_from_zones(
-            context, df_municipalities, df[f_missing & f_undefined], "commune_id", random, label = "Imputing municipality coordinates ..."))
+            context, df_municipalities, df[f_missing & f_undefined], "commune_id", random, label = "Imputing municipality coordinates ...",
+            method = context.config("bpe_sampling_method")))
 
     # Consolidate
     df["imputed"] = f_missing
@@ -120,19 +131,18 @@ def execute(context):
 
     # Intrestingly, some of the given coordinates are not really inside of
     # the respective municipality. Find them and move them back in.
-    outside_indices = []
-
-    with context.progress(label = "Finding outside observations ...", total = len(df["commune_id"].unique())):
-        with context.parallel(dict(df = df, df_municipalities = df_municipalities)) as parallel:
-            for partial in parallel.imap(find_outside, df["commune_id"].unique()):
-                outside_indices += partial
+    outside_indices = find_outside(df, df_municipalities)
+    print("Found %d/%d (%.2f%%) observations outside of their municipality" % (
+        len(outside_indices), len(df), 100 * len(outside_indices) / len(df)
+    ))
 
     if len(outside_indices) > 0:
         df.loc[outside_indices, "x"] = np.nan
         df.loc[outside_indices, "y"] = np.nan
 
         df.update(spatial_utils.sample_from_zones(
-            context, df_municipalities, df.loc[outside_indices], "commune_id", random, label = "Fixing outside locations ..."))
+            context, df_municipalities, df.loc[outside_indices], "commune_id", random, label = "Fixing outside locations ...",
+            method = context.config("bpe_sampling_method")))
 
         df.loc[outside_indices, "imputed"] = True
 
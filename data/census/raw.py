@@ -1,6 +1,8 @@
 import pandas as pd
 import os
-import zipfile
+
+import data.raw_cache as raw_cache
+import data.chunked_reader as chunked_reader
 
 """
 This stage loads the raw data from the French population census.
@@ -14,6 +16,9 @@ def configure(context):
     context.config("census_csv", "FD_INDCVI_2021.csv")
 
     context.config("projection_year", None)
+    context.config("raw_cache_path", None)
+    context.config("raw_chunk_size", 100000)
+    context.config("raw_csv_engine", "pandas")
 
 COLUMNS_DTYPES = {
     "CANTVILLE":"str", 
@@ -33,6 +38,12 @@ COLUMNS_DTYPES = {
     "DEROU":"str"
 }
 
+def read_census(context, callback):
+    for df_chunk in chunked_reader.read_chunks(context,
+            "{}/{}".format(context.config("data_path"), context.config("census_path")),
+            COLUMNS_DTYPES, sep = ";", member = context.config("census_csv"), label = "Reading census ..."):
+        callback(df_chunk)
+
 def execute(context):
     df_records = []
     df_codes = context.stage("data.spatial.codes")
@@ -42,24 +53,28 @@ def execute(context):
     # only pre-filter if we don't need to reweight the census later
     prefilter_departments = context.config("projection_year") is None
 
-    with context.progress(label = "Reading census ...") as progress:
-        with zipfile.ZipFile(
-            "{}/{}".format(context.config("data_path"), context.config("census_path"))) as archive:
-            with archive.open(context.config("census_csv")) as f:
-                csv = pd.read_csv(f, 
-                        usecols = COLUMNS_DTYPES.keys(), sep = ";",
-                        dtype = COLUMNS_DTYPES,
-                        chunksize = 10240)
-    
-                for df_chunk in csv:
-                    progress.update(len(df_chunk))
-                    
-                    if prefilter_departments:
-                        df_chunk = df_chunk[df_chunk["DEPT"].isin(requested_departements)]
-
-                    if len(df_chunk) > 0:
-                        df_records.append(df_chunk)
+    # Read from the persistent cache, which is partitioned by department
+    cache_path = raw_cache.get_cache_path(context, "census",
+        ["{}/{}".format(context.config("data_path"), context.config("census_path"))],
+        dict(csv = context.config("census_csv"), dtypes = COLUMNS_DTYPES))
+
+    if not cache_path is None:
+        if not raw_cache.is_cached(cache_path):
+            writer = raw_cache.PartitionWriter(cache_path, COLUMNS_DTYPES)
+            read_census(context, lambda df_chunk: writer.write(df_chunk, df_chunk["DEPT"]))
+            writer.close()
+
+        return raw_cache.read_partitions(cache_path,
+            requested_departements if prefilter_departments else None, columns = COLUMNS_DTYPES.keys())
+
+    def process_chunk(df_chunk):
+        if prefilter_departments:
+            df_chunk = df_chunk[df_chunk["DEPT"].isin(requested_departements)]
+
+        if len(df_chunk) > 0:
+            df_records.append(df_chunk)
 
+    read_census(context, process_chunk)
     return pd.concat(df_records)
 
 
@@ -0,0 +1,126 @@
+import time, zipfile, contextlib
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+
+import data.raw_cache as raw_cache
+
+"""
+Chunked reading of the large national CSV files.
+
+Loaders declare the raw_chunk_size and raw_csv_engine options and iterate over
+read_chunks. The default engine is the C parser of pandas. The pyarrow engine
+only parses the requested columns and converts them in large batches, which is
+considerably faster for files with many unused columns. Both engines give the
+same chunks: columns in the order of the file, missing strings as NaN and an
+index that continues over the chunks.
+"""
+
+ENGINES = ("pandas", "pyarrow")
+
+@contextlib.contextmanager
+def open_source(path, member = None):
+    if path.endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            if member is None:
+                names = archive.namelist()
+
+                if len(names) != 1:
+                    raise RuntimeError("Expected exactly one file in {}, found {}".format(path, names))
+
+                member = names[0]
+
+            with archive.open(member) as f:
+                yield f
+    else:
+        with open(path, "rb") as f:
+            yield f
+
+def read_header(path, member, sep):
+    with open_source(path, member) as f:
+        line = f.readline().decode("utf-8-sig").rstrip("\r\n")
+
+    return [column.strip('"') for column in line.split(sep)]
+
+def filter_prefixes(values, prefixes):
+    """
+    Returns a mask of the values that start with any of the given prefixes,
+    comparing one slice of the values per prefix length.
+    """
+    mask = np.zeros((len(values),), dtype = bool)
+    prefixes = set(prefixes)
+
+    for length in sorted(set(map(len, prefixes))):
+        mask |= values.str[:length].isin([prefix for prefix in prefixes if len(prefix) == length]).values
+
+    return mask
+
+def _read_pandas(f, dtypes, sep, chunk_size):
+    yield from pd.read_csv(f, usecols = dtypes.keys(), sep = sep, dtype = dtypes, chunksize = chunk_size)
+
+def _read_pyarrow(f, columns, dtypes, sep, chunk_size):
+    reader = pacsv.open_csv(f,
+        read_options = pacsv.ReadOptions(block_size = 1 << 24),
+        parse_options = pacsv.ParseOptions(delimiter = sep),
+        convert_options = pacsv.ConvertOptions(
+            include_columns = columns, strings_can_be_null = True,
+            column_types = { column: raw_cache.ARROW_TYPES[dtypes[column]] for column in columns }))
+
+    offset = 0
+    batches, batch_rows = [], 0
+
+    def convert():
+        df_chunk = pa.Table.from_batches(batches).to_pandas()
+        df_chunk.index = pd.RangeIndex(offset, offset + len(df_chunk))
+
+        for column in columns:
+            if dtypes[column] in ("str", str):
+                df_chunk[column] = df_chunk[column].where(df_chunk[column].notna(), np.nan)
+
+        return df_chunk
+
+    for batch in reader:
+        batches.append(batch)
+        batch_rows += batch.num_rows
+
+        if batch_rows >= chunk_size:
+            df_chunk = convert()
+            yield df_chunk
+
+            offset += len(df_chunk)
+            batches, batch_rows = [], 0
+
+    if batch_rows > 0:
+        yield convert()
+
+def read_chunks(context, path, dtypes, sep = ",", member = None, label = "Reading CSV ..."):
+    """
+    Iterates over the chunks of a (zipped) CSV file, reading only the columns in
+    dtypes, and reports the throughput at the end.
+    """
+    engine = context.config("raw_csv_engine")
+    chunk_size = context.config("raw_chunk_size")
+
+    if not engine in ENGINES:
+        raise RuntimeError("Unknown CSV engine: {}".format(engine))
+
+    start_time = time.time()
+    rows = 0
+
+    with context.progress(label = label) as progress:
+        with open_source(path, member) as f:
+            if engine == "pyarrow":
+                columns = [column for column in read_header(path, member, sep) if column in dtypes]
+                chunks = _read_pyarrow(f, columns, dtypes, sep, chunk_size)
+            else:
+                chunks = _read_pandas(f, dtypes, sep, chunk_size)
+
+            for df_chunk in chunks:
+                rows += len(df_chunk)
+                progress.update(len(df_chunk))
+                yield df_chunk
+
+    duration = time.time() - start_time
+    print("Read {} rows of {} in {:.2f}s ({:.0f} rows/s, {})".format(
+        rows, member or path, duration, rows / max(duration, 1e-9), engine))
@@ -1,7 +1,6 @@
 import zipfile, io
 import pandas as pd
 import geopandas as gpd
-import shapely.geometry as geo
 import os
 import numpy as np
 
@@ -147,12 +146,8 @@ def cut_feed(feed, df_area, crs = None):
     else:
         df_stations = df_stops[df_stops["location_type"] == 1].copy()
 
-    df_stations["geometry"] = [
-        geo.Point(*xy)
-        for xy in zip(df_stations["stop_lon"], df_stations["stop_lat"])
-    ]
-
-    df_stations = gpd.GeoDataFrame(df_stations, crs = "EPSG:4326")
+    df_stations = gpd.GeoDataFrame(df_stations,
+        geometry = gpd.points_from_xy(df_stations["stop_lon"], df_stations["stop_lat"]), crs = "EPSG:4326")
 
     if not crs is None:
         print("Converting stops to custom CRS", crs)
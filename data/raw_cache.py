@@ -0,0 +1,177 @@
+import os, glob, json, hashlib, shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+"""
+Persistent cache of raw data sets as partitioned Parquet files.
+
+Raw loaders convert their national source files once into one Parquet file per
+partition (usually the department) in raw_cache_path. The cache is keyed on
+the path, size and modification time of the sources and on the reader
+parameters, but not on the selected region. When the synpp cache of a loader
+is invalidated, e.g. after changing the regions, only the requested partitions
+are read back.
+
+The original row numbers are stored along with the data, so that reading from
+the cache gives the same rows, in the same order and with the same index as
+reading the source files.
+"""
+
+ROW_INDEX = "row_index"
+ALL = "all"
+
+ARROW_TYPES = {
+    "str": pa.string(), str: pa.string(),
+    "int32": pa.int32(), "int64": pa.int64(),
+    "float": pa.float64(), float: pa.float64()
+}
+
+def get_cache_path(context, name, source_paths, parameters = {}):
+    """
+    Returns the cache directory for the given sources or None if caching is disabled.
+    """
+    cache_path = context.config("raw_cache_path")
+
+    if cache_path is None:
+        return None
+
+    key = [
+        (os.path.realpath(path), os.path.getsize(path), os.path.getmtime(path))
+        for path in source_paths
+    ]
+
+    key = hashlib.md5(json.dumps([key, parameters], sort_keys = True, default = str).encode("utf-8"))
+    return "%s/%s_%s" % (cache_path, name, key.hexdigest())
+
+def is_cached(path):
+    return os.path.exists("%s/done" % path)
+
+class PartitionWriter:
+    """
+    Writes a data frame chunk by chunk into one Parquet file per partition. The
+    files are buffered to obtain reasonably large row groups and only become
+    visible once the writer is closed.
+    """
+    def __init__(self, path, dtypes, row_group_size = 100000):
+        self.path = path
+        self.temporary_path = "%s.tmp" % path
+        self.row_group_size = row_group_size
+
+        self.dtypes = dtypes
+        self.schema = None
+
+        self.writers = {}
+        self.buffers = {}
+
+        if os.path.exists(self.temporary_path):
+            shutil.rmtree(self.temporary_path)
+
+        os.makedirs(self.temporary_path)
+
+    def write(self, df, partitions = None):
+        if self.schema is None: # Keep the order of the source columns
+            self.schema = pa.schema(
+                [(column, ARROW_TYPES[self.dtypes[column]]) for column in df.columns if column in self.dtypes] +
+                [(ROW_INDEX, pa.int64())])
+
+        df = df[[field.name for field in self.schema if field.name != ROW_INDEX]].copy()
+        df[ROW_INDEX] = df.index.values.astype(np.int64)
+
+        if partitions is None:
+            partitions = np.full((len(df),), ALL, dtype = object)
+
+        partitions = pd.Series(np.asarray(partitions, dtype = object))
+
+        for partition, indices in partitions.groupby(partitions).indices.items():
+            buffer = self.buffers.setdefault(partition, [])
+            buffer.append(df.iloc[indices])
+
+            if sum(map(len, buffer)) >= self.row_group_size:
+                self._flush(partition)
+
+    def _flush(self, partition):
+        df = pd.concat(self.buffers[partition])
+        self.buffers[partition] = []
+
+        if not partition in self.writers:
+            self.writers[partition] = pq.ParquetWriter(
+                "%s/%s.parquet" % (self.temporary_path, partition), self.schema)
+
+        self.writers[partition].write_table(pa.Table.from_pandas(
+            df, schema = self.schema, preserve_index = False))
+
+    def close(self):
+        for partition in list(self.buffers.keys()):
+            if len(self.buffers[partition]) > 0:
+                self._flush(partition)
+
+        for writer in self.writers.values():
+            writer.close()
+
+        open("%s/done" % self.temporary_path, "w+").close()
+
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+
+        os.rename(self.temporary_path, self.path)
+
+def _restore_missing(df, schema):
+    # Missing strings are NaN when reading CSV
+    for field in schema:
+        if field.type == pa.string() and field.name in df:
+            df[field.name] = df[field.name].where(df[field.name].notna(), np.nan)
+
+    return df
+
+def read_partitions(path, partitions = None, columns = None, selection = None, batch_size = 100000):
+    """
+    Reads the requested partitions (all if None) with the requested columns back
+    into one data frame in the order of the source. The files are read in batches
+    and, if given, selection returns the mask of the rows to keep per batch, so
+    that only the selected rows are held in memory.
+    """
+    if partitions is None:
+        paths = sorted([
+            "%s/%s" % (path, name) for name in os.listdir(path) if name.endswith(".parquet")
+        ])
+    else:
+        paths = ["%s/%s.parquet" % (path, partition) for partition in sorted(set(partitions))]
+        paths = [path for path in paths if os.path.exists(path)]
+
+    candidates = paths if len(paths) > 0 else sorted(glob.glob("%s/*.parquet" % path))
+
+    if len(candidates) == 0:
+        raise RuntimeError("No cached partitions found in %s" % path)
+
+    schema = pq.read_schema(candidates[0])
+
+    # Keep the order of the source columns as when reading the CSV
+    if columns is None:
+        columns = [name for name in schema.names if name != ROW_INDEX]
+    else:
+        missing = set(columns) - set(schema.names)
+
+        if len(missing) > 0:
+            raise RuntimeError("Columns are not available in %s: %s" % (path, missing))
+
+        columns = [name for name in schema.names if name in set(columns)]
+
+    df = [_restore_missing(schema.empty_table().to_pandas()[columns + [ROW_INDEX]], schema)]
+
+    for partition_path in paths:
+        for batch in pq.ParquetFile(partition_path).iter_batches(batch_size = batch_size, columns = columns + [ROW_INDEX]):
+            df_batch = _restore_missing(batch.to_pandas(), schema)
+
+            if not selection is None:
+                df_batch = df_batch[selection(df_batch)]
+
+            df.append(df_batch)
+
+    df = pd.concat(df) if len(df) > 1 else df[0]
+
+    df = df.set_index(ROW_INDEX).sort_index()
+    df.index.name = None
+
+    return df
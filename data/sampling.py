@@ -0,0 +1,55 @@
+import numpy as np
+
+"""
+Shared routines for weighted categorical sampling from cumulative distributions.
+
+All samplers return the same indices as np.count_nonzero(cdf < u) per uniform
+value u, but use binary search instead of a full scan of the distribution.
+"""
+
+def calculate_cdf(weights):
+    """
+    Calculates the normalized cumulative distribution of the given weights.
+    """
+    cdf = np.cumsum(weights).astype(float)
+    cdf /= cdf[-1]
+    return cdf
+
+def sample_cdf(cdf, uniform):
+    """
+    Samples indices from a cumulative distribution for the given uniform values.
+
+    :param cdf: non-decreasing cumulative distribution
+    :param uniform: uniform values in [0, 1)
+    :returns: the number of entries of the distribution below each uniform value
+    """
+    return np.searchsorted(cdf, uniform, side = "left")
+
+def sample_grouped(cdf, offsets, groups, uniform):
+    """
+    Samples indices from many cumulative distributions that are stored in one flat
+    array. The distribution of group g is found in cdf[offsets[g]:offsets[g + 1]].
+
+    :param cdf: flat array of all cumulative distributions
+    :param offsets: start of each distribution, followed by the total length
+    :param groups: group of each uniform value
+    :param uniform: uniform values in [0, 1)
+    :returns: indices into the flat array, offsets[g] + sample_cdf(cdf of g, u)
+    """
+    groups, uniform = np.asarray(groups), np.asarray(uniform)
+    indices = np.zeros(groups.shape, dtype = int)
+
+    # Sort the values by group so that each group is one slice
+    order = np.argsort(groups, kind = "stable")
+    sorted_groups = groups[order]
+
+    boundaries = np.append(np.flatnonzero(np.diff(sorted_groups, prepend = -1)), len(groups))
+
+    for start, end in zip(boundaries[:-1], boundaries[1:]):
+        group = sorted_groups[start]
+        selection = order[start:end]
+
+        indices[selection] = offsets[group] + sample_cdf(
+            cdf[offsets[group]:offsets[group + 1]], uniform[selection])
+
+    return indices
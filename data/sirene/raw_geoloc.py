@@ -1,6 +1,8 @@
 import os
 import pandas as pd
 
+import data.chunked_reader as chunked_reader
+
 """
 This stage loads the geolocalization data for the French enterprise registry.
 """
@@ -10,6 +12,8 @@ def configure(context):
     context.config("siret_geo_path", "sirene/GeolocalisationEtablissement_Sirene_pour_etudes_statistiques_utf8.zip")
     
     context.stage("data.spatial.codes")
+    context.config("raw_chunk_size", 100000)
+    context.config("raw_csv_engine", "pandas")
 
 
 def execute(context):
@@ -24,26 +28,15 @@ def execute(context):
         "plg_code_commune":"str",
     }
 
-    df_siret_geoloc = pd.DataFrame(columns=["siret","x","y"])
-    
-    with context.progress(label = "Reading geolocalized SIRET ...") as progress:
-         csv = pd.read_csv("%s/%s" % (context.config("data_path"), context.config("siret_geo_path")), 
-                          usecols = COLUMNS_DTYPES.keys(), sep=";",dtype = COLUMNS_DTYPES,chunksize = 10240)
-    
-         for df_chunk in csv:
-            progress.update(len(df_chunk))
-            
-            f = df_chunk["siret"].isna() # Just to get a mask
-            
-            for departement in requested_departements:
-
-                f |= df_chunk["plg_code_commune"].str.startswith(departement)
-
-            df_siret_geoloc = pd.concat([df_siret_geoloc, df_chunk[f]],ignore_index=True)
+    df_siret_geoloc = [pd.DataFrame(columns=["siret","x","y"])]
 
-    return df_siret_geoloc
+    for df_chunk in chunked_reader.read_chunks(context,
+            "%s/%s" % (context.config("data_path"), context.config("siret_geo_path")),
+            COLUMNS_DTYPES, sep = ";", label = "Reading geolocalized SIRET ..."):
+        f = chunked_reader.filter_prefixes(df_chunk["plg_code_commune"], requested_departements)
+        df_siret_geoloc.append(df_chunk[f])
 
- 
+    return pd.concat(df_siret_geoloc, ignore_index = True)
 
 def validate(context):
     if not os.path.exists("%s/%s" % (context.config("data_path"), context.config("siret_geo_path"))):
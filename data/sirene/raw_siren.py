@@ -1,6 +1,9 @@
 import os
 import pandas as pd
 
+import data.raw_cache as raw_cache
+import data.chunked_reader as chunked_reader
+
 """
 This stage loads the raw data from the French enterprise registry.
 """
@@ -10,6 +13,9 @@ def configure(context):
     context.config("siren_path", "sirene/StockUniteLegale_utf8.zip")
 
     context.stage("data.sirene.raw_siret")
+    context.config("raw_cache_path", None)
+    context.config("raw_chunk_size", 100000)
+    context.config("raw_csv_engine", "pandas")
 
 def execute(context):
     relevant_siren = context.stage("data.sirene.raw_siret")["siren"].unique()
@@ -22,20 +28,35 @@ def execute(context):
         "categorieJuridiqueUniteLegale":"str", 
     }
     
-    with context.progress(label = "Reading SIREN...") as progress:
-        csv = pd.read_csv("%s/%s" % (context.config("data_path"), context.config("siren_path")),
-              usecols = COLUMNS_DTYPES.keys(), dtype = COLUMNS_DTYPES,chunksize = 10240)
+    def read_siren(callback):
+        for df_chunk in chunked_reader.read_chunks(context,
+                "%s/%s" % (context.config("data_path"), context.config("siren_path")),
+                COLUMNS_DTYPES, label = "Reading SIREN..."):
+            callback(df_chunk)
+
+    # Read from the persistent cache, which has only one partition
+    cache_path = raw_cache.get_cache_path(context, "siren",
+        ["%s/%s" % (context.config("data_path"), context.config("siren_path"))],
+        dict(dtypes = COLUMNS_DTYPES))
+
+    if not cache_path is None:
+        if not raw_cache.is_cached(cache_path):
+            writer = raw_cache.PartitionWriter(cache_path, COLUMNS_DTYPES)
+            read_siren(writer.write)
+            writer.close()
 
-        for df_chunk in csv:
-            progress.update(len(df_chunk))
+        return raw_cache.read_partitions(cache_path, columns = COLUMNS_DTYPES.keys(),
+            selection = lambda df_batch: df_batch["siren"].isin(relevant_siren))
 
-            df_chunk = df_chunk[
-                df_chunk["siren"].isin(relevant_siren)
-            ]
+    def process_chunk(df_chunk):
+        df_chunk = df_chunk[
+            df_chunk["siren"].isin(relevant_siren)
+        ]
 
-            if len(df_chunk) > 0:
-                df_siren.append(df_chunk)
+        if len(df_chunk) > 0:
+            df_siren.append(df_chunk)
 
+    read_siren(process_chunk)
     return pd.concat(df_siren)
 
 def validate(context):
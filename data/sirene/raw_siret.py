@@ -1,6 +1,9 @@
 import os
 import pandas as pd
 
+import data.raw_cache as raw_cache
+import data.chunked_reader as chunked_reader
+
 """
 This stage loads the raw data from the French enterprise registry.
 """
@@ -10,6 +13,9 @@ def configure(context):
     context.config("siret_path", "sirene/StockEtablissement_utf8.zip")
 
     context.stage("data.spatial.codes")
+    context.config("raw_cache_path", None)
+    context.config("raw_chunk_size", 100000)
+    context.config("raw_csv_engine", "pandas")
 
 def execute(context):
     # Filter by departement
@@ -27,26 +33,40 @@ def execute(context):
         "trancheEffectifsEtablissement":"str",
         "etatAdministratifEtablissement":"str"
     }
-    
-    with context.progress(label = "Reading SIRET...") as progress:
-        csv = pd.read_csv("%s/%s" % (context.config("data_path"), context.config("siret_path")),
-                          usecols = COLUMNS_DTYPES.keys(), dtype = COLUMNS_DTYPES,chunksize = 10240)
 
-        for df_chunk in csv:
-            progress.update(len(df_chunk))
+    def read_siret(callback):
+        for df_chunk in chunked_reader.read_chunks(context,
+                "%s/%s" % (context.config("data_path"), context.config("siret_path")),
+                COLUMNS_DTYPES, label = "Reading SIRET..."):
+            callback(df_chunk)
+
+    def filter_departements(df_chunk):
+        f = chunked_reader.filter_prefixes(df_chunk["codeCommuneEtablissement"], requested_departements)
+        return df_chunk[f]
 
-            f = df_chunk["codeCommuneEtablissement"].isna() # Just to get a mask
+    # Read from the persistent cache, which is partitioned by the first two digits of the municipality
+    cache_path = raw_cache.get_cache_path(context, "siret",
+        ["%s/%s" % (context.config("data_path"), context.config("siret_path"))],
+        dict(dtypes = COLUMNS_DTYPES))
 
-            for departement in requested_departements:
-                f |= df_chunk["codeCommuneEtablissement"].str.startswith(departement)
+    if not cache_path is None:
+        if not raw_cache.is_cached(cache_path):
+            writer = raw_cache.PartitionWriter(cache_path, COLUMNS_DTYPES)
+            read_siret(lambda df_chunk: writer.write(df_chunk, df_chunk["codeCommuneEtablissement"].str[:2]))
+            writer.close()
 
-            f &= ~df_chunk["codeCommuneEtablissement"].isna()
-            df_chunk = df_chunk[f]
+        return raw_cache.read_partitions(cache_path,
+            [departement[:2] for departement in requested_departements],
+            columns = COLUMNS_DTYPES.keys(), selection = lambda df_batch: chunked_reader.filter_prefixes(
+                df_batch["codeCommuneEtablissement"], requested_departements))
 
-            if len(df_chunk) > 0:
-                df_siret.append(df_chunk)
+    def process_chunk(df_chunk):
+        df_chunk = filter_departements(df_chunk)
 
+        if len(df_chunk) > 0:
+            df_siret.append(df_chunk)
 
+    read_siret(process_chunk)
     return pd.concat(df_siret)
 
 def validate(context):
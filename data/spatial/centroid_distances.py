@@ -1,18 +1,100 @@
+import numpy as np
 import pandas as pd
+from scipy.spatial import cKDTree
+
+"""
+This stage calculates the distances between the centroids of all municipalities.
+
+By default, a data frame with one row per origin and destination is returned. As
+this becomes very large for many municipalities, only pairs within a maximum
+distance can be kept, or a dense float32 matrix can be returned instead.
+"""
 
 def configure(context):
     context.stage("data.spatial.municipalities")
 
+    # Use "dense" to obtain a matrix instead of a data frame
+    context.config("centroid_distances_format", "long")
+
+    # Only keep pairs up to this distance in the long format
+    context.config("centroid_distances_threshold", None)
+
+def calculate_dense(coordinates, block_size = 1000):
+    distances = np.zeros((len(coordinates), len(coordinates)), dtype = np.float32)
+
+    for start in range(0, len(coordinates), block_size):
+        block = coordinates[start:start + block_size]
+        distances[start:start + block_size] = np.sqrt(np.sum(
+            (block[:, np.newaxis, :] - coordinates[np.newaxis, :, :])**2, axis = 2))
+
+    return distances
+
+def lookup_distances(distances, origin_ids, destination_ids):
+    """
+    Looks up the centroid distances for the given pairs in the dense format.
+    """
+    index = pd.Index(distances["commune_id"])
+
+    origin_indices = index.get_indexer(origin_ids)
+    destination_indices = index.get_indexer(destination_ids)
+
+    if np.any(origin_indices < 0) or np.any(destination_indices < 0):
+        raise RuntimeError("Unknown municipalities in centroid distance lookup")
+
+    return distances["distances"][origin_indices, destination_indices]
+
+def get_centroids(df_municipalities):
+    commune_ids = df_municipalities["commune_id"].astype(str).values
+    centroids = df_municipalities["geometry"].centroid
+    return commune_ids, np.vstack([centroids.x.values, centroids.y.values]).T
+
+def calculate_distances(df_municipalities, origin_ids, destination_ids):
+    """
+    Calculates the exact centroid distances for the given pairs, e.g. for pairs
+    that are beyond the threshold of the long format.
+    """
+    commune_ids, coordinates = get_centroids(df_municipalities)
+    index = pd.Index(commune_ids)
+
+    origin_indices = index.get_indexer(np.asarray(origin_ids).astype(str))
+    destination_indices = index.get_indexer(np.asarray(destination_ids).astype(str))
+
+    if np.any(origin_indices < 0) or np.any(destination_indices < 0):
+        raise RuntimeError("Unknown municipalities in centroid distance calculation")
+
+    return np.sqrt(np.sum((coordinates[origin_indices] - coordinates[destination_indices])**2, axis = 1))
+
 def execute(context):
     df = context.stage("data.spatial.municipalities")
-    records = []
+    commune_ids, coordinates = get_centroids(df)
+
+    output_format = context.config("centroid_distances_format")
+    threshold = context.config("centroid_distances_threshold")
+
+    if output_format == "dense":
+        return dict(
+            commune_id = commune_ids,
+            distances = calculate_dense(coordinates)
+        )
+
+    elif output_format != "long":
+        raise RuntimeError("Unknown format for centroid distances: %s" % output_format)
+
+    if threshold is None:
+        origin_indices = np.repeat(np.arange(len(df)), len(df))
+        destination_indices = np.tile(np.arange(len(df)), len(df))
+
+        distances = np.sqrt(np.sum((coordinates[origin_indices] - coordinates[destination_indices])**2, axis = 1))
+
+    else:
+        tree = cKDTree(coordinates)
+        pairs = tree.sparse_distance_matrix(tree, threshold, output_type = "ndarray")
+        pairs = np.sort(pairs, order = ["i", "j"])
 
-    with context.progress(total = len(df)**2, label = "Calculating centroid distances ...") as progress:
-        for origin_id, origin_geometry in zip(df["commune_id"], df["geometry"]):
-            for destination_id, destination_geometry in zip(df["commune_id"], df["geometry"]):
-                records.append((
-                    origin_id, destination_id, origin_geometry.centroid.distance(destination_geometry.centroid)
-                ))
-                progress.update()
+        origin_indices, destination_indices, distances = pairs["i"], pairs["j"], pairs["v"]
 
-    return pd.DataFrame.from_records(records, columns = ["origin_id", "destination_id", "centroid_distance"])
+    return pd.DataFrame(dict(
+        origin_id = commune_ids[origin_indices],
+        destination_id = commune_ids[destination_indices],
+        centroid_distance = distances
+    ))
@@ -1,37 +1,104 @@
+import shapely
 import shapely.geometry as geo
 import numpy as np
 import geopandas as gpd
 import pandas as pd
 
+from data.sampling import calculate_cdf, sample_cdf
+
 def to_gpd(context, df, x = "x", y = "y", crs = "EPSG:2154", column = "geometry"):
-    df[column] = [
-        geo.Point(*coord) for coord in context.progress(
-            zip(df[x], df[y]), total = len(df),
-            label = "Converting coordinates"
-        )]
-    df = gpd.GeoDataFrame(df, crs = "EPSG:2154", geometry = column)
+    df[column] = gpd.points_from_xy(df[x], df[y], crs = crs)
+    df = gpd.GeoDataFrame(df, geometry = column)
 
     if not df.crs == "EPSG:2154":
         df = df.to_crs("EPSG:2154")
 
     return df
 
-def sample_from_shape(shape, count, random, sample_size = None):
-    points = []
+SAMPLING_METHODS = ("rejection", "triangulation", "auto")
 
-    if sample_size is None:
-        sample_size = int(1.3 * count)
+# Zones that fill less of their bounding box are triangulated in "auto" mode
+AUTO_MINIMUM_ACCEPTANCE = 0.25
 
-    while len(points) < count:
-        minx, miny, maxx, maxy = shape.bounds
+def _sample_rejection(shape, count, random, sample_size):
+    minx, miny, maxx, maxy = shape.bounds
+    shapely.prepare(shape)
+
+    points = []
+    accepted, drawn = 0, 0
+
+    while accepted < count:
         candidates = random.random_sample(size = (sample_size, 2))
         candidates[:,0] = minx + candidates[:,0] * (maxx - minx)
         candidates[:,1] = miny + candidates[:,1] * (maxy - miny)
-        candidates = [geo.Point(*point) for point in candidates]
-        candidates = [point for point in candidates if shape.contains(point)]
-        points += candidates
 
-    return np.array([(point.x, point.y) for point in points[:count]])
+        candidates = candidates[shapely.contains_xy(shape, candidates[:,0], candidates[:,1])]
+        points.append(candidates)
+
+        accepted += len(candidates)
+        drawn += sample_size
+
+    return np.vstack(points)[:count], accepted / drawn
+
+def triangulate(shape):
+    """
+    Decomposes a (multi)polygon exactly into triangles. The Delaunay triangles
+    of all vertices are clipped to the shape. As no vertex of the shape lies
+    inside of a triangle, every clipped piece is convex and is split as a fan.
+    """
+    triangles = []
+
+    for triangle in shapely.get_parts(shapely.delaunay_triangles(shape)):
+        for piece in shapely.get_parts(shapely.intersection(triangle, shape)):
+            if not isinstance(piece, geo.Polygon) or piece.area == 0.0:
+                continue
+
+            coordinates = np.array(piece.exterior.coords)[:-1]
+
+            for index in range(1, len(coordinates) - 1):
+                triangles.append((coordinates[0], coordinates[index], coordinates[index + 1]))
+
+    return np.array(triangles).reshape(-1, 3, 2)
+
+def _sample_triangulation(shape, count, random):
+    triangles = triangulate(shape)
+
+    a, b, c = triangles[:,0], triangles[:,1], triangles[:,2]
+    areas = 0.5 * np.abs((b[:,0] - a[:,0]) * (c[:,1] - a[:,1]) - (c[:,0] - a[:,0]) * (b[:,1] - a[:,1]))
+
+    selection = sample_cdf(calculate_cdf(areas), random.random_sample(size = count))
+
+    # Uniform point in the triangle, mirroring samples from the other half of the parallelogram
+    u = random.random_sample(size = (count, 2))
+    f = u.sum(axis = 1) > 1.0
+    u[f] = 1.0 - u[f]
+
+    a, b, c = a[selection], b[selection], c[selection]
+    return a + u[:,0:1] * (b - a) + u[:,1:2] * (c - a)
+
+def _sample_shape(shape, count, random, sample_size = None, method = "rejection"):
+    if not method in SAMPLING_METHODS:
+        raise RuntimeError("Unknown sampling method: %s" % method)
+
+    if method == "auto":
+        minx, miny, maxx, maxy = shape.bounds
+        bounds_area = (maxx - minx) * (maxy - miny)
+        method = "triangulation" if bounds_area > 0.0 and shape.area / bounds_area < AUTO_MINIMUM_ACCEPTANCE else "rejection"
+
+    if method == "triangulation":
+        return _sample_triangulation(shape, count, random), 1.0
+
+    if sample_size is None:
+        sample_size = int(1.3 * count)
+
+    return _sample_rejection(shape, count, random, sample_size)
+
+def sample_from_shape(shape, count, random, sample_size = None, method = "rejection"):
+    """
+    Samples coordinates uniformly inside of the shape, either by rejection from the
+    bounding box or exactly from its triangulation (or "auto" to decide by shape).
+    """
+    return _sample_shape(shape, count, random, sample_size, method)[0]
 
 def _sample_from_zones(context, args):
     attribute_value, random_seed = args
@@ -39,16 +106,17 @@ def _sample_from_zones(context, args):
     df_zones = context.data("df_zones")
     df = context.data("df")
     attribute = context.data("attribute")
+    method = context.data("method")
 
     random = np.random.RandomState(random_seed)
     zone = df_zones[df_zones[attribute] == attribute_value]["geometry"].values[0]
 
     f = df[attribute] == attribute_value
-    coordinates = sample_from_shape(zone, np.count_nonzero(f), random)
+    coordinates, acceptance = _sample_shape(zone, np.count_nonzero(f), random, method = method)
 
-    return pd.DataFrame(coordinates, columns = ["x", "y"], index = f[f].index)
+    return pd.DataFrame(coordinates, columns = ["x", "y"], index = f[f].index), acceptance
 
-def sample_from_zones(context, df_zones, df, attribute, random, label = "Sampling coordinates ..."):
+def sample_from_zones(context, df_zones, df, attribute, random, label = "Sampling coordinates ...", method = "rejection"):
     assert attribute in df
     assert attribute in df_zones
 
@@ -56,9 +124,15 @@ def sample_from_zones(context, df_zones, df, attribute, random, label = "Samplin
     random_seeds = random.randint(0, int(1e6), len(unique_values))
 
     df_result = []
+    acceptance = []
 
-    with context.parallel(dict(df_zones = df_zones, df = df, attribute = attribute)) as parallel:
-        for df_partial in context.progress(parallel.imap(_sample_from_zones, zip(unique_values, random_seeds)), label = label, total = len(unique_values)):
+    with context.parallel(dict(df_zones = df_zones, df = df, attribute = attribute, method = method)) as parallel:
+        for df_partial, zone_acceptance in context.progress(parallel.imap(_sample_from_zones, zip(unique_values, random_seeds)), label = label, total = len(unique_values)):
             df_result.append(df_partial)
+            acceptance.append(zone_acceptance)
+
+    acceptance = pd.Series(acceptance, index = unique_values).sort_values()
+    print("Acceptance rate per zone (%s): mean %.2f, minimum %.2f" % (method, acceptance.mean(), acceptance.iloc[0]))
+    print("  Lowest:", ", ".join("%s (%.2f)" % item for item in acceptance.iloc[:5].items()))
 
     return pd.concat(df_result)
@@ -0,0 +1,231 @@
+import os, sys, time, threading, contextlib, logging
+import multiprocessing as mp
+import pandas as pd
+import synpp
+import synpp.pipeline
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+"""
+Optional instrumentation of the pipeline. Every stage that is executed within
+profile() is recorded with its wall time, CPU time, peak memory, the CPU time of
+its parallel workers and the size of its cached output. The report is written
+to the output path after every stage and, together with a summary table, when
+the block is left.
+
+To profile a pipeline that is configured through a YAML file, run
+
+    python3 -m documentation.profiling config.yml
+
+instead of python3 -m synpp config.yml.
+"""
+
+FIELDS = [
+    "stage", "wall_time", "cpu_time", "worker_cpu_time", "worker_utilization",
+    "peak_rss_mb", "output_size_mb", "cache_size_mb", "identifier"
+]
+
+def _current_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+def _maximum_rss():
+    # Peak of the whole process, in bytes
+    if resource is None:
+        return None
+
+    maximum_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maximum_rss if sys.platform == "darwin" else maximum_rss * 1024
+
+def _children_cpu_time():
+    if resource is None:
+        return None
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def _directory_size(path):
+    size = 0
+
+    for root, directories, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+
+    return size
+
+class MemorySampler(threading.Thread):
+    """
+    Samples the resident set size while running and returns its peak in bytes
+    when stopped, or None if it cannot be determined.
+    """
+    def __init__(self, interval = 0.1):
+        threading.Thread.__init__(self, daemon = True)
+        self.interval = interval
+        self.peak = _current_rss()
+        self.initial_maximum = _maximum_rss()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            rss = _current_rss()
+
+            if not rss is None:
+                self.peak = max(self.peak, rss)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+        rss = _current_rss()
+        if not rss is None: self.peak = max(self.peak, rss)
+
+        # Where /proc is not available, the peak of the whole process is only
+        # known to belong to the sampled period if it was reached during it
+        if self.peak is None:
+            maximum = _maximum_rss()
+
+            if not maximum is None and maximum > self.initial_maximum:
+                return maximum
+
+        return self.peak
+
+class Profiler:
+    def __init__(self, output_path, prefix, processes):
+        self.output_path = output_path
+        self.prefix = prefix
+        self.processes = processes
+        self.records = []
+
+        self.original_execute = None
+        self.finished = False
+
+    def install(self):
+        self.original_execute = synpp.pipeline.StageInstance.execute
+        profiler = self
+
+        def profiled_execute(stage, context):
+            return profiler.execute(profiler.original_execute, stage, context)
+
+        self.profiled_execute = profiled_execute
+        synpp.pipeline.StageInstance.execute = profiled_execute
+
+    def uninstall(self):
+        if synpp.pipeline.StageInstance.execute is self.profiled_execute:
+            synpp.pipeline.StageInstance.execute = self.original_execute
+
+    def end(self):
+        if not self.finished:
+            self.finished = True
+            self.uninstall()
+            self.finish()
+
+    def execute(self, execute, stage, context):
+        cache_path = getattr(context, "cache_path", None)
+        identifier = stage.name if cache_path is None else os.path.basename(cache_path)[:-len(".cache")]
+
+        children_cpu_time = _children_cpu_time()
+        sampler = MemorySampler()
+        sampler.start()
+
+        start_cpu_time = time.process_time()
+        start_time = time.time()
+
+        try:
+            return execute(stage, context)
+
+        finally:
+            wall_time = time.time() - start_time
+            cpu_time = time.process_time() - start_cpu_time
+            peak_rss = sampler.stop()
+
+            # Collect finished workers so that their resources are accounted
+            mp.active_children()
+            worker_cpu_time = None
+
+            if not children_cpu_time is None:
+                worker_cpu_time = _children_cpu_time() - children_cpu_time
+
+            self.records.append(dict(
+                stage = stage.name,
+                wall_time = wall_time,
+                cpu_time = cpu_time,
+                worker_cpu_time = worker_cpu_time,
+                worker_utilization = worker_cpu_time / (wall_time * self.processes) if not worker_cpu_time is None and wall_time > 0.0 else None,
+                peak_rss_mb = peak_rss / 1024**2 if not peak_rss is None else None,
+                output_size_mb = None, cache_size_mb = None,
+                identifier = identifier, cache_path = cache_path
+            ))
+
+            self.write()
+
+    def update_sizes(self):
+        for record in self.records:
+            if not record["cache_path"] is None:
+                output_path = record["cache_path"][:-len(".cache")] + ".p"
+
+                if os.path.exists(output_path):
+                    record["output_size_mb"] = os.path.getsize(output_path) / 1024**2
+
+                record["cache_size_mb"] = _directory_size(record["cache_path"]) / 1024**2
+
+    def get_report(self):
+        return pd.DataFrame.from_records(self.records, columns = FIELDS)
+
+    def write(self):
+        if not os.path.isdir(self.output_path):
+            return
+
+        df_report = self.get_report()
+        df_report.to_csv("%s/%sprofile.csv" % (self.output_path, self.prefix), sep = ";", index = False)
+
+        df_report.to_json("%s/%sprofile.json" % (self.output_path, self.prefix), orient = "records", indent = 4)
+
+    def finish(self):
+        if len(self.records) == 0:
+            return
+
+        self.update_sizes()
+        self.write()
+
+        df_report = self.get_report().sort_values(by = "wall_time", ascending = False)
+        df_report = df_report.drop(columns = ["identifier"])
+
+        print("Stage profile (%d stages, %.2fs):" % (len(df_report), df_report["wall_time"].sum()))
+        print(df_report.to_string(index = False, float_format = lambda value: "%.2f" % value))
+
+@contextlib.contextmanager
+def profile(output_path, prefix = "", processes = 1):
+    """
+    Profiles all stages that are executed within the block.
+    """
+    profiler = Profiler(output_path, prefix, processes)
+    profiler.install()
+
+    try:
+        yield profiler
+    finally:
+        profiler.end()
+
+if __name__ == "__main__":
+    import yaml
+
+    logging.basicConfig(level = logging.INFO)
+    config_path = sys.argv[1] if len(sys.argv) > 1 else "config.yml"
+
+    if not os.path.isfile(config_path):
+        raise synpp.PipelineError("Config file does not exist: %s" % config_path)
+
+    with open(config_path) as f:
+        config = yaml.load(f, Loader = yaml.SafeLoader).get("config", {})
+
+    with profile(config.get("output_path", "."), config.get("output_prefix", "ile_de_france_"), config.get("processes", 1)):
+        synpp.run_from_yaml(config_path)
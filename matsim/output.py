@@ -14,6 +14,9 @@ def configure(context):
     need_osm = context.config("export_detailed_network", False)
     if need_osm:
         context.stage("matsim.scenario.supply.osm")
+
+    if context.config("population_parquet", False):
+        context.stage("matsim.scenario.population")
     
 
     context.stage("documentation.meta_output")
@@ -47,6 +50,13 @@ def execute(context):
             "%s/%s" % (context.config("output_path"), "%sdetailed_network.csv" % context.config("output_prefix"))
         )
     
+    if context.config("population_parquet"):
+        for name in ("plans_persons.parquet", "plans_elements.parquet"):
+            shutil.copy(
+                "%s/%s" % (context.path("matsim.scenario.population"), name),
+                "%s/%s%s" % (context.config("output_path"), context.config("output_prefix"), name)
+            )
+
     if context.config("write_jar"):
         shutil.copy(
             "%s/%s" % (context.path("matsim.runtime.eqasim"), context.stage("matsim.runtime.eqasim")),
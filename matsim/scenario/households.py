@@ -1,5 +1,3 @@
-import io, gzip
-
 import numpy as np
 import pandas as pd
 
@@ -8,6 +6,10 @@ import matsim.writers as writers
 def configure(context):
     context.stage("synthesis.population.enriched")
 
+    context.config("processes")
+    context.config("sharded_gzip", False)
+    context.config("xml_buffer_size", 16)
+
 FIELDS = ["household_id", "person_id", "household_income", "car_availability", "bike_availability", "census_household_id"]
 
 def add_household(writer, household, member_ids):
@@ -34,28 +36,27 @@ def execute(context):
     current_household_id = None
     current_household = None
 
-    with gzip.open(output_path, 'wb+') as writer:
-        with io.BufferedWriter(writer, buffer_size = 2 * 1024**3) as writer:
-            writer = writers.HouseholdsWriter(writer)
-            writer.start_households()
+    with writers.open_gzip(output_path, context.config("sharded_gzip"), context.config("processes")) as writer:
+        writer = writers.HouseholdsWriter(writer, context.config("xml_buffer_size") * 1024**2)
+        writer.start_households()
 
-            with context.progress(total = len(df_persons), label = "Writing households ...") as progress:
-                for item in df_persons.itertuples(index = False):
-                    if current_household_id != item[FIELDS.index("household_id")]:
-                        if not current_household_id is None:
-                            add_household(writer, current_household, current_members)
+        with context.progress(total = len(df_persons), label = "Writing households ...") as progress:
+            for item in df_persons.itertuples(index = False):
+                if current_household_id != item[FIELDS.index("household_id")]:
+                    if not current_household_id is None:
+                        add_household(writer, current_household, current_members)
 
-                        current_household = item
-                        current_household_id = item[FIELDS.index("household_id")]
-                        current_members = [item[FIELDS.index("person_id")]]
-                    else:
-                        current_members.append(item[FIELDS.index("person_id")])
+                    current_household = item
+                    current_household_id = item[FIELDS.index("household_id")]
+                    current_members = [item[FIELDS.index("person_id")]]
+                else:
+                    current_members.append(item[FIELDS.index("person_id")])
 
-                    progress.update()
+                progress.update()
 
-            if not current_household_id is None:
-                add_household(writer, current_household, current_members)
+        if not current_household_id is None:
+            add_household(writer, current_household, current_members)
 
-            writer.end_households()
+        writer.end_households()
 
     return "households.xml.gz"
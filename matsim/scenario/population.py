@@ -1,11 +1,12 @@
-import io, gzip
 import itertools
 
 import numpy as np
 import pandas as pd
+import geopandas as gpd
 
 import matsim.writers as writers
 from matsim.writers import backlog_iterator
+from documentation.profiling import MemorySampler
 
 def configure(context):
     context.stage("synthesis.population.enriched")
@@ -16,6 +17,16 @@ def configure(context):
     context.stage("synthesis.population.trips")
     context.stage("synthesis.vehicles.vehicles")
 
+    # Use "columnar" to format chunks of persons at once (same output)
+    context.config("population_writer", "default")
+
+    context.config("processes")
+    context.config("sharded_gzip", False)
+    context.config("xml_buffer_size", 16)
+
+    # Set to also export the plans as Parquet tables
+    context.config("population_parquet", False)
+
 PERSON_FIELDS = [
     "person_id", "household_income", "car_availability", "bike_availability",
     "census_household_id", "census_person_id", "household_id",
@@ -101,6 +112,323 @@ def add_person(writer, person, activities, trips, vehicles):
     writer.end_plan()
     writer.end_person()
 
+def write_population(writer, df_persons, df_activities, df_trips, df_vehicles, progress, buffer_size = writers.DEFAULT_BUFFER_SIZE):
+    writer = writers.PopulationWriter(writer, buffer_size)
+    writer.start_population()
+
+    activity_iterator = backlog_iterator(iter(df_activities[ACTIVITY_FIELDS].itertuples(index = False)))
+    trip_iterator = backlog_iterator(iter(df_trips[TRIP_FIELDS].itertuples(index = False)))
+    vehicle_iterator = backlog_iterator(iter(df_vehicles[VEHICLE_FIELDS].itertuples(index = False)))
+
+    for person in df_persons.itertuples(index = False):
+        person_id = person[PERSON_FIELDS.index("person_id")]
+
+        activities = []
+        trips = []
+        vehicles = []
+
+        # Track all activities for person
+        while activity_iterator.has_next():
+            activity = activity_iterator.next()
+
+            if not activity[ACTIVITY_FIELDS.index("person_id")] == person_id:
+                activity_iterator.previous()
+                break
+            else:
+                activities.append(activity)
+
+        assert len(activities) > 0
+
+        # Track all trips for person
+        while trip_iterator.has_next():
+            trip = trip_iterator.next()
+
+            if not trip[TRIP_FIELDS.index("person_id")] == person_id:
+                trip_iterator.previous()
+                break
+            else:
+                trips.append(trip)
+
+        assert len(trips) == len(activities) - 1
+
+        # Track all vehicles for person
+        while vehicle_iterator.has_next():
+            vehicle = vehicle_iterator.next()
+
+            if not vehicle[VEHICLE_FIELDS.index("owner_id")] == person_id:
+                vehicle_iterator.previous()
+                break
+            else:
+                vehicles.append(vehicle)
+
+        add_person(writer, person, activities, trips, vehicles)
+        progress.update()
+
+    writer.end_population()
+
+PERSON_TEMPLATE = """  <person id="%d">
+    <attributes>
+      <attribute name="householdId" class="java.lang.Integer">%s</attribute>
+      <attribute name="householdIncome" class="java.lang.Double">%s</attribute>
+      <attribute name="carAvailability" class="java.lang.String">%s</attribute>
+      <attribute name="bikeAvailability" class="java.lang.String">%s</attribute>
+      <attribute name="censusHouseholdId" class="java.lang.Long">%s</attribute>
+      <attribute name="censusPersonId" class="java.lang.Long">%s</attribute>
+      <attribute name="htsHouseholdId" class="java.lang.Long">%s</attribute>
+      <attribute name="htsPersonId" class="java.lang.Long">%s</attribute>
+      <attribute name="hasPtSubscription" class="java.lang.Boolean">%s</attribute>
+      <attribute name="hasLicense" class="java.lang.String">%s</attribute>
+      <attribute name="isPassenger" class="java.lang.Boolean">%s</attribute>
+      <attribute name="age" class="java.lang.Integer">%s</attribute>
+      <attribute name="employed" class="java.lang.String">%s</attribute>
+      <attribute name="sex" class="java.lang.String">%s</attribute>
+      <attribute name="vehicles" class="org.matsim.vehicles.PersonVehicles">{%s}</attribute>
+    </attributes>
+    <plan selected="yes">
+"""
+
+PERSON_END = """    </plan>
+  </person>
+"""
+
+ACTIVITY_TEMPLATE = """      <activity type="%s" x="%f" y="%f" %s%s%s/>
+"""
+
+LEG_TEMPLATE = """      <leg mode="%s" dep_time="%s" trav_time="%s" >
+      <attributes>
+        <attribute name="routingMode" class="java.lang.String">%s</attribute>
+      </attributes>
+      </leg>
+"""
+
+def find_offsets(person_ids, reference_ids, name):
+    # Finds the range of each person in reference_ids, which must be sorted by person
+    if np.any(np.diff(reference_ids) < 0):
+        raise RuntimeError("The %s are not sorted by person" % name)
+
+    offsets = np.zeros(len(person_ids) + 1, dtype = int)
+    offsets[:-1] = np.searchsorted(reference_ids, person_ids, side = "left")
+    offsets[-1] = np.searchsorted(reference_ids, person_ids[-1], side = "right") if len(person_ids) > 0 else 0
+
+    return offsets
+
+def write_population_columnar(writer, df_persons, df_activities, df_trips, df_vehicles, progress, chunk_size = 10000, buffer_size = writers.DEFAULT_BUFFER_SIZE):
+    """
+        Writes the same output as write_population, but the persons are formatted
+        in chunks from columns, with activities, trips and vehicles found by
+        offsets per person, and every chunk is written as one block.
+    """
+    writer = writers.PopulationWriter(writer, buffer_size)
+    writer.start_population()
+
+    person_ids = df_persons["person_id"].values
+
+    if np.any(np.diff(person_ids) <= 0):
+        raise RuntimeError("The persons must be ordered by identifier")
+
+    activity_offsets = find_offsets(person_ids, df_activities["person_id"].values, "activities")
+    trip_offsets = find_offsets(person_ids, df_trips["person_id"].values, "trips")
+    vehicle_offsets = find_offsets(person_ids, df_vehicles["owner_id"].values, "vehicles")
+
+    activity_counts = np.diff(activity_offsets)
+    assert np.all(activity_counts > 0)
+    assert np.all(np.diff(trip_offsets) == activity_counts - 1)
+
+    # Persons
+    household_ids = df_persons["household_id"].tolist()
+
+    person_values = list(zip(
+        df_persons["person_id"].tolist(), household_ids,
+        df_persons["household_income"].tolist(),
+        df_persons["car_availability"].tolist(), df_persons["bike_availability"].tolist(),
+        df_persons["census_household_id"].tolist(), df_persons["census_person_id"].tolist(),
+        df_persons["hts_household_id"].tolist(), df_persons["hts_id"].tolist(),
+        df_persons["has_pt_subscription"].tolist(),
+        [writer.yes_no(value) for value in df_persons["has_license"].tolist()],
+        df_persons["is_passenger"].tolist(),
+        df_persons["age"].tolist(), df_persons["employed"].tolist(),
+        [value[0] for value in df_persons["sex"].tolist()]
+    ))
+
+    vehicles = [
+        "\"%s\":\"%s\"" % item for item in zip(
+            df_vehicles["mode"].tolist(), df_vehicles["vehicle_id"].tolist())
+    ]
+
+    # Activities
+    purposes = df_activities["purpose"].tolist()
+    location_ids = df_activities["location_id"].tolist()
+    activity_household_ids = np.repeat(np.array(household_ids, dtype = object), activity_counts)
+
+    for index in np.flatnonzero(np.array(purposes, dtype = object) == "home"):
+        location_ids[index] = "home_%s" % activity_household_ids[index]
+
+    facilities = [
+        "" if location_id is None or location_id == -1 else "facility=\"%s\" " % str(location_id)
+        for location_id in location_ids
+    ]
+
+    start_times = ["" if time is None else "start_time=\"%s\" " % time for time in writer.times(df_activities["start_time"].values)]
+    end_times = ["" if time is None else "end_time=\"%s\" " % time for time in writer.times(df_activities["end_time"].values)]
+
+    geometry = gpd.GeoSeries(df_activities["geometry"].values)
+
+    activities = [
+        ACTIVITY_TEMPLATE % item for item in zip(
+            purposes, geometry.x.values, geometry.y.values,
+            facilities, start_times, end_times)
+    ]
+
+    # Trips
+    modes = df_trips["mode"].tolist()
+
+    legs = [
+        LEG_TEMPLATE % item for item in zip(
+            modes, writer.times(df_trips["departure_time"].values),
+            writer.times(df_trips["travel_time"].values), modes)
+    ]
+
+    # Write chunks of persons
+    for start in range(0, len(person_ids), chunk_size):
+        end = min(start + chunk_size, len(person_ids))
+
+        activity_start, activity_end = activity_offsets[start], activity_offsets[end]
+        trip_start, trip_end = trip_offsets[start], trip_offsets[end]
+
+        # Per person: header, activities and legs in alternation, footer
+        person_indices = np.arange(end - start)
+        activity_persons = np.repeat(person_indices, activity_counts[start:end])
+        trip_persons = np.repeat(person_indices, activity_counts[start:end] - 1)
+
+        local_activity_offsets = activity_offsets[start:end] - activity_start
+        local_next_offsets = activity_offsets[start + 1:end + 1] - activity_start
+
+        fragments = np.empty(2 * (activity_end - activity_start) + (end - start), dtype = object)
+
+        fragments[2 * local_activity_offsets + person_indices] = [
+            PERSON_TEMPLATE % (person_values[index] + ("",)) if vehicle_offsets[index] == vehicle_offsets[index + 1] else
+            PERSON_TEMPLATE % (person_values[index] + (",".join(vehicles[vehicle_offsets[index]:vehicle_offsets[index + 1]]),))
+            for index in range(start, end)
+        ]
+
+        fragments[2 * local_next_offsets + person_indices] = PERSON_END
+        fragments[2 * np.arange(activity_end - activity_start) + activity_persons + 1] = activities[activity_start:activity_end]
+        fragments[2 * np.arange(trip_end - trip_start) + 3 * trip_persons + 2] = legs[trip_start:trip_end]
+
+        writer.write_many(fragments.tolist())
+        progress.update(end - start)
+
+    writer.end_population()
+
+def write_plans_parquet(output_path, df_persons, df_activities, df_trips, df_vehicles):
+    """
+        Writes the plans as they appear in the XML population as two Parquet
+        tables: persons with their attributes, and plan elements (activities and
+        legs in alternation) of which each person covers the range from
+        element_offset to element_offset + element_count.
+    """
+    person_ids = df_persons["person_id"].values
+
+    activity_offsets = find_offsets(person_ids, df_activities["person_id"].values, "activities")
+    trip_offsets = find_offsets(person_ids, df_trips["person_id"].values, "trips")
+    vehicle_offsets = find_offsets(person_ids, df_vehicles["owner_id"].values, "vehicles")
+
+    activity_counts = np.diff(activity_offsets)
+    assert np.all(activity_counts > 0)
+    assert np.all(np.diff(trip_offsets) == activity_counts - 1)
+
+    element_counts = 2 * activity_counts - 1
+
+    element_offsets = np.zeros(len(person_ids), dtype = np.int64)
+    element_offsets[1:] = np.cumsum(element_counts)[:-1]
+
+    # Persons
+    vehicles = [
+        "\"%s\":\"%s\"" % item for item in zip(
+            df_vehicles["mode"].tolist(), df_vehicles["vehicle_id"].tolist())
+    ]
+
+    df_plan_persons = pd.DataFrame(dict(
+        person_id = person_ids.astype(np.int64),
+        household_id = df_persons["household_id"].values.astype(np.int64),
+        household_income = df_persons["household_income"].values.astype(np.float64),
+        car_availability = df_persons["car_availability"].astype(str).values,
+        bike_availability = df_persons["bike_availability"].astype(str).values,
+        census_household_id = df_persons["census_household_id"].values.astype(np.int64),
+        census_person_id = df_persons["census_person_id"].values.astype(np.int64),
+        hts_household_id = df_persons["hts_household_id"].values.astype(np.int64),
+        hts_person_id = df_persons["hts_id"].values.astype(np.int64),
+        has_pt_subscription = df_persons["has_pt_subscription"].values.astype(bool),
+        has_license = df_persons["has_license"].values.astype(bool),
+        is_passenger = df_persons["is_passenger"].values.astype(bool),
+        age = df_persons["age"].values.astype(np.int64),
+        employed = df_persons["employed"].values.astype(bool),
+        sex = df_persons["sex"].astype(str).str[0].values,
+        vehicles = [
+            "{%s}" % ",".join(vehicles[vehicle_offsets[index]:vehicle_offsets[index + 1]])
+            for index in range(len(person_ids))
+        ],
+        element_offset = element_offsets,
+        element_count = element_counts.astype(np.int64)
+    ))
+
+    # Plan elements, activities are at even and legs at odd positions per person
+    activity_persons = np.repeat(np.arange(len(person_ids)), activity_counts)
+    trip_persons = np.repeat(np.arange(len(person_ids)), activity_counts - 1)
+
+    activity_indices = 2 * np.arange(len(activity_persons)) - activity_persons
+    trip_indices = 2 * np.arange(len(trip_persons)) + trip_persons + 1
+
+    element_count = len(activity_indices) + len(trip_indices)
+
+    element_types = np.empty(element_count, dtype = object)
+    element_types[activity_indices] = "activity"
+    element_types[trip_indices] = "leg"
+
+    purposes = df_activities["purpose"].astype(str).values
+    location_ids = df_activities["location_id"].tolist()
+    household_ids = df_persons["household_id"].values[activity_persons]
+
+    facility_ids = [
+        "home_%s" % household_id if purpose == "home" else (
+            None if location_id is None or location_id == -1 else str(location_id))
+        for purpose, location_id, household_id in zip(purposes, location_ids, household_ids)
+    ]
+
+    geometry = gpd.GeoSeries(df_activities["geometry"].values)
+
+    activity_types = np.full(element_count, None, dtype = object)
+    activity_types[activity_indices] = purposes
+
+    facilities = np.full(element_count, None, dtype = object)
+    facilities[activity_indices] = facility_ids
+
+    modes = np.full(element_count, None, dtype = object)
+    modes[trip_indices] = df_trips["mode"].astype(str).values
+
+    def place(indices, values):
+        result = np.full(element_count, np.nan)
+        result[indices] = values
+        return result
+
+    df_elements = pd.DataFrame(dict(
+        person_id = person_ids[np.sort(np.concatenate([activity_persons, trip_persons]))].astype(np.int64),
+        element_index = np.arange(element_count) - np.repeat(element_offsets, element_counts),
+        element_type = element_types,
+        activity_type = activity_types,
+        x = place(activity_indices, geometry.x.values),
+        y = place(activity_indices, geometry.y.values),
+        facility_id = facilities,
+        start_time = place(activity_indices, df_activities["start_time"].values),
+        end_time = place(activity_indices, df_activities["end_time"].values),
+        mode = modes,
+        departure_time = place(trip_indices, df_trips["departure_time"].values),
+        travel_time = place(trip_indices, df_trips["travel_time"].values)
+    ))
+
+    df_plan_persons.to_parquet("%s/plans_persons.parquet" % output_path)
+    df_elements.to_parquet("%s/plans_elements.parquet" % output_path)
+
 def execute(context):
     output_path = "%s/population.xml.gz" % context.path()
 
@@ -121,60 +449,29 @@ def execute(context):
     df_vehicles = context.stage("synthesis.vehicles.vehicles")[1]
     df_vehicles = df_vehicles.sort_values(by = ["owner_id"])
 
-    with gzip.open(output_path, 'wb+') as writer:
-        with io.BufferedWriter(writer, buffer_size = 2 * 1024**3) as writer:
-            writer = writers.PopulationWriter(writer)
-            writer.start_population()
-
-            activity_iterator = backlog_iterator(iter(df_activities[ACTIVITY_FIELDS].itertuples(index = False)))
-            trip_iterator = backlog_iterator(iter(df_trips[TRIP_FIELDS].itertuples(index = False)))
-            vehicle_iterator = backlog_iterator(iter(df_vehicles[VEHICLE_FIELDS].itertuples(index = False)))
-
-            with context.progress(total = len(df_persons), label = "Writing population ...") as progress:
-                for person in df_persons.itertuples(index = False):
-                    person_id = person[PERSON_FIELDS.index("person_id")]
-
-                    activities = []
-                    trips = []
-                    vehicles = []
-
-                    # Track all activities for person
-                    while activity_iterator.has_next():
-                        activity = activity_iterator.next()
-
-                        if not activity[ACTIVITY_FIELDS.index("person_id")] == person_id:
-                            activity_iterator.previous()
-                            break
-                        else:
-                            activities.append(activity)
-
-                    assert len(activities) > 0
+    method = context.config("population_writer")
 
-                    # Track all trips for person
-                    while trip_iterator.has_next():
-                        trip = trip_iterator.next()
+    if not method in ("default", "columnar"):
+        raise RuntimeError("Unknown population writer: %s" % method)
 
-                        if not trip[TRIP_FIELDS.index("person_id")] == person_id:
-                            trip_iterator.previous()
-                            break
-                        else:
-                            trips.append(trip)
+    buffer_size = context.config("xml_buffer_size") * 1024**2
 
-                    assert len(trips) == len(activities) - 1
+    memory_sampler = MemorySampler()
+    memory_sampler.start()
 
-                    # Track all vehicles for person
-                    while vehicle_iterator.has_next():
-                        vehicle = vehicle_iterator.next()
+    with writers.open_gzip(output_path, context.config("sharded_gzip"), context.config("processes")) as writer:
+        with context.progress(total = len(df_persons), label = "Writing population ...") as progress:
+            if method == "columnar":
+                write_population_columnar(writer, df_persons, df_activities, df_trips, df_vehicles, progress, buffer_size = buffer_size)
+            else:
+                write_population(writer, df_persons, df_activities, df_trips, df_vehicles, progress, buffer_size = buffer_size)
 
-                        if not vehicle[VEHICLE_FIELDS.index("owner_id")] == person_id:
-                            vehicle_iterator.previous()
-                            break
-                        else:
-                            vehicles.append(vehicle)
+    if context.config("population_parquet"):
+        write_plans_parquet(context.path(), df_persons, df_activities, df_trips, df_vehicles)
 
-                    add_person(writer, person, activities, trips, vehicles)
-                    progress.update()
+    peak_memory = memory_sampler.stop()
 
-            writer.end_population()
+    if not peak_memory is None:
+        print("Peak memory usage while writing population: %.1f MB" % (peak_memory / 1024**2))
 
     return "population.xml.gz"
@@ -1,12 +1,21 @@
+import gzip, contextlib
+import collections
+import concurrent.futures
 import numpy as np
 from xml.sax.saxutils import escape
 
+DEFAULT_BUFFER_SIZE = 16 * 1024**2
+
 class XmlWriter:
-    def __init__(self, writer):
+    def __init__(self, writer, buffer_size = DEFAULT_BUFFER_SIZE):
         self.writer = writer
         self.indent = 0
         self.scope = None
 
+        # Output is collected in a chunk buffer that is passed on when full
+        self.buffer = bytearray()
+        self.buffer_size = buffer_size
+
     def _write_line(self, content):
         self._write_indent()
         self._write(content + "\n")
@@ -15,7 +24,23 @@ class XmlWriter:
         self._write("  " * self.indent)
 
     def _write(self, content):
-        self.writer.write(bytes(content, "utf-8"))
+        self.write_raw(content.encode("utf-8"))
+
+    def write_raw(self, content):
+        # Appends already encoded content
+        self.buffer += content
+
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def write_many(self, fragments):
+        # Appends a sequence of preformatted fragments at once
+        self.write_raw("".join(fragments).encode("utf-8"))
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            self.writer.write(self.buffer)
+            self.buffer.clear()
 
     def _require_scope(self, scope):
         if scope == None and not self.scope is None:
@@ -40,6 +65,17 @@ class XmlWriter:
         seconds = (time % 60)
         return "%02d:%02d:%02d" % (hours, minutes, seconds)
 
+    def times(self, times):
+        # Formats an array of times like time, but each distinct value only once
+        times = np.asarray(times, dtype = float)
+        result = np.full(len(times), None, dtype = object)
+
+        f = ~np.isnan(times)
+        unique, inverse = np.unique(times[f], return_inverse = True)
+
+        result[f] = np.array([self.time(time) for time in unique] + [None], dtype = object)[:-1][inverse]
+        return result
+
     def location(self, x, y, facility_id = None):
         return (x, y, None if facility_id is None else facility_id)
 
@@ -61,8 +97,8 @@ class PopulationWriter(XmlWriter):
     PLAN_SCOPE = 3
     ATTRIBUTES_SCOPE = 4
 
-    def __init__(self, writer):
-        XmlWriter.__init__(self, writer)
+    def __init__(self, writer, buffer_size = DEFAULT_BUFFER_SIZE):
+        XmlWriter.__init__(self, writer, buffer_size)
 
     def start_population(self, attributes = {}):
         self._require_scope(None)
@@ -80,6 +116,7 @@ class PopulationWriter(XmlWriter):
         self.indent -= 1
         self._write_line('</population>')
         self.scope = self.FINISHED_SCOPE
+        self.flush()
 
     def start_person(self, person_id):
         self._require_scope(self.POPULATION_SCOPE)
@@ -158,8 +195,8 @@ class HouseholdsWriter(XmlWriter):
     HOUSEHOLD_SCOPE = 2
     ATTRIBUTES_SCOPE = 3
 
-    def __init__(self, writer):
-        XmlWriter.__init__(self, writer)
+    def __init__(self, writer, buffer_size = DEFAULT_BUFFER_SIZE):
+        XmlWriter.__init__(self, writer, buffer_size)
 
     def start_households(self, attributes = {}):
         self._require_scope(None)
@@ -175,6 +212,7 @@ class HouseholdsWriter(XmlWriter):
         self._require_scope(self.HOUSEHOLDS_SCOPE)
         self._write_line('</households>')
         self.scope = self.FINISHED_SCOPE
+        self.flush()
 
     def start_household(self, household_id):
         self._require_scope(self.HOUSEHOLDS_SCOPE)
@@ -223,8 +261,8 @@ class FacilitiesWriter(XmlWriter):
     FINISHED_SCOPE = 1
     FACILITY_SCOPE = 2
 
-    def __init__(self, writer):
-        XmlWriter.__init__(self, writer)
+    def __init__(self, writer, buffer_size = DEFAULT_BUFFER_SIZE):
+        XmlWriter.__init__(self, writer, buffer_size)
 
     def start_facilities(self, attributes = {}):
         self._require_scope(None)
@@ -242,6 +280,7 @@ class FacilitiesWriter(XmlWriter):
         self.indent -= 1
         self._write_line('</facilities>')
         self.scope = self.FINISHED_SCOPE
+        self.flush()
 
     def start_facility(self, facility_id, x, y):
         self._require_scope(self.FACILITIES_SCOPE)
@@ -267,8 +306,8 @@ class VehiclesWriter(XmlWriter):
     VEHICLES_SCOPE = 0
     FINISHED_SCOPE = 1
 
-    def __init__(self, writer):
-        XmlWriter.__init__(self, writer)
+    def __init__(self, writer, buffer_size = DEFAULT_BUFFER_SIZE):
+        XmlWriter.__init__(self, writer, buffer_size)
 
     def start_vehicles(self, attributes = {}):
         self._require_scope(None)
@@ -285,6 +324,7 @@ class VehiclesWriter(XmlWriter):
         self.indent -= 1
         self._write_line('</vehicleDefinitions>')
         self.scope = self.FINISHED_SCOPE
+        self.flush()
 
     def add_type(self, vehicle_type_id, nb_seats = 4, length = 5.0, width = 1.0, pce = 1.0, mode = "car", attributes = {}, engine_attributes = {}):
         self._require_scope(self.VEHICLES_SCOPE)
@@ -382,3 +422,68 @@ class backlog_iterator:
             return True
         except StopIteration:
             return False
+
+class ShardedGzipWriter:
+    """
+        Writes a gzip file as a sequence of independent gzip members. The written
+        content is cut into shards that are compressed in parallel threads and
+        appended to the file in their original order. Decompressing the file
+        yields the same content as a single member file.
+    """
+    def __init__(self, path, threads = 1, shard_size = 64 * 1024**2, compresslevel = 9):
+        self.file = open(path, "wb+")
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = threads)
+        self.threads = threads
+        self.shard_size = shard_size
+        self.compresslevel = compresslevel
+
+        self.buffer = []
+        self.buffer_size = 0
+        self.pending = collections.deque()
+        self.members = 0
+
+    def write(self, content):
+        self.buffer.append(bytes(content))
+        self.buffer_size += len(content)
+
+        if self.buffer_size >= self.shard_size:
+            self._submit()
+
+        return len(content)
+
+    def _submit(self):
+        content = b"".join(self.buffer)
+        self.buffer, self.buffer_size = [], 0
+
+        self.pending.append(self.executor.submit(gzip.compress, content, self.compresslevel, mtime = 0))
+        self.members += 1
+
+        # Bound the number of shards that are held in memory
+        while len(self.pending) > 2 * self.threads:
+            self.file.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.buffer_size > 0 or self.members == 0:
+            self._submit()
+
+        while len(self.pending) > 0:
+            self.file.write(self.pending.popleft().result())
+
+        self.executor.shutdown()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+@contextlib.contextmanager
+def open_gzip(path, sharded = False, threads = 1):
+    if sharded:
+        with ShardedGzipWriter(path, threads = threads) as writer:
+            yield writer
+
+    else:
+        with gzip.open(path, 'wb+') as writer:
+            yield writer
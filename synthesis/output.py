@@ -1,7 +1,7 @@
 import shutil
 import geopandas as gpd
 import pandas as pd
-import shapely.geometry as geo
+import shapely
 import os, datetime, json
 import sqlite3
 import math
@@ -60,6 +60,10 @@ def clean_gpkg(path):
     conn.commit()
     conn.close()
 
+def to_lines(origins, destinations):
+    coordinates = np.stack([shapely.get_coordinates(origins), shapely.get_coordinates(destinations)], axis = 1)
+    return shapely.linestrings(coordinates)
+
 def execute(context):
     output_path = context.config("output_path")
     output_prefix = context.config("output_prefix")
@@ -224,10 +228,7 @@ def execute(context):
         df_spatial[df_spatial["purpose"] == "work"].drop_duplicates("person_id")[["person_id", "geometry"]].rename(columns = { "geometry": "work_geometry" })
     )
 
-    df_spatial["geometry"] = [
-        geo.LineString(od)
-        for od in zip(df_spatial["home_geometry"], df_spatial["work_geometry"])
-    ]
+    df_spatial["geometry"] = to_lines(df_spatial["home_geometry"].values, df_spatial["work_geometry"].values)
 
     df_spatial = df_spatial.drop(columns = ["home_geometry", "work_geometry"])
     if "gpkg" in output_formats:
@@ -253,10 +254,7 @@ def execute(context):
         "geometry": "following_geometry"
     }), how = "left", on = ["person_id", "following_activity_index"])
 
-    df_spatial["geometry"] = [
-        geo.LineString(od)
-        for od in zip(df_spatial["preceding_geometry"], df_spatial["following_geometry"])
-    ]
+    df_spatial["geometry"] = to_lines(df_spatial["preceding_geometry"].values, df_spatial["following_geometry"].values)
 
     df_spatial = df_spatial.drop(columns = ["preceding_geometry", "following_geometry"])
 
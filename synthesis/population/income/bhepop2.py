@@ -1,6 +1,7 @@
 import numpy as np
 import pandas as pd
 from synthesis.population.income.utils import income_uniform_sample, MAXIMUM_INCOME_FACTOR
+from synthesis.population.utils import index_groups, select_group
 from bhepop2.tools import add_household_size_attribute, add_household_type_attribute
 from bhepop2.sources.marginal_distributions import QuantitativeMarginalDistributions
 from bhepop2.enrichment.bhepop2 import Bhepop2Enrichment
@@ -25,14 +26,15 @@ def configure(context):
 
 def _sample_income(context, args):
     commune_id, random_seed = args
-    df_households, df_income = context.data("households"), context.data("income")
+    df_households, household_groups = context.data("households"), context.data("household_groups")
+    df_income, income_groups = context.data("income"), context.data("income_groups")
 
     random = np.random.RandomState(random_seed)
 
     # selection of commune population and distributions
-    f = df_households["commune_id"] == commune_id
-    df_selected = df_households[f].reset_index(drop=True)
-    distribs = df_income[df_income["commune_id"] == commune_id]
+    start, end = household_groups[commune_id]
+    df_selected = df_households.iloc[start:end].reset_index(drop=True)
+    distribs = select_group(df_income, income_groups, commune_id)
     distribs = distribs.rename(
         columns={
             "value": "modality",
@@ -75,7 +77,7 @@ def _sample_income(context, args):
 
         # print(f"Successfully enriched population on commune {commune_id} using bhepop2")
         context.progress.update(1)
-        return f, incomes, "bhepop2"
+        return start, end, incomes, "bhepop2"
 
     # if those exceptions are raised, it is likely that some distributions were missing
     except (PopulationValidationError, SourceValidationError, ValueError) as e:
@@ -89,7 +91,7 @@ def _sample_income(context, args):
         incomes = income_uniform_sample(random, centiles, len(df_selected))
 
         context.progress.update(1)
-        return f, incomes, "uniform"
+        return start, end, incomes, "uniform"
 
 
 def execute(context):
@@ -115,13 +117,27 @@ def execute(context):
     commune_ids = df_households["commune_id"].unique()
     random_seeds = random.randint(10000, size = len(commune_ids))
 
+    df_households, household_groups = index_groups(df_households, "commune_id")
+    df_income, income_groups = index_groups(df_income, "commune_id")
+
+    consumption_units = df_households["consumption_units"].values
+    household_income = np.full(len(df_households), np.nan)
+    method = np.full(len(df_households), None, dtype = object)
+
     # Perform sampling per commune
     with context.progress(label = "Imputing income ...", total = len(commune_ids)) as progress:
-        with context.parallel(dict(households = df_households, income = df_income)) as parallel:
-
-            for f, incomes, method in parallel.imap(_sample_income, zip(commune_ids, random_seeds)):
-                df_households.loc[f, "household_income"] = incomes * df_households.loc[f, "consumption_units"]
-                df_households.loc[f, "method"] = method
+        with context.parallel(dict(
+            households = df_households, household_groups = household_groups,
+            income = df_income, income_groups = income_groups
+        )) as parallel:
+
+            for start, end, incomes, partial_method in parallel.imap(_sample_income, zip(commune_ids, random_seeds)):
+                household_income[start:end] = incomes * consumption_units[start:end]
+                method[start:end] = partial_method
+
+    df_households["household_income"] = household_income
+    df_households["method"] = method
+    df_households = df_households.sort_index()
 
     # Cleanup
     df_households = df_households[["household_id", "household_income", "consumption_units"]]
@@ -1,6 +1,7 @@
 import numpy as np
 import pandas as pd
 from synthesis.population.income.utils import income_uniform_sample
+from synthesis.population.utils import index_groups, select_group
 import multiprocessing as mp
 from tqdm import tqdm
 
@@ -22,18 +23,17 @@ def configure(context):
 
 def _sample_income(context, args):
     commune_id, random_seed = args
-    df_households, df_income = context.data("households"), context.data("income")
+    household_groups, df_income, income_groups = context.data("household_groups"), context.data("income"), context.data("income_groups")
 
     random = np.random.RandomState(random_seed)
 
-    f = df_households["commune_id"] == commune_id
-    df_selected = df_households[f]
+    start, end = household_groups[commune_id]
 
-    centiles = list(df_income[df_income["commune_id"] == commune_id][["q1", "q2", "q3", "q4", "q5", "q6", "q7", "q8", "q9"]].iloc[0].values / 12)
+    centiles = list(select_group(df_income, income_groups, commune_id)[["q1", "q2", "q3", "q4", "q5", "q6", "q7", "q8", "q9"]].iloc[0].values / 12)
 
-    incomes = income_uniform_sample(random, centiles, len(df_selected))
+    incomes = income_uniform_sample(random, centiles, end - start)
 
-    return f, incomes
+    return start, end, incomes
 
 def execute(context):
     random = np.random.RandomState(context.config("random_seed"))
@@ -51,14 +51,23 @@ def execute(context):
     ]]
 
     df_households = pd.merge(df_households, df_homes)
+    commune_ids = df_households["commune_id"].unique()
+
+    df_households, household_groups = index_groups(df_households, "commune_id")
+    df_income, income_groups = index_groups(df_income, "commune_id")
+
+    consumption_units = df_households["consumption_units"].values
+    household_income = np.full(len(df_households), np.nan)
 
     # Perform sampling per commune
-    with context.parallel(dict(households = df_households, income = df_income)) as parallel:
-        commune_ids = df_households["commune_id"].unique()
+    with context.parallel(dict(household_groups = household_groups, income = df_income, income_groups = income_groups)) as parallel:
         random_seeds = random.randint(10000, size = len(commune_ids))
 
-        for f, incomes in context.progress(parallel.imap(_sample_income, zip(commune_ids, random_seeds)), label = "Imputing income ...", total = len(commune_ids)):
-            df_households.loc[f, "household_income"] = incomes * df_households.loc[f, "consumption_units"]
+        for start, end, incomes in context.progress(parallel.imap(_sample_income, zip(commune_ids, random_seeds)), label = "Imputing income ...", total = len(commune_ids)):
+            household_income[start:end] = incomes * consumption_units[start:end]
+
+    df_households["household_income"] = household_income
+    df_households = df_households.sort_index()
 
     # Cleanup
     df_households = df_households[["household_id", "household_income", "consumption_units"]]
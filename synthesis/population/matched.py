@@ -1,8 +1,8 @@
 from tqdm import tqdm
-import itertools
 import numpy as np
 import pandas as pd
-import numba
+
+from data.sampling import sample_cdf
 
 import data.hts.egt.cleaned
 import data.hts.entd.cleaned
@@ -36,14 +36,33 @@ def configure(context):
     hts = context.config("hts")
     context.stage("data.hts.selected", alias = "hts")
 
-@numba.jit(nopython = True) # Already parallelized parallel = True)
 def sample_indices(uniform, cdf, selected_indices):
-    indices = np.arange(len(uniform))
+    return selected_indices[sample_cdf(cdf, uniform)]
+
+def encode_cells(df_source, df_target, columns):
+    """
+    Encodes the values of the first k columns as one integer cell code per row, for
+    every level k. Codes are shared between source and target, missing values are
+    encoded as -1 and never match.
+    """
+    source_codes, target_codes = [], []
+    current = np.zeros((len(df_source) + len(df_target),), dtype = np.int64)
+
+    for column in columns:
+        values = pd.concat([df_source[column], df_target[column]], ignore_index = True)
+        column_codes, column_values = pd.factorize(values)
 
-    for i, u in enumerate(uniform):
-        indices[i] = np.count_nonzero(cdf < u)
+        missing = (current < 0) | (column_codes < 0)
+        current = current * len(column_values) + column_codes
+        current[missing] = -1
 
-    return selected_indices[indices]
+        # Keep codes compact so they do not overflow
+        current[~missing] = np.unique(current[~missing], return_inverse = True)[1]
+
+        source_codes.append(current[:len(df_source)])
+        target_codes.append(current[len(df_source):])
+
+    return source_codes, target_codes
 
 def statistical_matching(progress, df_source, source_identifier, weight, df_target, target_identifier, columns, random_seed = 0, minimum_observations = 0):
     random = np.random.RandomState(random_seed)
@@ -56,22 +75,8 @@ def statistical_matching(progress, df_source, source_identifier, weight, df_targ
     df_source = df_source.sort_values(by = columns)
     df_target = df_target.sort_values(by = columns)
 
-    # Find unique values for all columns
-    unique_values = {}
-
-    for column in columns:
-        unique_values[column] = list(sorted(set(df_source[column].unique()) | set(df_target[column].unique())))
-
-    # Generate filters for all columns and values
-    source_filters, target_filters = {}, {}
-
-    for column, column_unique_values in unique_values.items():
-        source_filters[column] = [df_source[column].values == value for value in column_unique_values]
-        target_filters[column] = [df_target[column].values == value for value in column_unique_values]
-
-    # Define search order
-    source_filters = [source_filters[column] for column in columns]
-    target_filters = [target_filters[column] for column in columns]
+    # Encode cells, as the source is sorted the rows of a cell are consecutive on all levels
+    source_codes, target_codes = encode_cells(df_source, df_target, columns)
 
     # Perform matching
     weights = df_source[weight].values
@@ -80,34 +85,55 @@ def statistical_matching(progress, df_source, source_identifier, weight, df_targ
     assigned_levels = np.ones((len(df_target),), dtype = int) * -1
     uniform = random.random_sample(size = (len(df_target),))
 
-    column_indices = [np.arange(len(unique_values[column])) for column in columns]
+    for level in range(1, len(columns) + 1)[::-1]:
+        if np.count_nonzero(unassigned_mask) == 0:
+            break
+
+        level_source_codes = source_codes[level - 1]
+        level_target_codes = target_codes[level - 1]
+
+        # Find the source range of each cell
+        cell_count = max(np.max(level_source_codes, initial = -1), np.max(level_target_codes, initial = -1)) + 1
+        cell_starts = np.zeros((cell_count,), dtype = int)
+        cell_ends = np.zeros((cell_count,), dtype = int)
+
+        run_starts = np.flatnonzero(np.diff(level_source_codes, prepend = -2) != 0)
+        run_ends = np.append(run_starts[1:], len(level_source_codes))
+        run_codes = level_source_codes[run_starts]
+
+        f = run_codes >= 0
+        cell_starts[run_codes[f]] = run_starts[f]
+        cell_ends[run_codes[f]] = run_ends[f]
+
+        # Find the unassigned targets in cells with sufficient observations
+        target_indices = np.flatnonzero(unassigned_mask & (level_target_codes >= 0))
+        cells = level_target_codes[target_indices]
 
-    for level in range(1, len(column_indices) + 1)[::-1]:
-        level_column_indices = column_indices[:level]
+        observations = cell_ends[cells] - cell_starts[cells]
+        f = (observations >= minimum_observations) & (observations > 0)
 
-        if np.count_nonzero(unassigned_mask) > 0:
-            for column_index in itertools.product(*level_column_indices):
-                f_source = np.logical_and.reduce([source_filters[i][k] for i, k in enumerate(column_index)])
-                f_target = np.logical_and.reduce([target_filters[i][k] for i, k in enumerate(column_index)] + [unassigned_mask])
+        target_indices = target_indices[f]
+        cells = cells[f]
 
-                selected_indices = np.nonzero(f_source)[0]
-                requested_samples = np.count_nonzero(f_target)
+        # Sample per non-empty cell
+        order = np.argsort(cells, kind = "mergesort")
+        target_indices, cells = target_indices[order], cells[order]
 
-                if requested_samples == 0:
-                    continue
+        boundaries = np.flatnonzero(np.diff(cells, prepend = -1, append = cell_count) != 0)
 
-                if len(selected_indices) < minimum_observations:
-                    continue
+        for start, end in zip(boundaries[:-1], boundaries[1:]):
+            cell = cells[start]
+            selected_indices = np.arange(cell_starts[cell], cell_ends[cell])
+            f_target = target_indices[start:end]
 
-                selected_weights = weights[f_source]
-                cdf = np.cumsum(selected_weights)
-                cdf /= cdf[-1]
+            cdf = np.cumsum(weights[selected_indices])
+            cdf /= cdf[-1]
 
-                assigned_indices[f_target] = sample_indices(uniform[f_target], cdf, selected_indices)
-                assigned_levels[f_target] = level
-                unassigned_mask[f_target] = False
+            assigned_indices[f_target] = sample_indices(uniform[f_target], cdf, selected_indices)
+            assigned_levels[f_target] = level
+            unassigned_mask[f_target] = False
 
-                progress.update(np.count_nonzero(f_target))
+            progress.update(len(f_target))
 
     # Randomly assign unmatched observations
     cdf = np.cumsum(weights)
@@ -1,5 +1,7 @@
+import time
 import pandas as pd
 import numpy as np
+import scipy.sparse as sparse
 
 """
 This stage reweights the census data set according to the projection data for a different year.
@@ -9,6 +11,33 @@ def configure(context):
     context.stage("data.census.cleaned")
     context.stage("data.census.projection")
 
+def build_attribute_matrix(df_census, household_count, df_marginal, columns, selection = None):
+    """
+    Builds the sparse household x attribute matrix of one marginal. Each row of the
+    marginal is an attribute, defined by the levels in the given columns, and the
+    entries count the matching members per household.
+    """
+    if selection is None:
+        selection = np.ones((len(df_census),), dtype = bool)
+
+    if len(columns) == 0:
+        attribute_indices = np.zeros((len(df_census),), dtype = int)
+    else:
+        marginal_index = pd.MultiIndex.from_frame(df_marginal[columns].infer_objects())
+        census_index = pd.MultiIndex.from_frame(df_census[columns])
+        attribute_indices = marginal_index.get_indexer(census_index)
+
+    selection = selection & (attribute_indices >= 0)
+    attribute_count = max(len(df_marginal), 1)
+
+    # Every attribute must be represented in the census
+    assert np.all(np.bincount(attribute_indices[selection], minlength = attribute_count) > 0)
+
+    return sparse.coo_matrix((
+        np.ones((np.count_nonzero(selection),)),
+        (df_census["household_index"].values[selection], attribute_indices[selection])
+    ), shape = (household_count, attribute_count)).tocsc()
+
 def execute(context):
     df_census = context.stage("data.census.cleaned")
     projection = context.stage("data.census.projection")
@@ -24,59 +53,47 @@ def execute(context):
     # Obtain weights and sizes as arrays
     household_weights = df_households["weight"].values
 
-    # Obtain the attribute levels and membership of attributes for all households
-    attributes = []
+    # Define the marginals, additional ones are matched on all their columns
+    f_adult = ((df_census["age"] > 0) & (df_census["age"] <= 104)).values
+
+    marginals = [
+        ("age", ["age"], None),
+        ("sex", ["sex"], f_adult),
+        ("cross", ["sex", "age"], None),
+        ("total", [], f_adult)
+    ]
+
+    for name, df_marginal in projection.items():
+        if not name in ("age", "sex", "cross", "total"):
+            marginals.append((name, [column for column in df_marginal.columns if column != "projection"], None))
 
-    attribute_membership = []
-    attribute_counts = []
+    # Obtain the household x attribute membership matrix and the targets
+    attributes = []
     attribute_targets = []
+    matrices = []
 
-    # Proccesing age ...
-    df_marginal = projection["age"]
-    for index, row in context.progress(df_marginal.iterrows(), label = "Processing attribute: age", total = len(df_marginal)):
-        f = df_census["age"] == row["age"]
-        assert np.count_nonzero(f) > 0
-
-        df_counts = df_census.loc[f, "household_index"].value_counts()
-        attribute_targets.append(row["projection"])
-        attribute_membership.append(df_counts.index.values)
-        attribute_counts.append(df_counts.values)
-        attributes.append("age={}".format(row["age"]))
-    
-    # Processing sex ...
-    df_marginal = projection["sex"]
-    for index, row in context.progress(df_marginal.iterrows(), label = "Processing attribute: sex", total = len(df_marginal)):
-        f = df_census["sex"] == row["sex"]
-        f &= (df_census["age"] > 0) & (df_census["age"] <= 104)
-        assert np.count_nonzero(f) > 0
-
-        df_counts = df_census.loc[f, "household_index"].value_counts()
-        attribute_targets.append(row["projection"])
-        attribute_membership.append(df_counts.index.values)
-        attribute_counts.append(df_counts.values)
-        attributes.append("sex={}".format(row["sex"]))
-
-    # Processing age x sex ...
-    df_marginal = projection["cross"]
-    for index, row in context.progress(df_marginal.iterrows(), label = "Processing attributes: sex x age", total = len(df_marginal)):
-        f = (df_census["sex"] == row["sex"]) & (df_census["age"] == row["age"])
-        assert np.count_nonzero(f) > 0
-
-        df_counts = df_census.loc[f, "household_index"].value_counts()
-        attribute_targets.append(row["projection"])
-        attribute_membership.append(df_counts.index.values)
-        attribute_counts.append(df_counts.values)
-        attributes.append("sex={},age={}".format(row["sex"], row["age"]))
-
-    # Processing total ...
-    f = (df_census["age"] > 0) & (df_census["age"] <= 104)
-    assert np.count_nonzero(f) > 0
-    
-    df_counts = df_census.loc[f, "household_index"].value_counts()
-    attribute_targets.append(projection["total"]["projection"].values[0])
-    attribute_membership.append(df_counts.index.values)
-    attribute_counts.append(df_counts.values)
-    attributes.append("total")
+    for name, columns, selection in context.progress(marginals, label = "Processing marginals", total = len(marginals)):
+        df_marginal = projection[name]
+
+        matrices.append(build_attribute_matrix(df_census, len(df_households), df_marginal, columns, selection))
+        attribute_targets.append(df_marginal["projection"].values)
+
+        if len(columns) == 0:
+            attributes.append(name)
+        else:
+            attributes += [
+                ",".join("{}={}".format(column, value) for column, value in zip(columns, values))
+                for values in df_marginal[columns].itertuples(index = False)
+            ]
+
+    attribute_targets = np.hstack(attribute_targets).astype(float)
+
+    # Weight the member counts by the initial household weights once
+    membership = sparse.hstack(matrices).tocsc()
+    membership = membership.multiply(household_weights[:, np.newaxis]).tocsc()
+    membership.sort_indices()
+
+    indptr, indices, data = membership.indptr, membership.indices, membership.data
 
     # Perform IPU to obtain update weights
     update = np.ones((len(df_households),))
@@ -86,19 +103,19 @@ def execute(context):
     maximum_iterations = 100
 
     for iteration in range(maximum_iterations):
-        factors = []    
-        for k in np.arange(len(attributes)):
-            selection = attribute_membership[k]
-        
-            target = attribute_targets[k]
-            current = np.sum(update[selection] * household_weights[selection] * attribute_counts[k])
-        
-            factor = target / current
-            factors.append(factor)
-                
-            update[selection] *= factor
-
-        print("IPU it={} min={} max={}".format(iteration, np.min(factors), np.max(factors)))
+        start_time = time.time()
+        factors = np.zeros((len(attributes),))
+
+        for k in range(len(attributes)):
+            selection = indices[indptr[k]:indptr[k + 1]]
+
+            current = np.dot(data[indptr[k]:indptr[k + 1]], update[selection])
+            factors[k] = attribute_targets[k] / current
+
+            update[selection] *= factors[k]
+
+        print("IPU it={} min={} max={} time={:.2f}s".format(
+            iteration, np.min(factors), np.max(factors), time.time() - start_time))
 
         converged = np.abs(1 - np.max(factors)) < convergence_threshold
         converged &= np.abs(1 - np.min(factors)) < convergence_threshold
@@ -1,6 +1,5 @@
 import numpy as np
 import pandas as pd
-import itertools
 
 """
 This stage has the census data as input and samples households according to the
@@ -32,30 +31,32 @@ def execute(context):
     # Multiply households (use same multiplicator for all household members)
     household_multiplicators = df_rounding["multiplicator"].values
     household_sizes = df_rounding["household_size"].values
+    household_starts = np.cumsum(household_sizes) - household_sizes
 
-    # create index to replicate all households members by their household weight
+    # Replicate households by their weight, the replicas of one household are consecutive
+    replicated_households = np.repeat(np.arange(len(household_sizes)), household_multiplicators)
+    replicated_sizes = household_sizes[replicated_households]
+    household_count = len(replicated_households)
+
+    # Select sample from 100% population before expanding the persons
+    selector = random.random_sample(household_count) < sampling_rate
+    selected_households = np.flatnonzero(selector)
+    selected_sizes = replicated_sizes[selected_households]
+
+    # Persons keep the identifiers they would have in the 100% population
     # the order ([0, 1, 0, 1, 2, 2, ...]) is important here as they will be reassigned to new housholds later with that assumption
-    expandor = np.split(np.arange(len(df_census)), np.cumsum(household_sizes))
-    expandor = [x for x in expandor if x.size > 0]
-    expandor = np.repeat(expandor, household_multiplicators, axis=0)
-    expandor = list(itertools.chain(*expandor))
+    person_offsets = np.cumsum(replicated_sizes) - replicated_sizes
+    member_indices = np.arange(np.sum(selected_sizes)) - np.repeat(np.cumsum(selected_sizes) - selected_sizes, selected_sizes)
 
-    df_census = df_census.iloc[expandor]
+    expandor = np.repeat(household_starts[replicated_households[selected_households]], selected_sizes) + member_indices
+    df_census = df_census.iloc[expandor].copy()
 
     # Create new household and person IDs
     df_census["census_person_id"] = df_census["person_id"]
     df_census["census_household_id"] = df_census["household_id"]
 
-    df_census["person_id"] = np.arange(len(df_census))
-
-    household_sizes = np.repeat(household_sizes, household_multiplicators)
-    household_count = np.sum(household_multiplicators)
-    df_census.loc[:, "household_id"] = np.repeat(np.arange(household_count), household_sizes)
-
-    # Select sample from 100% population
-    selector = random.random_sample(household_count) < sampling_rate
-    selector = np.repeat(selector, household_sizes)
-    df_census = df_census[selector]
+    df_census["person_id"] = np.repeat(person_offsets[selected_households], selected_sizes) + member_indices
+    df_census.loc[:, "household_id"] = np.repeat(selected_households, selected_sizes)
 
     del df_census["weight"]
     return df_census
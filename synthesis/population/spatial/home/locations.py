@@ -2,6 +2,8 @@ import data.spatial.utils as spatial_utils
 import numpy as np
 import pandas as pd
 import geopandas as gpd
+from synthesis.population.utils import index_groups, select_group
+from data.sampling import calculate_cdf, sample_cdf
 
 def configure(context):
     context.stage("synthesis.population.spatial.home.zones")
@@ -12,15 +14,15 @@ def configure(context):
 
 def _sample_locations(context, args):
     # Extract data sets
-    df_locations = context.data("df_locations")
-    df_homes = context.data("df_homes")
+    df_locations, location_groups = context.data("df_locations"), context.data("location_groups")
+    df_homes, home_groups = context.data("df_homes"), context.data("home_groups")
 
     # Extract task parameters
     iris_id, random_seed = args
 
     # Select home candidates and locations for the selected IRIS
-    df_homes = df_homes[df_homes["iris_id"] == iris_id].copy()
-    df_locations = df_locations[df_locations["iris_id"] == iris_id].copy()
+    df_homes = select_group(df_homes, home_groups, iris_id).copy()
+    df_locations = select_group(df_locations, location_groups, iris_id).copy()
 
     # Verify counts
     home_count = len(df_homes)
@@ -32,11 +34,8 @@ def _sample_locations(context, args):
     # Perform sampling
     random = np.random.RandomState(random_seed)
 
-    cdf = np.cumsum(df_locations["weight"].values)
-    cdf /= cdf[-1]
-
-    indices = np.array([np.count_nonzero(cdf < u) 
-        for u in random.random_sample(size = home_count)])
+    cdf = calculate_cdf(df_locations["weight"].values)
+    indices = sample_cdf(cdf, random.random_sample(size = home_count))
     
     # Apply selection
     df_homes["geometry"] = df_locations.iloc[indices]["geometry"].values
@@ -56,9 +55,13 @@ def execute(context):
     # Sample locations for home
     unique_iris_ids = sorted(set(df_homes["iris_id"].unique()))
 
+    df_locations, location_groups = index_groups(df_locations, "iris_id")
+    df_homes, home_groups = index_groups(df_homes, "iris_id")
+
     with context.progress(label = "Sampling home locations ...", total = len(unique_iris_ids)):
         with context.parallel(dict(
-            df_locations = df_locations, df_homes = df_homes
+            df_locations = df_locations, location_groups = location_groups,
+            df_homes = df_homes, home_groups = home_groups
         )) as parallel:
             seeds = random.randint(10000, size = len(unique_iris_ids))
             df_homes = pd.concat(parallel.map(_sample_locations, zip(unique_iris_ids, seeds)))
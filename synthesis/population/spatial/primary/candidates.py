@@ -1,5 +1,6 @@
 import pandas as pd
 import numpy as np
+from synthesis.population.utils import index_groups, select_group
 
 def configure(context):
     context.stage("data.od.weighted")
@@ -24,11 +25,11 @@ EDUCATION_MAPPING = {
 def sample_destination_municipalities(context, arguments):
     # Load data
     origin_id, count, random_seed = arguments
-    df_od = context.data("df_od")
+    df_od, od_groups = context.data("df_od"), context.data("od_groups")
 
     # Prepare state
     random = np.random.RandomState(random_seed)
-    df_od = df_od[df_od["origin_id"] == origin_id].copy()
+    df_od = select_group(df_od, od_groups, origin_id).copy()
 
     # Sample destinations
     df_od["count"] = random.multinomial(count, df_od["weight"].values)
@@ -40,14 +41,15 @@ def sample_destination_municipalities(context, arguments):
 def sample_locations(context, arguments):
     # Load data
     destination_id, random_seed = arguments
-    df_locations, df_flow = context.data("df_locations"), context.data("df_flow")
+    df_locations, location_groups = context.data("df_locations"), context.data("location_groups")
+    df_flow, flow_groups = context.data("df_flow"), context.data("flow_groups")
 
     # Prepare state
     random = np.random.RandomState(random_seed)
-    df_locations = df_locations[df_locations["commune_id"] == destination_id]
+    df_locations = select_group(df_locations, location_groups, destination_id)
     
     # Determine demand
-    df_flow = df_flow[df_flow["destination_id"] == destination_id]
+    df_flow = select_group(df_flow, flow_groups, destination_id)
     count = df_flow["count"].sum()
 
     # Sample destinations
@@ -85,9 +87,10 @@ def process(context, purpose, random, df_persons, df_od, df_locations,step_name)
     df_demand = df_demand[df_demand["count"] > 0]
 
     df_flow = []
+    df_od, od_groups = index_groups(df_od, "origin_id")
 
     with context.progress(label = "Sampling %s municipalities" % step_name, total = len(df_demand)) as progress:
-        with context.parallel(dict(df_od = df_od)) as parallel:
+        with context.parallel(dict(df_od = df_od, od_groups = od_groups)) as parallel:
             for df_partial in parallel.imap_unordered(sample_destination_municipalities, df_demand.itertuples(index = False, name = None)):
                 df_flow.append(df_partial)
 
@@ -99,8 +102,14 @@ def process(context, purpose, random, df_persons, df_od, df_locations,step_name)
 
     df_result = []
 
+    df_locations, location_groups = index_groups(df_locations, "commune_id")
+    df_flow, flow_groups = index_groups(df_flow, "destination_id")
+
     with context.progress(label = "Sampling %s destinations" % purpose, total = len(df_demand)) as progress:
-        with context.parallel(dict(df_locations = df_locations, df_flow = df_flow)) as parallel:
+        with context.parallel(dict(
+            df_locations = df_locations, location_groups = location_groups,
+            df_flow = df_flow, flow_groups = flow_groups
+        )) as parallel:
             for df_partial in parallel.imap_unordered(sample_locations, zip(unique_ids, random_seeds)):
                 df_result.append(df_partial)
 
@@ -1,7 +1,9 @@
 import numpy as np
 import pandas as pd
 import geopandas as gpd
+from scipy.optimize import linear_sum_assignment
 from .candidates import EDUCATION_MAPPING
+from synthesis.population.utils import index_groups, select_group
 
 def configure(context):
     context.stage("synthesis.population.spatial.primary.candidates")
@@ -12,6 +14,12 @@ def configure(context):
 
     context.config("education_location_source", "bpe")
 
+    # Use "sorted" to match persons and candidates by their sorted distances
+    context.config("primary_location_ordering", "distance")
+
+    # Set to compare the commute distance error with the greedy distance ordering
+    context.config("primary_location_ordering_check", False)
+
 
 def define_distance_ordering(df_persons, df_candidates, progress):
     indices = []
@@ -44,38 +52,129 @@ def define_random_ordering(df_persons, df_candidates, progress):
     progress.update(len(df_candidates))
     return np.arange(len(df_candidates))
 
-define_ordering = define_distance_ordering
+def define_sorted_ordering(df_persons, df_candidates, progress, window_size = 64):
+    # Persons and candidates are first matched by rank: the person with the
+    # shortest commute distance obtains the candidate that is closest to the
+    # center of the homes, and so on. The matching is then improved by solving
+    # the exact assignment problem within overlapping windows of ranks.
+    home_locations = gpd.GeoSeries(df_persons["home_location"].values)
+    home_coordinates = np.vstack([home_locations.x.values, home_locations.y.values]).T
+
+    commute_coordinates = np.vstack([
+        df_candidates["geometry"].x.values,
+        df_candidates["geometry"].y.values
+    ]).T
+
+    commute_distances = df_persons["commute_distance"].values
+
+    center = np.mean(home_coordinates, axis = 0)
+    distances = np.sqrt(np.sum((commute_coordinates - center)**2, axis = 1))
+
+    person_order = np.argsort(commute_distances, kind = "stable")
+    candidate_order = np.argsort(distances, kind = "stable")
+
+    for offset in (0, window_size // 2):
+        for start in range(offset, len(person_order), window_size):
+            persons = person_order[start:start + window_size]
+            candidates = candidate_order[start:start + window_size]
+
+            costs = home_coordinates[persons][:, np.newaxis, :] - commute_coordinates[candidates][np.newaxis, :, :]
+            costs = np.abs(np.sqrt(np.sum(costs**2, axis = 2)) - commute_distances[persons][:, np.newaxis])
+
+            candidate_order[start:start + window_size] = candidates[linear_sum_assignment(costs)[1]]
+
+    indices = np.zeros((len(df_candidates),), dtype = int)
+    indices[person_order] = candidate_order
+
+    progress.update(len(df_candidates))
+    return indices
+
+def define_ordering(df_persons, df_candidates, progress, method = "distance"):
+    if method == "distance":
+        return define_distance_ordering(df_persons, df_candidates, progress)
+
+    elif method == "sorted":
+        return define_sorted_ordering(df_persons, df_candidates, progress)
+
+    elif method == "random":
+        return define_random_ordering(df_persons, df_candidates, progress)
+
+    raise RuntimeError("Unknown primary location ordering: %s" % method)
+
+def calculate_ordering_error(df_persons, df_candidates, indices):
+    # Absolute difference between the commute distance of each person and the
+    # distance from home to the assigned candidate
+    home_locations = gpd.GeoSeries(df_persons["home_location"].values)
+    home_coordinates = np.vstack([home_locations.x.values, home_locations.y.values]).T
+
+    commute_coordinates = np.vstack([
+        df_candidates["geometry"].x.values[indices],
+        df_candidates["geometry"].y.values[indices]
+    ]).T
+
+    distances = np.sqrt(np.sum((commute_coordinates - home_coordinates)**2, axis = 1))
+    return np.abs(distances - df_persons["commute_distance"].values)
+
+class NoProgress:
+    def update(self, amount = 1):
+        pass
 
 def process_municipality(context, origin_id):
     # Load data
-    df_candidates, df_persons = context.data("df_candidates"), context.data("df_persons")
+    df_candidates, candidate_groups = context.data("df_candidates"), context.data("candidate_groups")
+    df_persons, person_groups = context.data("df_persons"), context.data("person_groups")
 
     # Find relevant records
-    df_persons = df_persons[df_persons["commune_id"] == origin_id][[
+    df_persons = select_group(df_persons, person_groups, origin_id)[[
         "person_id", "home_location", "commute_distance"
     ]].copy()
-    df_candidates = df_candidates[df_candidates["origin_id"] == origin_id]
+    df_candidates = select_group(df_candidates, candidate_groups, origin_id)
 
     # From previous step, this should be equal!
     assert len(df_persons) == len(df_candidates)
 
-    indices = define_ordering(df_persons, df_candidates, context.progress)
+    method = context.config("primary_location_ordering")
+    indices = define_ordering(df_persons, df_candidates, context.progress, method)
+
+    errors = calculate_ordering_error(df_persons, df_candidates, indices)
+
+    if context.config("primary_location_ordering_check"):
+        baseline_indices = define_distance_ordering(df_persons, df_candidates, NoProgress())
+        baseline_errors = calculate_ordering_error(df_persons, df_candidates, baseline_indices)
+    else:
+        baseline_errors = np.zeros((0,))
+
     df_candidates = df_candidates.iloc[indices]
 
     df_candidates["person_id"] = df_persons["person_id"].values
     df_candidates = df_candidates.rename(columns = dict(destination_id = "commune_id"))
 
-    return df_candidates[["person_id", "commune_id", "location_id", "geometry"]]
+    return df_candidates[["person_id", "commune_id", "location_id", "geometry"]], errors, baseline_errors
 
 def process(context, purpose, df_persons, df_candidates):
     unique_ids = df_candidates["origin_id"].unique()
 
-    df_result = []
+    df_result, errors, baseline_errors = [], [], []
+
+    df_persons, person_groups = index_groups(df_persons, "commune_id")
+    df_candidates, candidate_groups = index_groups(df_candidates, "origin_id")
 
     with context.progress(label = "Distributing %s destinations" % purpose, total = len(df_persons)) as progress:
-        with context.parallel(dict(df_persons = df_persons, df_candidates = df_candidates)) as parallel:
-            for df_partial in parallel.imap_unordered(process_municipality, unique_ids):
+        with context.parallel(dict(
+            df_persons = df_persons, person_groups = person_groups,
+            df_candidates = df_candidates, candidate_groups = candidate_groups
+        )) as parallel:
+            for df_partial, partial_errors, partial_baseline_errors in parallel.imap_unordered(process_municipality, unique_ids):
                 df_result.append(df_partial)
+                errors.append(partial_errors)
+                baseline_errors.append(partial_baseline_errors)
+
+    errors = np.concatenate(errors)
+    print("Mean commute distance error for %s (%s):" % (purpose, context.config("primary_location_ordering")), np.mean(errors))
+
+    if context.config("primary_location_ordering_check"):
+        baseline_errors = np.concatenate(baseline_errors)
+        print("Mean commute distance error for %s (distance):" % purpose, np.mean(baseline_errors))
 
     return pd.concat(df_result).sort_index()
 
@@ -2,27 +2,48 @@ import synthesis.population.spatial.secondary.rda as rda
 import sklearn.neighbors
 import numpy as np
 
+from data.sampling import sample_grouped
+
 class CustomDistanceSampler(rda.FeasibleDistanceSampler):
-    def __init__(self, random, distributions, maximum_iterations = 1000):
+    def __init__(self, random, table, maximum_iterations = 1000):
         rda.FeasibleDistanceSampler.__init__(self, random = random, maximum_iterations = maximum_iterations)
 
         self.random = random
-        self.distributions = distributions
+        self.table = table # see distance_distributions.compile_distributions
+
+    def find_bands(self, modes, travel_times):
+        modes, travel_times = np.asarray(modes), np.asarray(travel_times)
+        bands = np.zeros(modes.shape, dtype = int)
+
+        for mode in np.unique(modes):
+            f_mode = modes == mode
+            mode_table = self.table["modes"][mode]
+
+            # Same as count_nonzero(travel_time > bounds)
+            bands[f_mode] = mode_table["first_band"] + np.searchsorted(mode_table["bounds"], travel_times[f_mode], side = "left")
+
+        return bands
+
+    def lookup(self, bands, uniform):
+        offsets, cdf, values = self.table["offsets"], self.table["cdf"], self.table["values"]
+        indices = sample_grouped(cdf, offsets, np.ravel(bands), np.ravel(uniform))
+
+        return values[indices].reshape(np.shape(bands))
 
     def sample_distances(self, problem):
-        distances = np.zeros((len(problem["modes"])))
+        return self.sample_distances_block(problem, 1)[0]
 
-        for index, (mode, travel_time) in enumerate(zip(problem["modes"], problem["travel_times"])):
-            mode_distribution = self.distributions[mode]
+    def sample_distances_block(self, problem, count):
+        bands = self.find_bands(problem["modes"], problem["travel_times"])
+        uniform = self.random.random_sample((count, len(bands)))
 
-            bound_index = np.count_nonzero(travel_time > mode_distribution["bounds"])
-            mode_distribution = mode_distribution["distributions"][bound_index]
+        return self.lookup(np.broadcast_to(bands, uniform.shape), uniform)
 
-            distances[index] = mode_distribution["values"][
-                np.count_nonzero(self.random.random_sample() > mode_distribution["cdf"])
-            ]
+    def sample_distances_batch(self, problems):
+        bands = self.find_bands(problems["modes"], problems["travel_times"])
+        uniform = self.random.random_sample(bands.shape)
 
-        return distances
+        return self.lookup(bands, uniform)
 
 class CandidateIndex:
     def __init__(self, data):
@@ -39,6 +60,28 @@ class CandidateIndex:
         location = self.data[purpose]["locations"][index]
         return identifier, location
 
+    def query_many(self, purposes, locations):
+        """
+            Discretizes a (N, 2) array of locations with the corresponding (N,)
+            array of purposes. The KD-tree is queried once per purpose.
+        """
+        identifiers = None
+        discretized_locations = np.zeros((len(locations), 2))
+
+        for purpose in np.unique(purposes):
+            f_purpose = purposes == purpose
+            data = self.data[purpose]
+
+            if identifiers is None:
+                identifiers = np.empty(len(purposes), dtype = data["identifiers"].dtype)
+
+            indices = self.indices[purpose].query(locations[f_purpose], return_distance = False)[:, 0]
+
+            identifiers[f_purpose] = data["identifiers"][indices]
+            discretized_locations[f_purpose] = data["locations"][indices]
+
+        return identifiers, discretized_locations
+
     def sample(self, purpose, random):
         index = random.randint(0, len(self.data[purpose]["locations"]))
         identifier = self.data[purpose]["identifiers"][index]
@@ -50,19 +93,23 @@ class CustomDiscretizationSolver(rda.DiscretizationSolver):
         self.index = index
 
     def solve(self, problem, locations):
-        discretized_locations = []
-        discretized_identifiers = []
+        discretized_identifiers, discretized_locations = self.index.query_many(
+            np.array(problem["purposes"]), locations)
 
-        for location, purpose in zip(locations, problem["purposes"]):
-            identifier, location = self.index.query(purpose, location.reshape(1, -1))
+        assert len(discretized_locations) == problem["size"]
 
-            discretized_identifiers.append(identifier)
-            discretized_locations.append(location)
+        return dict(
+            valid = True, locations = discretized_locations, identifiers = discretized_identifiers
+        )
 
-        assert len(discretized_locations) == problem["size"]
+    def solve_batch(self, problems, locations):
+        discretized_identifiers, discretized_locations = self.index.query_many(
+            problems["purposes"].reshape(-1), locations.reshape(-1, 2))
 
         return dict(
-            valid = True, locations = np.vstack(discretized_locations), identifiers = discretized_identifiers
+            valid = np.ones(len(locations), dtype = bool),
+            locations = discretized_locations.reshape(locations.shape),
+            identifiers = discretized_identifiers.reshape(locations.shape[:2])
         )
 
 class CustomFreeChainSolver(rda.RelaxationSolver):
@@ -77,3 +124,19 @@ class CustomFreeChainSolver(rda.RelaxationSolver):
 
         assert len(locations) == len(distances) + 1
         return dict(valid = True, locations = locations)
+
+    def solve_batch(self, problems, distances):
+        first_purposes = problems["purposes"][:, 0]
+        anchors = np.zeros((len(distances), 2))
+
+        for purpose in np.unique(first_purposes):
+            f_purpose = first_purposes == purpose
+            candidates = self.index.data[purpose]["locations"]
+
+            indices = self.random.randint(0, len(candidates), size = np.count_nonzero(f_purpose))
+            anchors[f_purpose] = candidates[indices]
+
+        locations = rda.sample_tail_batch(self.random, anchors, distances)
+        locations = np.concatenate([anchors[:, np.newaxis, :], locations], axis = 1)
+
+        return dict(valid = np.ones(len(distances), dtype = bool), locations = locations)
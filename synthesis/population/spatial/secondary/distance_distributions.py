@@ -78,3 +78,26 @@ def execute(context):
             distributions[mode]["distributions"].append(dict(cdf = cdf, values = values, weights = weights))
 
     return distributions
+
+def compile_distributions(distributions):
+    """
+        Compiles the distributions into a compact table. The CDF and distance
+        values of all (mode, travel time band) combinations are concatenated
+        into flat arrays, band b occupies the range offsets[b] to offsets[b + 1].
+        Per mode, the travel time bounds and the index of its first band are given.
+    """
+    modes = {}
+    cdf, values, offsets = [], [], [0]
+
+    for mode, mode_distributions in distributions.items():
+        modes[mode] = dict(bounds = np.array(mode_distributions["bounds"]), first_band = len(offsets) - 1)
+
+        for distribution in mode_distributions["distributions"]:
+            cdf.append(distribution["cdf"])
+            values.append(distribution["values"])
+            offsets.append(offsets[-1] + len(distribution["cdf"]))
+
+    return dict(
+        modes = modes, cdf = np.concatenate(cdf), values = np.concatenate(values),
+        offsets = np.array(offsets)
+    )
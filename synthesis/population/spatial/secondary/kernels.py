@@ -0,0 +1,140 @@
+import numpy as np
+import numba
+
+"""
+Compiled versions of the scalar routines of the RDA gravity chain solver, used
+with secloc_backend: numba.
+
+The kernels do not draw random numbers themselves. All random numbers are
+drawn by the host RandomState in the same order as with the NumPy backend and
+passed into the kernels, so the results are deterministic per seed and agree
+with the NumPy backend up to floating point rounding.
+"""
+
+TWO_POINTS_ZERO = 0
+TWO_POINTS_FAR = 1
+TWO_POINTS_NEAR = 2
+TWO_POINTS_REGULAR = 3
+
+@numba.jit(nopython = True)
+def calculate_feasibility(distances, direct_distance, consider_total_distance = True):
+    total_distance = 0.0
+
+    for k in range(len(distances)):
+        total_distance += distances[k]
+
+    delta = -np.inf
+
+    for k in range(len(distances)):
+        remaining_distance = total_distance - distances[k]
+        delta = max(delta, distances[k] - direct_distance - remaining_distance)
+
+    if consider_total_distance:
+        delta = max(delta, direct_distance - total_distance)
+
+    return max(delta, 0.0)
+
+@numba.jit(nopython = True)
+def find_two_points_case(distances, direct_distance):
+    if direct_distance == 0.0:
+        return TWO_POINTS_ZERO
+
+    elif direct_distance > distances[0] + distances[1]:
+        return TWO_POINTS_FAR
+
+    elif direct_distance < abs(distances[0] - distances[1]):
+        return TWO_POINTS_NEAR
+
+    return TWO_POINTS_REGULAR
+
+@numba.jit(nopython = True)
+def solve_two_points(origin, distances, direction, direct_distance, case, r):
+    """
+        Places the variable point between origin and destination. The random
+        number r is only used in the regular case and must have been drawn by
+        the caller in that case.
+    """
+    location = np.zeros(2)
+    valid = False
+
+    ratio = 1.0
+
+    if distances[0] > 0.0 or distances[1] > 0.0:
+        ratio = distances[0] / (distances[0] + distances[1])
+
+    if case == TWO_POINTS_ZERO:
+        location[:] = origin + direction * distances[0]
+        valid = distances[0] == distances[1]
+
+    elif case == TWO_POINTS_FAR:
+        location[:] = origin + direction * ratio * direct_distance
+
+    elif case == TWO_POINTS_NEAR:
+        location[:] = origin + direction * ratio * max(distances[0], distances[1])
+
+    else:
+        A = 0.5 * ( distances[0]**2 - distances[1]**2 + direct_distance**2 ) / direct_distance
+        H = np.sqrt(max(0.0, distances[0]**2 - A**2))
+
+        sign = 1.0 if r < 0.5 else -1.0
+
+        location[0] = origin[0] + direction[0] * A + sign * direction[1] * H
+        location[1] = origin[1] + direction[1] * A - sign * direction[0] * H
+        valid = True
+
+    return location, valid
+
+@numba.jit(nopython = True)
+def relax_chain(locations, distances, alpha, eps, maximum_iterations):
+    """
+        Runs the gravity simulation on the (k + 2, 2) locations (including
+        origin and destination) in place. Returns whether the simulation has
+        converged and the last iteration.
+    """
+    segments = len(distances)
+
+    directions = np.zeros((segments, 2))
+    offset = np.zeros(segments)
+
+    valid = False
+    k = 0
+
+    for k in range(maximum_iterations):
+        converged = True
+
+        for i in range(segments):
+            dx = locations[i, 0] - locations[i + 1, 0]
+            dy = locations[i, 1] - locations[i + 1, 1]
+            length = np.sqrt(dx * dx + dy * dy)
+
+            offset[i] = distances[i] - length
+
+            if length < 1.0:
+                length = 1.0
+
+            directions[i, 0] = dx / length
+            directions[i, 1] = dy / length
+
+            if not abs(offset[i]) < eps:
+                converged = False
+
+        if converged:
+            valid = True
+            break
+
+        # Apply adjustment to locations
+        for i in range(segments - 1):
+            origin_weight = 2.0 if i == 0 else 1.0
+            destination_weight = 2.0 if i == segments - 2 else 1.0
+
+            for d in range(2):
+                adjustment = 0.0
+                adjustment -= 0.5 * alpha * offset[i] * directions[i, d] * origin_weight
+                adjustment += 0.5 * alpha * offset[i + 1] * directions[i + 1, d] * destination_weight
+
+                locations[i + 1, d] += adjustment
+
+                if np.isnan(locations[i + 1, d]) or np.isinf(locations[i + 1, d]):
+                    raise RuntimeError("NaN/Inf value encountered during gravity simulation")
+
+    return valid, k
@@ -1,10 +1,10 @@
 import numpy as np
 import pandas as pd
 import multiprocessing as mp
-import shapely.geometry as geo
 import geopandas as gpd
 
-from synthesis.population.spatial.secondary.problems import find_assignment_problems
+from synthesis.population.spatial.secondary.problems import build_assignment_problems, iterate_assignment_problems, batch_assignment_problems
+from synthesis.population.spatial.secondary.distance_distributions import compile_distributions
 
 def configure(context):
     context.stage("synthesis.population.trips")
@@ -21,6 +21,16 @@ def configure(context):
 
     context.config("secloc_maximum_iterations", np.inf)
 
+    # Use "batch" to solve problems of the same shape together in vectorized form
+    context.config("secloc_solver", "scalar")
+    context.config("secloc_batch_size", 10000)
+
+    # Use "numba" to run the scalar solver routines as compiled kernels
+    context.config("secloc_backend", "numpy")
+
+    # Set to split persons into many small chunks that are dispatched dynamically
+    context.config("secloc_chunk_size", None)
+
 def prepare_locations(context):
     # Load persons and their primary locations
     df_home = context.stage("synthesis.population.spatial.home.locations")
@@ -42,7 +52,8 @@ def prepare_destinations(context):
     df_locations = context.stage("synthesis.locations.secondary")
 
     identifiers = df_locations["location_id"].values
-    locations = np.vstack(df_locations["geometry"].apply(lambda x: np.array([x.x, x.y])).values)
+    geometry = gpd.GeoSeries(df_locations["geometry"].values)
+    locations = np.vstack([geometry.x.values, geometry.y.values]).T
 
     data = {}
 
@@ -70,6 +81,18 @@ def resample_distributions(distributions, factors):
         for distribution in mode_distributions["distributions"]:
             distribution["cdf"] = resample_cdf(distribution["cdf"], factors[mode])
 
+def select_persons(df, person_ids):
+    # Selects the range from the first to the last given person in a data frame sorted by person
+    values = df["person_id"].values
+
+    if len(person_ids) == 0:
+        return df.iloc[:0]
+
+    start = np.searchsorted(values, person_ids[0], side = "left")
+    end = np.searchsorted(values, person_ids[-1], side = "right")
+
+    return df.iloc[start:end]
+
 from synthesis.population.spatial.secondary.rda import AssignmentSolver, DiscretizationErrorObjective, GravityChainSolver, AngularTailSolver, GeneralRelaxationSolver
 from synthesis.population.spatial.secondary.components import CustomDistanceSampler, CustomDiscretizationSolver, CandidateIndex, CustomFreeChainSolver
 
@@ -83,36 +106,55 @@ def execute(context):
     distance_distributions = context.stage("synthesis.population.spatial.secondary.distance_distributions")
     destinations = prepare_destinations(context)
 
+    # The spatial index is constructed once and shared read-only with the workers
+    candidate_index = CandidateIndex(destinations)
+
     # Resampling for calibration
     resample_distributions(distance_distributions, dict(
         car = 0.0, car_passenger = 0.1, pt = 0.5, bike = 0.0, walk = -0.5
     ))
 
+    distance_table = compile_distributions(distance_distributions)
+
     # Segment into subsamples
     processes = context.config("processes")
+    chunk_size = context.config("secloc_chunk_size")
 
     unique_person_ids = df_trips["person_id"].unique()
     number_of_persons = len(unique_person_ids)
-    unique_person_ids = np.array_split(unique_person_ids, processes)
 
     random = np.random.RandomState(context.config("random_seed"))
-    random_seeds = random.randint(10000, size = processes)
+
+    if chunk_size is None:
+        # One subsample per process
+        unique_person_ids = np.array_split(unique_person_ids, processes)
+        random_seeds = random.randint(10000, size = processes)
+
+    else:
+        # Many small subsamples that are dispatched dynamically to the workers. The
+        # chunks and their seeds do not depend on the number of processes.
+        unique_person_ids = [
+            unique_person_ids[index:index + chunk_size]
+            for index in range(0, number_of_persons, chunk_size)
+        ]
+
+        random_seeds = random.randint(np.iinfo(np.int32).max, size = len(unique_person_ids))
 
     # Create batch problems for parallelization
     batches = []
 
-    for index in range(processes):
+    for index in range(len(unique_person_ids)):
         batches.append((
-            df_trips[df_trips["person_id"].isin(unique_person_ids[index])],
-            df_primary[df_primary["person_id"].isin(unique_person_ids[index])],
+            select_persons(df_trips, unique_person_ids[index]),
+            select_persons(df_primary, unique_person_ids[index]),
             random_seeds[index], crs
         ))
 
     # Run algorithm in parallel
     with context.progress(label = "Assigning secondary locations to persons", total = number_of_persons):
         with context.parallel(processes = processes, data = dict(
-            distance_distributions = distance_distributions,
-            destinations = destinations
+            distance_table = distance_table,
+            candidate_index = candidate_index
         )) as parallel:
             df_locations, df_convergence = [], []
 
@@ -133,23 +175,24 @@ def process(context, arguments):
   # Set up RNG
   random = np.random.RandomState(random_seed)
   maximum_iterations = context.config("secloc_maximum_iterations")
+  backend = context.config("secloc_backend")
 
   # Set up discretization solver
-  destinations = context.data("destinations")
-  candidate_index = CandidateIndex(destinations)
+  candidate_index = context.data("candidate_index")
   discretization_solver = CustomDiscretizationSolver(candidate_index)
 
   # Set up distance sampler
-  distance_distributions = context.data("distance_distributions")
+  distance_table = context.data("distance_table")
   distance_sampler = CustomDistanceSampler(
         maximum_iterations = min(1000, maximum_iterations),
         random = random,
-        distributions = distance_distributions)
+        table = distance_table)
 
   # Set up relaxation solver; currently, we do not consider tail problems.
   chain_solver = GravityChainSolver(
     random = random, eps = 10.0, lateral_deviation = 10.0, alpha = 0.1,
-    maximum_iterations = min(1000, maximum_iterations)
+    maximum_iterations = min(1000, maximum_iterations),
+    backend = backend
     )
 
   tail_solver = AngularTailSolver(random = random)
@@ -172,19 +215,27 @@ def process(context, arguments):
       maximum_iterations = min(20, maximum_iterations)
       )
 
+  problems = build_assignment_problems(df_trips, df_primary)
+
+  if context.config("secloc_solver") == "batch":
+      return process_batches(context, assignment_solver, problems, crs)
+
+  elif context.config("secloc_solver") != "scalar":
+      raise RuntimeError("Unknown secondary location solver: %s" % context.config("secloc_solver"))
+
   df_locations = []
   df_convergence = []
 
   last_person_id = None
 
-  for problem in find_assignment_problems(df_trips, df_primary):
+  for problem in iterate_assignment_problems(problems):
       result = assignment_solver.solve(problem)
 
       starting_activity_index = problem["activity_index"]
 
       for index, (identifier, location) in enumerate(zip(result["discretization"]["identifiers"], result["discretization"]["locations"])):
           df_locations.append((
-              problem["person_id"], starting_activity_index + index, identifier, geo.Point(location)
+              problem["person_id"], starting_activity_index + index, identifier, location[0], location[1]
           ))
 
       df_convergence.append((
@@ -195,9 +246,41 @@ def process(context, arguments):
           last_person_id = problem["person_id"]
           context.progress.update()
 
-  df_locations = pd.DataFrame.from_records(df_locations, columns = ["person_id", "activity_index", "location_id", "geometry"])
-  df_locations = gpd.GeoDataFrame(df_locations, crs = crs)
+  df_locations = pd.DataFrame.from_records(df_locations, columns = ["person_id", "activity_index", "location_id", "x", "y"])
+  df_locations = gpd.GeoDataFrame(df_locations[["person_id", "activity_index", "location_id"]],
+      geometry = gpd.points_from_xy(df_locations["x"], df_locations["y"]), crs = crs)
   assert not df_locations["geometry"].isna().any()
 
   df_convergence = pd.DataFrame.from_records(df_convergence, columns = ["valid", "size"])
   return df_locations, df_convergence
+
+def process_batches(context, assignment_solver, problems, crs):
+  df_locations = [pd.DataFrame(columns = ["person_id", "activity_index", "location_id", "x", "y"])]
+  df_convergence = [pd.DataFrame(columns = ["valid", "size"])]
+
+  for batches in batch_assignment_problems(problems, context.config("secloc_batch_size")):
+      for batch in batches:
+          result = assignment_solver.solve_batch(batch)
+          size = batch["size"]
+
+          df_locations.append(pd.DataFrame({
+              "person_id": np.repeat(batch["person_id"], size),
+              "activity_index": (batch["activity_index"][:, np.newaxis] + np.arange(size)).reshape(-1),
+              "location_id": result["identifiers"].reshape(-1),
+              "x": result["locations"][:, :, 0].reshape(-1),
+              "y": result["locations"][:, :, 1].reshape(-1)
+          }))
+
+          df_convergence.append(pd.DataFrame({
+              "valid": result["valid"], "size": size
+          }))
+
+      context.progress.update(len(np.unique(np.concatenate([batch["person_id"] for batch in batches]))))
+
+  df_locations = pd.concat(df_locations)
+  df_locations = gpd.GeoDataFrame(df_locations[["person_id", "activity_index", "location_id"]],
+      geometry = gpd.points_from_xy(df_locations["x"], df_locations["y"]), crs = crs)
+  assert not df_locations["geometry"].isna().any()
+
+  df_convergence = pd.concat(df_convergence)
+  return df_locations, df_convergence
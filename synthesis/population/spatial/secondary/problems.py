@@ -1,93 +1,209 @@
 import numpy as np
 import pandas as pd
+import geopandas as gpd
 
 FIELDS = ["person_id", "trip_index", "preceding_purpose", "following_purpose", "mode", "travel_time"]
 FIXED_PURPOSES = ["home", "work", "education"]
 
-def find_bare_assignment_problems(df):
-    problem = None
+LOCATION_FIELDS = ["person_id", "home", "work", "education"]
 
-    for row in df[FIELDS].itertuples(index = False):
-        person_id, trip_index, preceding_purpose, following_purpose, mode, travel_time = row
+def build_assignment_problems(df, df_locations):
+    """
+        Builds the assignment problems of all persons in columnar form. A problem
+        is a sequence of trips that starts with the first trip of a person or
+        after a fixed activity, and that ends with a fixed activity or with the
+        last trip of the person. Problems without variable activities are skipped.
+
+        Per problem p, the trips (modes, travel times) are found in the range
+        trip_offsets[p] to trip_offsets[p + 1] and the variable purposes in the
+        range purpose_offsets[p] to purpose_offsets[p + 1] of the flat arrays.
+        The locations of fixed activities are given as origin and destination,
+        with has_origin and has_destination indicating whether they exist.
+    """
+    df = df[FIELDS]
 
-        if not problem is None and person_id != problem["person_id"]:
-            # We switch person, but we're still tracking a problem. This is a tail!
-            yield problem
-            problem = None
+    person_ids = df["person_id"].values
+    trip_indices = df["trip_index"].values
+    preceding_purposes = df["preceding_purpose"].astype(str).values
+    following_purposes = df["following_purpose"].astype(str).values
+    modes = df["mode"].astype(str).values
+    travel_times = df["travel_time"].values.astype(float)
 
-        if problem is None:
-            # Start a new problem
-            problem = dict(
-                person_id = person_id, trip_index = trip_index, purposes = [preceding_purpose],
-                modes = [], travel_times = []
-            )
+    preceding_fixed = np.isin(preceding_purposes, FIXED_PURPOSES)
+    following_fixed = np.isin(following_purposes, FIXED_PURPOSES)
 
-        problem["purposes"].append(following_purpose)
-        problem["modes"].append(mode)
-        problem["travel_times"].append(travel_time)
+    # Segment trips into problems
+    is_first = np.ones(len(df), dtype = bool)
+    is_first[1:] = person_ids[1:] != person_ids[:-1]
 
-        if problem["purposes"][-1] in FIXED_PURPOSES:
-            # The current chain (or initial tail) ends with a fixed activity.
-            yield problem
-            problem = None
+    is_last = np.ones(len(df), dtype = bool)
+    is_last[:-1] = is_first[1:]
 
-    if not problem is None:
-        yield problem
+    is_end = following_fixed | is_last
 
-LOCATION_FIELDS = ["person_id", "home", "work", "education"]
+    is_start = np.ones(len(df), dtype = bool)
+    is_start[1:] = is_end[:-1]
+
+    trip_problems = np.cumsum(is_start) - 1
+    starts = np.flatnonzero(is_start)
+    ends = np.flatnonzero(is_end)
+
+    # Find variable purposes: the preceding purpose of the first trip (if not fixed)
+    # and the following purposes (the one of the last trip may be fixed)
+    emit_preceding = is_start & ~preceding_fixed
+    emit_following = ~following_fixed
+
+    purposes = np.vstack([preceding_purposes, following_purposes]).T.reshape(-1)
+    purposes = purposes[np.vstack([emit_preceding, emit_following]).T.reshape(-1)]
+
+    sizes = np.bincount(trip_problems, weights = emit_preceding.astype(int) + emit_following.astype(int), minlength = len(starts)).astype(int)
+
+    purpose_offsets = np.zeros(len(starts) + 1, dtype = int)
+    purpose_offsets[1:] = np.cumsum(sizes)
+
+    trip_offsets = np.zeros(len(starts) + 1, dtype = int)
+    trip_offsets[1:] = ends + 1
+
+    # Find locations of fixed activities
+    df_locations = df_locations[LOCATION_FIELDS]
+    location_person_ids = df_locations["person_id"].values
+
+    problem_person_ids = person_ids[starts]
+    location_indices = np.searchsorted(location_person_ids, problem_person_ids)
+
+    if np.any(location_indices >= len(location_person_ids)) or np.any(location_person_ids[location_indices] != problem_person_ids):
+        raise RuntimeError("Fixed locations are missing for some persons")
 
-def find_assignment_problems(df, df_locations):
+    has_origin = preceding_fixed[starts]
+    has_destination = following_fixed[ends]
+
+    origins = np.full((len(starts), 2), np.nan)
+    destinations = np.full((len(starts), 2), np.nan)
+
+    for purpose in FIXED_PURPOSES:
+        geometry = gpd.GeoSeries(df_locations[purpose].values)
+        coordinates = np.vstack([geometry.x.values, geometry.y.values]).T
+
+        f = has_origin & (preceding_purposes[starts] == purpose)
+        origins[f] = coordinates[location_indices[f]]
+
+        f = has_destination & (following_purposes[ends] == purpose)
+        destinations[f] = coordinates[location_indices[f]]
+
+    problems = dict(
+        person_id = problem_person_ids,
+        trip_index = trip_indices[starts],
+        activity_index = trip_indices[starts] + has_origin,
+        size = sizes,
+        has_origin = has_origin, origin = origins,
+        has_destination = has_destination, destination = destinations,
+        trip_offsets = trip_offsets, purpose_offsets = purpose_offsets,
+        modes = modes, travel_times = travel_times, purposes = purposes
+    )
+
+    # Skip problems without variable activities
+    return select_assignment_problems(problems, np.flatnonzero(sizes > 0))
+
+def gather_ranges(offsets, indices):
     """
-        Enriches assignment problems with:
-          - Locations of the fixed activities
-          - Size of the problem
-          - Reduces purposes to the variable ones
+        Returns the indices into a flat array for the ranges offsets[i] to
+        offsets[i + 1] of the given indices, and the offsets of the ranges in
+        the gathered array.
     """
-    location_iterator = df_locations[LOCATION_FIELDS].itertuples(index = False)
-    current_location = None
+    counts = np.diff(offsets)[indices]
 
-    for problem in find_bare_assignment_problems(df):
-        origin_purpose = problem["purposes"][0]
-        destination_purpose = problem["purposes"][-1]
+    gathered_offsets = np.zeros(len(indices) + 1, dtype = int)
+    gathered_offsets[1:] = np.cumsum(counts)
 
-        # Reduce purposes
-        if origin_purpose in FIXED_PURPOSES and destination_purpose in FIXED_PURPOSES:
-            problem["purposes"] = problem["purposes"][1:-1]
+    selection = np.repeat(offsets[:-1][indices] - gathered_offsets[:-1], counts) + np.arange(gathered_offsets[-1])
+    return selection, gathered_offsets
 
-        elif origin_purpose in FIXED_PURPOSES:
-            problem["purposes"] = problem["purposes"][1:]
+def select_assignment_problems(problems, indices):
+    """
+        Reduces the columnar problems to the given problem indices, the flat
+        arrays are rearranged accordingly.
+    """
+    trip_selection, trip_offsets = gather_ranges(problems["trip_offsets"], indices)
+    purpose_selection, purpose_offsets = gather_ranges(problems["purpose_offsets"], indices)
+
+    return dict(
+        person_id = problems["person_id"][indices],
+        trip_index = problems["trip_index"][indices],
+        activity_index = problems["activity_index"][indices],
+        size = problems["size"][indices],
+        has_origin = problems["has_origin"][indices], origin = problems["origin"][indices],
+        has_destination = problems["has_destination"][indices], destination = problems["destination"][indices],
+        trip_offsets = trip_offsets, purpose_offsets = purpose_offsets,
+        modes = problems["modes"][trip_selection],
+        travel_times = problems["travel_times"][trip_selection],
+        purposes = problems["purposes"][purpose_selection]
+    )
+
+def iterate_assignment_problems(problems):
+    """
+        Yields the columnar problems one by one as used by the scalar solver.
+    """
+    trip_offsets, purpose_offsets = problems["trip_offsets"], problems["purpose_offsets"]
+
+    for index in range(len(problems["person_id"])):
+        yield dict(
+            person_id = problems["person_id"][index],
+            trip_index = problems["trip_index"][index],
+            activity_index = problems["activity_index"][index],
+            size = problems["size"][index],
+            purposes = problems["purposes"][purpose_offsets[index]:purpose_offsets[index + 1]],
+            modes = problems["modes"][trip_offsets[index]:trip_offsets[index + 1]],
+            travel_times = problems["travel_times"][trip_offsets[index]:trip_offsets[index + 1]],
+            origin = problems["origin"][index:index + 1] if problems["has_origin"][index] else None,
+            destination = problems["destination"][index:index + 1] if problems["has_destination"][index] else None
+        )
+
+def batch_assignment_problems(problems, batch_size):
+    """
+        Splits the columnar problems in windows of (at least) batch_size problems
+        that do not split persons. Per window, the problems are grouped by their
+        size and type of chain (free, tail, or chain) and yielded as a list of
+        stacked batch problems with arrays along the first axis.
+    """
+    person_ids = problems["person_id"]
+    problem_count = len(person_ids)
 
-        elif destination_purpose in FIXED_PURPOSES:
-            problem["purposes"] = problem["purposes"][:-1]
+    # Windows end at the first change of person after batch_size problems
+    changes = np.flatnonzero(person_ids[1:] != person_ids[:-1]) + 1
+    start = 0
 
-        else:
-            pass # Neither chain nor tail
+    while start < problem_count:
+        index = np.searchsorted(changes, start + batch_size)
+        end = changes[index] if index < len(changes) else problem_count
 
-        # Define size
-        problem["size"] = len(problem["purposes"])
+        yield _group_window(problems, start, end)
+        start = end
 
-        if problem["size"] == 0:
-            continue # We can skip if there are no variable activities
+def _group_window(problems, start, end):
+    sizes = problems["size"][start:end]
+    no_origin = ~problems["has_origin"][start:end]
+    no_destination = ~problems["has_destination"][start:end]
 
-        # Advance location iterator until we arrive at the current problem's person
-        while current_location is None or current_location[0] != problem["person_id"]:
-            current_location = next(location_iterator)
+    batches = []
 
-        # Define origin and destination locations if they have fixed purposes
-        problem["origin"] = None
-        problem["destination"] = None
+    keys = np.unique(np.vstack([sizes, no_origin, no_destination]).T, axis = 0)
 
-        if origin_purpose in FIXED_PURPOSES:
-            problem["origin"] = current_location[LOCATION_FIELDS.index(origin_purpose)] # Shapely POINT
-            problem["origin"] = np.array([[problem["origin"].x, problem["origin"].y]])
+    for size, key_no_origin, key_no_destination in keys:
+        indices = start + np.flatnonzero((sizes == size) & (no_origin == key_no_origin) & (no_destination == key_no_destination))
 
-        if destination_purpose in FIXED_PURPOSES:
-            problem["destination"] = current_location[LOCATION_FIELDS.index(destination_purpose)] # Shapely POINT
-            problem["destination"] = np.array([[problem["destination"].x, problem["destination"].y]])
+        trip_count = problems["trip_offsets"][indices[0] + 1] - problems["trip_offsets"][indices[0]]
+        trip_selection = problems["trip_offsets"][indices][:, np.newaxis] + np.arange(trip_count)
+        purpose_selection = problems["purpose_offsets"][indices][:, np.newaxis] + np.arange(size)
 
-        if problem["origin"] is None:
-            problem["activity_index"] = problem["trip_index"]
-        else:
-            problem["activity_index"] = problem["trip_index"] + 1
+        batches.append(dict(
+            person_id = problems["person_id"][indices],
+            activity_index = problems["activity_index"][indices],
+            size = size,
+            purposes = problems["purposes"][purpose_selection],
+            modes = problems["modes"][trip_selection],
+            travel_times = problems["travel_times"][trip_selection],
+            origin = None if key_no_origin else problems["origin"][indices],
+            destination = None if key_no_destination else problems["destination"][indices]
+        ))
 
-        yield problem
+    return batches
@@ -1,6 +1,14 @@
 import numpy as np
 import numpy.linalg as la
 
+import synthesis.population.spatial.secondary.kernels as kernels
+
+BACKENDS = ("numpy", "numba")
+
+def check_backend(backend):
+    if not backend in BACKENDS:
+        raise RuntimeError("Unknown backend for secondary location assignment: %s" % backend)
+
 def check_feasibility(distances, direct_distance, consider_total_distance = True):
     return calculate_feasibility(distances, direct_distance, consider_total_distance) == 0.0
 
@@ -16,22 +24,59 @@ def calculate_feasibility(distances, direct_distance, consider_total_distance =
 
     return float(max(delta, 0))
 
+def calculate_feasibility_batch(distances, direct_distance, consider_total_distance = True):
+    """
+        Row-wise version of calculate_feasibility for a (N, k) array of distance
+        chains and a (N,) array of direct distances.
+    """
+    total_distance = np.sum(distances, axis = 1)
+
+    remaining_distance = total_distance[:, np.newaxis] - distances
+    delta = np.max(distances - direct_distance[:, np.newaxis] - remaining_distance, axis = 1)
+
+    if consider_total_distance:
+        delta = np.maximum(delta, direct_distance - total_distance)
+
+    return np.maximum(delta, 0.0)
+
+def select_batch(problems, selection):
+    """
+        Reduces a batch of stacked problems (see problems.batch_assignment_problems)
+        to the given selection (mask or indices) of problems.
+    """
+    return {
+        key: value[selection] if isinstance(value, np.ndarray) else value
+        for key, value in problems.items()
+    }
+
 class DiscretizationSolver:
     def solve(self, problem, locations):
         raise NotImplementedError()
 
+    def solve_batch(self, problems, locations):
+        raise NotImplementedError()
+
 class RelaxationSolver:
     def solve(self, problem, distances):
         raise NotImplementedError()
 
+    def solve_batch(self, problems, distances):
+        raise NotImplementedError()
+
 class DistanceSampler:
     def sample(self, problem):
         raise NotImplementedError()
 
+    def sample_batch(self, problems):
+        raise NotImplementedError()
+
 class AssignmentObjective:
     def evaluate(self, problem, distance_result, relaxation_result, discretization_result):
         raise NotImplementedError()
 
+    def evaluate_batch(self, problems, distance_result, relaxation_result, discretization_result):
+        raise NotImplementedError()
+
 class AssignmentSolver:
     def __init__(self, distance_sampler, relaxation_solver, discretization_solver, objective, maximum_iterations = 1000):
         self.maximum_iterations = maximum_iterations
@@ -65,6 +110,59 @@ class AssignmentSolver:
 
         return best_result
 
+    def solve_batch(self, problems):
+        """
+            Solves a batch of stacked problems that share the same size and the
+            same type of chain (see problems.batch_assignment_problems). The
+            iterations follow the scalar solve method, but all problems that
+            are still pending are sampled, relaxed and discretized at once. The
+            random numbers are drawn per step for the whole batch, so the result
+            for a specific problem is not the same as with solve for the same
+            seed, but it follows the same distribution.
+        """
+        problem_count = len(problems["person_id"])
+        size = problems["size"]
+
+        best_objective = np.full(problem_count, np.inf)
+        best_valid = np.zeros(problem_count, dtype = bool)
+        best_iterations = np.zeros(problem_count, dtype = int)
+        best_locations = np.zeros((problem_count, size, 2))
+        best_identifiers = None
+
+        pending = np.arange(problem_count)
+
+        for assignment_iteration in range(self.maximum_iterations):
+            if len(pending) == 0:
+                break
+
+            current = select_batch(problems, pending)
+
+            distance_result = self.distance_sampler.sample_batch(current)
+
+            relaxation_result = self.relaxation_solver.solve_batch(current, distance_result["distances"])
+            discretization_result = self.discretization_solver.solve_batch(current, relaxation_result["locations"])
+
+            assignment_result = self.objective.evaluate_batch(current, distance_result, relaxation_result, discretization_result)
+
+            if best_identifiers is None:
+                best_identifiers = np.empty((problem_count, size), dtype = discretization_result["identifiers"].dtype)
+
+            improved = assignment_result["objective"] < best_objective[pending]
+            improved_indices = pending[improved]
+
+            best_objective[improved_indices] = assignment_result["objective"][improved]
+            best_valid[improved_indices] = assignment_result["valid"][improved]
+            best_iterations[improved_indices] = assignment_iteration
+            best_locations[improved_indices] = discretization_result["locations"][improved]
+            best_identifiers[improved_indices] = discretization_result["identifiers"][improved]
+
+            pending = pending[~best_valid[pending]]
+
+        return dict(
+            valid = best_valid, objective = best_objective, iterations = best_iterations,
+            locations = best_locations, identifiers = best_identifiers
+        )
+
 class GeneralRelaxationSolver(RelaxationSolver):
     def __init__(self, chain_solver, tail_solver = None, free_solver = None):
         self.chain_solver = chain_solver
@@ -81,6 +179,16 @@ class GeneralRelaxationSolver(RelaxationSolver):
         else:
             return self.chain_solver.solve(problem, distances)
 
+    def solve_batch(self, problems, distances):
+        if problems["origin"] is None and problems["destination"] is None:
+            return self.free_solver.solve_batch(problems, distances)
+
+        elif problems["origin"] is None or problems["destination"] is None:
+            return self.tail_solver.solve_batch(problems, distances)
+
+        else:
+            return self.chain_solver.solve_batch(problems, distances)
+
 def sample_tail(random, anchor, distances):
     angles = random.random_sample(len(distances)) * 2.0 * np.pi
     offsets = np.vstack([np.cos(angles), np.sin(angles)]).T * distances[:, np.newaxis]
@@ -92,6 +200,23 @@ def sample_tail(random, anchor, distances):
 
     return np.vstack(locations[1:])
 
+def sample_tail_batch(random, anchors, distances):
+    """
+        Batch version of sample_tail for (N, 2) anchors and (N, k) distances,
+        returns (N, k, 2) locations.
+    """
+    angles = random.random_sample(distances.shape) * 2.0 * np.pi
+    offsets = np.stack([np.cos(angles), np.sin(angles)], axis = 2) * distances[:, :, np.newaxis]
+
+    locations = np.zeros(distances.shape + (2,))
+    current = anchors
+
+    for k in range(distances.shape[1]):
+        current = current + offsets[:, k]
+        locations[:, k] = current
+
+    return locations
+
 class AngularTailSolver(RelaxationSolver):
     def __init__(self, random):
         self.random = random
@@ -116,14 +241,29 @@ class AngularTailSolver(RelaxationSolver):
         assert len(locations) == len(distances)
         return dict(valid = True, locations = locations)
 
+    def solve_batch(self, problems, distances):
+        if problems["origin"] is None:
+            locations = sample_tail_batch(self.random, problems["destination"], distances)
+
+        elif problems["destination"] is None:
+            locations = sample_tail_batch(self.random, problems["origin"], distances)[:, ::-1, :]
+
+        else:
+            raise RuntimeError("Invalid chain for AngularTailSolver")
+
+        return dict(valid = np.ones(len(distances), dtype = bool), locations = locations)
+
 class GravityChainSolver:
-    def __init__(self, random, alpha = 0.3, eps = 1.0, maximum_iterations = 1000, lateral_deviation = None):
+    def __init__(self, random, alpha = 0.3, eps = 1.0, maximum_iterations = 1000, lateral_deviation = None, backend = "numpy"):
         self.alpha = 0.3
         self.eps = 1e-2
         self.maximum_iterations = maximum_iterations
         self.random = random
         self.lateral_deviation = lateral_deviation
 
+        check_backend(backend)
+        self.backend = backend
+
     def solve_two_points(self, problem, origin, destination, distances, direction, direct_distance):
         if direct_distance == 0.0:
             location = origin + direction * distances[0]
@@ -173,6 +313,17 @@ class GravityChainSolver:
                 valid = True, locations = location.reshape(-1, 2), iterations = None
             )
 
+    def solve_two_points_compiled(self, origin, distances, direction, direct_distance):
+        case = kernels.find_two_points_case(distances, direct_distance)
+
+        # The random number is only drawn in the regular case, as in solve_two_points
+        r = self.random.random_sample() if case == kernels.TWO_POINTS_REGULAR else 0.0
+        location, valid = kernels.solve_two_points(origin[0], distances, direction[0], direct_distance, case, r)
+
+        return dict(
+            valid = valid, locations = location.reshape(-1, 2), iterations = None
+        )
+
     def solve(self, problem, distances):
         origin, destination = problem["origin"], problem["destination"]
 
@@ -196,7 +347,10 @@ class GravityChainSolver:
 
         # If we have only one variable point, take a short cut
         if problem["size"] == 1:
-             return self.solve_two_points(problem, origin, destination, distances, direction, direct_distance)
+            if self.backend == "numba":
+                return self.solve_two_points_compiled(origin, distances, direction, direct_distance)
+
+            return self.solve_two_points(problem, origin, destination, distances, direction, direct_distance)
 
         # Prepare initial locations
         if np.sum(distances) < 1e-12:
@@ -207,7 +361,12 @@ class GravityChainSolver:
         locations = origin + direction * shares[:, np.newaxis] * direct_distance
         locations = np.vstack([origin, locations, destination])
 
-        if not check_feasibility(distances, direct_distance):
+        if self.backend == "numba":
+            feasible = kernels.calculate_feasibility(distances, direct_distance) == 0.0
+        else:
+            feasible = check_feasibility(distances, direct_distance)
+
+        if not feasible:
             return dict( # We still return some locations although they may not be perfect
                 valid = False, locations = locations[1:-1], iterations = None
             )
@@ -216,6 +375,17 @@ class GravityChainSolver:
         lateral_deviation = self.lateral_deviation if not self.lateral_deviation is None else max(direct_distance, 1.0)
         locations[1:-1] += normal * 2.0 * (self.random.normal(size = len(distances) - 1)[:, np.newaxis] - 0.5) * lateral_deviation
 
+        if self.backend == "numba":
+            valid, k = kernels.relax_chain(locations, distances, self.alpha, self.eps, int(self.maximum_iterations))
+        else:
+            valid, k = self.relax(locations, distances)
+
+        return dict(
+            valid = valid, locations = locations[1:-1], iterations = k
+        )
+
+    def relax(self, locations, distances):
+        # Runs the gravity simulation in place on the locations including origin and destination
         # Prepare gravity simulation
         valid = False
 
@@ -248,19 +418,162 @@ class GravityChainSolver:
             if np.isnan(locations).any() or np.isinf(locations).any():
                 raise RuntimeError("NaN/Inf value encountered during gravity simulation")
 
+        return valid, k
+
+    def solve_two_points_batch(self, origins, distances, directions, direct_distances):
+        locations = np.zeros((len(origins), 2))
+        valid = np.zeros(len(origins), dtype = bool)
+
+        total_distances = np.sum(distances, axis = 1)
+
+        ratios = np.ones(len(origins))
+        f = (distances[:, 0] > 0.0) | (distances[:, 1] > 0.0)
+        ratios[f] = distances[f, 0] / total_distances[f]
+
+        # Cases are evaluated in the same order as in solve_two_points
+        f_zero = direct_distances == 0.0
+        f_far = ~f_zero & (direct_distances > total_distances)
+        f_near = ~f_zero & ~f_far & (direct_distances < np.abs(distances[:, 0] - distances[:, 1]))
+        f_regular = ~f_zero & ~f_far & ~f_near
+
+        locations[f_zero] = origins[f_zero] + directions[f_zero] * distances[f_zero, 0:1]
+        valid[f_zero] = distances[f_zero, 0] == distances[f_zero, 1]
+
+        locations[f_far] = origins[f_far] + directions[f_far] * (ratios[f_far] * direct_distances[f_far])[:, np.newaxis]
+        locations[f_near] = origins[f_near] + directions[f_near] * (ratios[f_near] * np.max(distances[f_near], axis = 1))[:, np.newaxis]
+
+        distances = distances[f_regular]
+        direct_distances = direct_distances[f_regular]
+
+        A = 0.5 * ( distances[:, 0]**2 - distances[:, 1]**2 + direct_distances**2 ) / direct_distances
+        H = np.sqrt(np.maximum(0, distances[:, 0]**2 - A**2))
+        r = self.random.random_sample(len(A))
+
+        centers = origins[f_regular] + directions[f_regular] * A[:, np.newaxis]
+        offsets = directions[f_regular] * H[:, np.newaxis]
+        offsets = np.vstack([offsets[:, 1], -offsets[:, 0]]).T
+
+        locations[f_regular] = centers + np.where(r < 0.5, 1.0, -1.0)[:, np.newaxis] * offsets
+        valid[f_regular] = True
+
+        return dict(valid = valid, locations = locations.reshape(-1, 1, 2))
+
+    def solve_batch(self, problems, distances):
+        """
+            Batch version of solve for (N, 2) origins and destinations and (N, k + 1)
+            distances. The gravity simulation is performed in lockstep for all
+            problems, problems that have converged are not updated further.
+        """
+        origins, destinations = problems["origin"], problems["destination"]
+
+        if origins is None or destinations is None:
+            raise RuntimeError("Invalid chain for GravityChainSolver")
+
+        problem_count = len(origins)
+
+        # Prepare direction and normal direction
+        direct_distances = la.norm(destinations - origins, axis = 1)
+        f_zero = direct_distances < 1e-12
+
+        directions = np.zeros((problem_count, 2))
+        directions[~f_zero] = (destinations[~f_zero] - origins[~f_zero]) / direct_distances[~f_zero, np.newaxis]
+
+        angles = self.random.random_sample(np.count_nonzero(f_zero)) * np.pi * 2.0
+        directions[f_zero] = np.vstack([np.cos(angles), np.sin(angles)]).T
+
+        normals = np.vstack([directions[:, 1], -directions[:, 0]]).T
+
+        # If we have only one variable point, take a short cut
+        if problems["size"] == 1:
+            return self.solve_two_points_batch(origins, distances, directions, direct_distances)
+
+        # Prepare initial locations
+        total_distances = np.sum(distances, axis = 1)
+
+        shares = np.cumsum(distances[:, :-1], axis = 1)
+        f = total_distances < 1e-12
+        shares[f] = np.linspace(0, 1, distances.shape[1] - 1)
+        shares[~f] /= total_distances[~f, np.newaxis]
+
+        locations = origins[:, np.newaxis, :] + directions[:, np.newaxis, :] * shares[:, :, np.newaxis] * direct_distances[:, np.newaxis, np.newaxis]
+        locations = np.concatenate([origins[:, np.newaxis, :], locations, destinations[:, np.newaxis, :]], axis = 1)
+
+        # Infeasible problems keep their initial locations
+        active = calculate_feasibility_batch(distances, direct_distances) == 0.0
+
+        # Add lateral devations
+        if self.lateral_deviation is None:
+            lateral_deviations = np.maximum(direct_distances, 1.0)
+        else:
+            lateral_deviations = np.ones(problem_count) * self.lateral_deviation
+
+        deviations = self.random.normal(size = (np.count_nonzero(active), distances.shape[1] - 1))
+        locations[active, 1:-1] += normals[active, np.newaxis, :] * 2.0 * (deviations[:, :, np.newaxis] - 0.5) * lateral_deviations[active, np.newaxis, np.newaxis]
+
+        # Prepare gravity simulation
+        valid = np.zeros(problem_count, dtype = bool)
+        iterations = np.ones(problem_count, dtype = int) * (self.maximum_iterations - 1)
+
+        origin_weights = np.ones((distances.shape[1] - 1, 2))
+        origin_weights[0,:] = 2.0
+
+        destination_weights = np.ones((distances.shape[1] - 1, 2))
+        destination_weights[-1,:] = 2.0
+
+        # Run gravity simulation
+        active = np.flatnonzero(active)
+
+        for k in range(self.maximum_iterations):
+            if len(active) == 0:
+                break
+
+            current_locations = locations[active]
+            current_distances = distances[active]
+
+            directions = current_locations[:, :-1] - current_locations[:, 1:]
+            lengths = la.norm(directions, axis = 2)
+
+            offset = current_distances - lengths
+            lengths[lengths < 1.0] = 1.0
+            directions /= lengths[:, :, np.newaxis]
+
+            converged = np.all(np.abs(offset) < self.eps, axis = 1) # Check if we have converged
+            valid[active[converged]] = True
+            iterations[active[converged]] = k
+
+            # Apply adjustment to locations
+            offset, directions = offset[~converged], directions[~converged]
+            active = active[~converged]
+
+            adjustment = np.zeros((len(active), distances.shape[1] - 1, 2))
+            adjustment -= 0.5 * self.alpha * offset[:, :-1, np.newaxis] * directions[:, :-1] * origin_weights
+            adjustment += 0.5 * self.alpha * offset[:, 1:, np.newaxis] * directions[:, 1:] * destination_weights
+
+            locations[active, 1:-1] += adjustment
+
+            # Only the locations of the active problems have changed
+            if not np.all(np.isfinite(locations[active, 1:-1])):
+                raise RuntimeError("NaN/Inf value encountered during gravity simulation")
+
         return dict(
-            valid = valid, locations = locations[1:-1], iterations = k
+            valid = valid, locations = locations[:, 1:-1], iterations = iterations
         )
 
 class FeasibleDistanceSampler(DistanceSampler):
-    def __init__(self, random, maximum_iterations = 1000):
+    def __init__(self, random, maximum_iterations = 1000, block_size = 8):
         self.maximum_iterations = maximum_iterations
         self.random = random
+        self.block_size = block_size
 
     def sample_distances(self, problem):
         # Return distance chains per row
         raise NotImplementedError()
 
+    def sample_distances_block(self, problem, count):
+        # Return (count, k) distance chains, the random numbers must be consumed
+        # in the same way as with count calls to sample_distances
+        return np.vstack([self.sample_distances(problem) for k in range(count)])
+
     def sample(self, problem):
         origin, destination = problem["origin"], problem["destination"]
 
@@ -285,27 +598,89 @@ class FeasibleDistanceSampler(DistanceSampler):
 
             return dict(valid = True, distances = distances, iterations = None)
 
-        # This is the general case
+        # This is the general case: chains are sampled in blocks of growing size,
+        # starting with a single one. Once a feasible chain is found, the random
+        # state is rewound such that only the rows up to that chain are consumed,
+        # as if they were sampled one by one.
         best_distances = None
         best_delta = None
 
-        for k in range(self.maximum_iterations):
-            distances = self.sample_distances(problem)
-            delta = calculate_feasibility(distances, direct_distance)
+        iterations = self.maximum_iterations - 1
+        block_offset, block_size = 0, 1
 
-            if best_delta is None or delta < best_delta:
-                best_delta = delta
-                best_distances = distances
+        while block_offset < self.maximum_iterations:
+            count = min(block_size, self.maximum_iterations - block_offset)
 
-                if delta == 0.0:
+            state = self.random.get_state() if count > 1 else None
+            distances = self.sample_distances_block(problem, count)
+
+            delta = calculate_feasibility_batch(distances, np.repeat(direct_distance, count))
+            index = np.argmin(delta) # First minimum, as in the sequential search
+
+            if best_delta is None or delta[index] < best_delta:
+                best_delta = delta[index]
+                best_distances = distances[index]
+
+                if best_delta == 0.0:
+                    if index + 1 < count:
+                        self.random.set_state(state)
+                        self.sample_distances_block(problem, index + 1)
+
+                    iterations = block_offset + index
                     break
 
+            block_offset += count
+            block_size = self.block_size if block_size == 1 else 2 * block_size
+
         return dict(
             valid = best_delta == 0.0,
             distances = best_distances,
-            iterations = k
+            iterations = iterations
         )
 
+    def sample_distances_batch(self, problems):
+        # Return (N, k) distance chains for a batch of problems
+        raise NotImplementedError()
+
+    def sample_batch(self, problems):
+        origins, destinations = problems["origin"], problems["destination"]
+
+        if origins is None or destinations is None: # These are free chains or tails
+            distances = self.sample_distances_batch(problems)
+            return dict(valid = np.ones(len(distances), dtype = bool), distances = distances)
+
+        direct_distances = la.norm(destinations - origins, axis = 1)
+        distances = self.sample_distances_batch(problems)
+
+        # One point and two trips
+        f_single = np.zeros(len(distances), dtype = bool)
+
+        if problems["size"] == 1:
+            f_single = direct_distances < 1e-3
+            distances[f_single, 1] = distances[f_single, 0]
+
+        # This is the general case
+        best_distances = distances
+        best_delta = calculate_feasibility_batch(distances, direct_distances)
+        best_delta[f_single] = 0.0
+
+        pending = np.flatnonzero(best_delta > 0.0)
+
+        for k in range(1, self.maximum_iterations):
+            if len(pending) == 0:
+                break
+
+            distances = self.sample_distances_batch(select_batch(problems, pending))
+            delta = calculate_feasibility_batch(distances, direct_distances[pending])
+
+            improved = delta < best_delta[pending]
+            best_delta[pending[improved]] = delta[improved]
+            best_distances[pending[improved]] = distances[improved]
+
+            pending = pending[best_delta[pending] > 0.0]
+
+        return dict(valid = best_delta == 0.0, distances = best_distances)
+
 class DiscretizationErrorObjective(AssignmentObjective):
     def __init__(self, thresholds):
         self.thresholds = thresholds
@@ -334,3 +709,30 @@ class DiscretizationErrorObjective(AssignmentObjective):
         valid &= discretization_result["valid"]
 
         return dict(valid = valid, objective = objective)
+
+    def evaluate_batch(self, problems, distance_result, relaxation_result, discretization_result):
+        sampled_distances = distance_result["distances"]
+
+        discretized_locations = []
+        if not problems["origin"] is None: discretized_locations.append(problems["origin"][:, np.newaxis, :])
+        discretized_locations.append(discretization_result["locations"])
+        if not problems["destination"] is None: discretized_locations.append(problems["destination"][:, np.newaxis, :])
+        discretized_locations = np.concatenate(discretized_locations, axis = 1)
+
+        discretized_distances = la.norm(discretized_locations[:, :-1] - discretized_locations[:, 1:], axis = 2)
+        discretization_error = np.abs(sampled_distances - discretized_distances)
+
+        target_error = np.zeros(discretization_error.shape)
+        modes = problems["modes"]
+
+        for mode in np.unique(modes):
+            target_error[modes == mode] = self.thresholds[mode]
+
+        objective = np.max(np.maximum(0.0, discretization_error - target_error), axis = 1)
+
+        valid = objective == 0.0
+        valid &= distance_result["valid"]
+        valid &= relaxation_result["valid"]
+        valid &= discretization_result["valid"]
+
+        return dict(valid = valid, objective = objective)
@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+
+def index_groups(df, column):
+    """
+    Sort a data frame by a grouping column and find the row range of each group.
+
+    The sort is stable, so the rows of one group keep their original order and
+    df.iloc[start:end] contains the same rows as df[df[column] == value]. This
+    way, parallel tasks can select their group without scanning the whole data
+    frame.
+
+    :param df: data frame to be grouped
+    :param column: name of the grouping column
+    :returns: the sorted data frame and a dictionary from group value to (start, end)
+    """
+    df = df.sort_values(column, kind = "mergesort")
+
+    codes, values = pd.factorize(df[column])
+    counts = np.bincount(codes[codes >= 0], minlength = len(values))
+
+    ends = np.cumsum(counts)
+    starts = ends - counts
+
+    return df, dict(zip(values, zip(starts, ends)))
+
+def select_group(df, groups, value):
+    """
+    Select the rows of one group from a data frame sorted by index_groups.
+
+    :param df: data frame as returned by index_groups
+    :param groups: group ranges as returned by index_groups
+    :param value: value of the grouping column
+    """
+    start, end = groups.get(value, (0, 0))
+    return df.iloc[start:end]
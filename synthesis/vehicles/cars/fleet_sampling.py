@@ -2,6 +2,8 @@ import re
 import pandas as pd
 import numpy as np
 from datetime import date
+from synthesis.population.utils import index_groups, select_group
+from data.sampling import calculate_cdf, sample_cdf
 
 """
 Creates the synthetic vehicle fleet
@@ -14,44 +16,78 @@ def configure(context):
     context.stage("data.vehicles.types")
 
     context.config("vehicles_year", 2021)
+    context.config("random_seed")
 
-def _sample_vehicle(context, args):
-    vehicle = args
-    year = context.config("vehicles_year")
-    df_vehicle_fleet_counts, df_vehicle_age_counts = context.data("fleet"), context.data("age")
+def _sample_rows(random, weights, count):
+    indices = sample_cdf(calculate_cdf(weights), random.random_sample(size = count))
+    return np.minimum(indices, len(weights) - 1)
 
-    commune_id = vehicle["commune_id"]
+def _sample_vehicles(context, df_vehicles, df_vehicle_fleet_counts, df_vehicle_age_counts):
+    random = np.random.RandomState(context.config("random_seed"))
 
-    if  commune_id in df_vehicle_fleet_counts["commune_id"].unique():
-        fleet = df_vehicle_fleet_counts.loc[df_vehicle_fleet_counts["commune_id"] == commune_id]
-        choice = fleet.sample(weights="fleet")
-        critair = choice["critair"].values[0]
-        technology = choice["technology"].values[0]
+    vehicle_count = len(df_vehicles)
+    critair = np.empty(vehicle_count, dtype = object)
+    technology = np.empty(vehicle_count, dtype = object)
+    age = np.empty(vehicle_count, dtype = object)
 
-        age_mask = (df_vehicle_age_counts["critair"] == critair) & (df_vehicle_age_counts["technology"] == technology)
-        age = df_vehicle_age_counts.loc[age_mask].sample(weights="fleet")["age"].values[0]
-    else:
-        choice = df_vehicle_age_counts.sample(weights="fleet")
-        critair = choice["critair"].values[0]
-        technology = choice["technology"].values[0]
-        age = choice["age"].values[0]
+    # Group vehicles by commune
+    commune_ids = df_vehicles["commune_id"].astype(str).values
+    vehicle_order = np.argsort(commune_ids, kind = "stable")
+    unique_commune_ids, commune_starts, commune_counts = np.unique(commune_ids[vehicle_order], return_index = True, return_counts = True)
 
-    vehicle["critair"] = critair
-    vehicle["technology"] = technology
-    vehicle["age"] = age
+    df_fleet = df_vehicle_fleet_counts[["commune_id", "critair", "technology", "fleet"]].copy()
+    df_fleet["commune_id"] = df_fleet["commune_id"].astype(str)
+    df_fleet, fleet_groups = index_groups(df_fleet, "commune_id")
 
-    euro = _get_euro_from_critair(vehicle, year)
-    vehicle["euro"] = euro
+    df_age = df_vehicle_age_counts[["critair", "technology", "age", "fleet"]]
+    fallback = np.zeros(vehicle_count, dtype = bool)
 
-    if technology == "Gazole":
-        hbefa_tech = "diesel"
-        vehicle["type_id"] = "car_%s_%s" % (hbefa_tech, euro)
-    if technology == "Essence":
-        hbefa_tech = "petrol"
-        vehicle["type_id"] = "car_%s_%s" % (hbefa_tech, euro)
+    # Sample critair and technology per commune
+    with context.progress(label = "Sampling vehicle types ...", total = len(unique_commune_ids)) as progress:
+        for commune_id, start, count in zip(unique_commune_ids, commune_starts, commune_counts):
+            indices = vehicle_order[start:start + count]
 
-    context.progress.update()
-    return vehicle
+            if commune_id in fleet_groups:
+                df_choices = select_group(df_fleet, fleet_groups, commune_id)
+                selection = _sample_rows(random, df_choices["fleet"].values, count)
+
+                critair[indices] = df_choices["critair"].values[selection]
+                technology[indices] = df_choices["technology"].values[selection]
+            else:
+                fallback[indices] = True
+
+            progress.update()
+
+    # Sample age per critair and technology
+    df_types = pd.DataFrame(dict(critair = critair, technology = technology))[~fallback]
+
+    for (group_critair, group_technology), indices in sorted(df_types.groupby(["critair", "technology"]).indices.items()):
+        indices = np.flatnonzero(~fallback)[indices]
+
+        df_choices = df_age[(df_age["critair"] == group_critair) & (df_age["technology"] == group_technology)]
+
+        if len(df_choices) == 0:
+            raise RuntimeError("No age distribution found for %s / %s" % (group_critair, group_technology))
+
+        selection = _sample_rows(random, df_choices["fleet"].values, len(indices))
+        age[indices] = df_choices["age"].values[selection]
+
+    # Vehicles in communes without fleet data are sampled from the regional data
+    indices = np.flatnonzero(fallback)
+
+    if len(indices) > 0:
+        selection = _sample_rows(random, df_age["fleet"].values, len(indices))
+
+        critair[indices] = df_age["critair"].values[selection]
+        technology[indices] = df_age["technology"].values[selection]
+        age[indices] = df_age["age"].values[selection]
+
+    df_vehicles = df_vehicles.copy()
+    df_vehicles["critair"] = critair
+    df_vehicles["technology"] = technology
+    df_vehicles["age"] = age
+
+    return df_vehicles
 
 def _get_euro_from_critair(vehicle, year):
 
@@ -127,14 +163,21 @@ def execute(context):
     df_vehicles["mode"] = "car"
 
     df_vehicle_fleet_counts, df_vehicle_age_counts = context.stage("data.vehicles.raw")
+    df_vehicles = _sample_vehicles(context, df_vehicles, df_vehicle_fleet_counts, df_vehicle_age_counts)
+
+    # Look up the Euro class per combination of critair, technology and age
+    df_euro = df_vehicles[["vehicle_id", "critair", "technology", "age"]].drop_duplicates(["critair", "technology", "age"])
+    df_euro["euro"] = [
+        _get_euro_from_critair(vehicle, context.config("vehicles_year"))
+        for vehicle in df_euro.to_dict(orient = "records")
+    ]
 
-    res = []
+    df_vehicles = pd.merge(df_vehicles, df_euro[["critair", "technology", "age", "euro"]], on = ["critair", "technology", "age"], how = "left")
 
-    with context.progress(label = "Processing vehicles data ...", total = len(df_vehicles)) as progress:
-        with context.parallel(dict(fleet = df_vehicle_fleet_counts, age = df_vehicle_age_counts)) as parallel:
-            for df_partial in parallel.imap(_sample_vehicle, df_vehicles.to_dict(orient="records")):
-                res.append(df_partial)
+    f_diesel = df_vehicles["technology"] == "Gazole"
+    df_vehicles.loc[f_diesel, "type_id"] = "car_diesel_" + df_vehicles.loc[f_diesel, "euro"]
 
-    df_vehicles = pd.DataFrame.from_dict(res)
+    f_petrol = df_vehicles["technology"] == "Essence"
+    df_vehicles.loc[f_petrol, "type_id"] = "car_petrol_" + df_vehicles.loc[f_petrol, "euro"]
 
-    return df_vehicle_types, df_vehicles
\ No newline at end of file
+    return df_vehicle_types, df_vehicles
@@ -4,6 +4,8 @@ import hashlib
 from . import testdata
 import pandas as pd
 
+import documentation.profiling as profiling
+
 def test_data(tmpdir):
     data_path = str(tmpdir.mkdir("data"))
     testdata.create(data_path)
@@ -88,6 +90,141 @@ def test_population_with_fleet_sample(tmpdir):
         "vehicles_year": 2021
     })
 
+def test_population_with_batch_secondary_locations(tmpdir):
+    run_population(tmpdir, "entd", {
+        "secloc_solver": "batch",
+        "secloc_batch_size": 50
+    })
+
+def test_population_with_numba_secondary_locations(tmpdir):
+    run_population(tmpdir, "entd", {
+        "secloc_backend": "numba"
+    })
+
+def test_population_with_chunked_secondary_locations(tmpdir):
+    run_population(tmpdir, "entd", {
+        "secloc_chunk_size": 50
+    })
+
+class ProcessesContext:
+    # Overrides the number of processes seen by a single stage, so that the
+    # upstream stages are computed identically
+    def __init__(self, context, processes):
+        self.context = context
+        self.processes = processes
+
+    def config(self, option):
+        if option == "processes":
+            return self.processes
+
+        return self.context.config(option)
+
+    def __getattr__(self, name):
+        return getattr(self.context, name)
+
+def test_chunked_secondary_locations_are_independent_of_processes(tmpdir, monkeypatch):
+    import synthesis.population.spatial.secondary.locations as locations
+
+    data_path = str(tmpdir.mkdir("data"))
+    testdata.create(data_path)
+
+    execute = locations.execute
+
+    def run(name, solver, processes):
+        monkeypatch.setattr(locations, "execute", lambda context: execute(ProcessesContext(context, processes)))
+
+        config = dict(
+            data_path = data_path, output_path = str(tmpdir),
+            regions = [10, 11], sampling_rate = 1.0, hts = "entd",
+            random_seed = 1000, processes = 1,
+            secloc_maximum_iterations = 10,
+            secloc_chunk_size = 50, secloc_solver = solver
+        )
+
+        stages = [dict(descriptor = "synthesis.population.spatial.secondary.locations")]
+        return synpp.run(stages, config, working_directory = str(tmpdir.mkdir(name)))[0][0]
+
+    for solver in ("scalar", "batch"):
+        df_sequential = run("%s_1" % solver, solver, 1)
+        df_parallel = run("%s_2" % solver, solver, 2)
+
+        assert len(df_sequential) > 0
+        pd.testing.assert_frame_equal(df_sequential, df_parallel)
+
+def test_population_with_sorted_primary_locations(tmpdir):
+    run_population(tmpdir, "entd", {
+        "primary_location_ordering": "sorted",
+        "primary_location_ordering_check": True
+    })
+
+def test_population_with_profiling(tmpdir):
+    output_path = str(tmpdir.join("output"))
+    execute = synpp.pipeline.StageInstance.execute
+
+    with profiling.profile(output_path, "ile_de_france_") as profiler:
+        run_population(tmpdir, "entd")
+
+    assert synpp.pipeline.StageInstance.execute is execute
+
+    df_profile = pd.read_csv("%s/ile_de_france_profile.csv" % output_path, sep = ";")
+    assert "synthesis.population.spatial.secondary.locations" in df_profile["stage"].values
+    assert len(df_profile) == len(profiler.records)
+
+def test_population_with_raw_cache(tmpdir):
+    raw_cache_path = str(tmpdir.mkdir("raw_cache"))
+
+    run_population(tmpdir, "entd", {
+        "raw_cache_path": raw_cache_path
+    })
+
+    names = os.listdir(raw_cache_path)
+    assert any(name.startswith("census_") for name in names)
+    assert any(name.startswith("siret_") for name in names)
+    assert any(name.startswith("ban_") for name in names)
+
+def test_raw_cache(tmpdir):
+    data_path = str(tmpdir.mkdir("data"))
+    testdata.create(data_path)
+
+    raw_cache_path = str(tmpdir.mkdir("raw_cache"))
+
+    stages = [
+        dict(descriptor = "data.census.raw"),
+        dict(descriptor = "data.sirene.raw_siret"),
+        dict(descriptor = "data.sirene.raw_siren"),
+        dict(descriptor = "data.ban.raw"),
+    ]
+
+    def run(name, update):
+        config = dict(data_path = data_path, regions = [10, 11], processes = 1)
+        config.update(update)
+
+        return synpp.run(stages, config, working_directory = str(tmpdir.mkdir(name)))
+
+    # Reading from CSV, converting into the cache, reading back from the cache
+    reference = run("csv", {})
+    converted = run("convert", { "raw_cache_path": raw_cache_path })
+    assert len(os.listdir(raw_cache_path)) > 0
+    cached = run("cached", { "raw_cache_path": raw_cache_path })
+
+    for df_reference, df_converted, df_cached in zip(reference, converted, cached):
+        pd.testing.assert_frame_equal(df_reference, df_converted)
+        pd.testing.assert_frame_equal(df_reference, df_cached)
+
+    # Reading a subset of the departments from the existing cache
+    reference = run("csv_subset", { "regions": [], "departments": ["1B"] })
+    cached = run("cached_subset", { "regions": [], "departments": ["1B"], "raw_cache_path": raw_cache_path })
+
+    for df_reference, df_cached in zip(reference, cached):
+        assert len(df_reference) > 0
+        pd.testing.assert_frame_equal(df_reference, df_cached)
+
+def test_population_with_pyarrow_csv_engine(tmpdir):
+    run_population(tmpdir, "entd", {
+        "raw_csv_engine": "pyarrow",
+        "raw_chunk_size": 500
+    })
+
 def test_population_with_bhepop2_income(tmpdir):
     run_population(tmpdir, "egt", { 
         "income_assignation_method": "bhepop2"
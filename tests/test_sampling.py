@@ -0,0 +1,35 @@
+import numpy as np
+
+from data.sampling import calculate_cdf, sample_cdf, sample_grouped
+
+def test_sample_cdf():
+    random = np.random.RandomState(0)
+
+    cdf = calculate_cdf(random.random_sample(size = 100))
+    uniform = random.random_sample(size = 1000)
+
+    # Include uniform values that are equal to entries of the distribution
+    uniform[:10] = cdf[:10]
+
+    reference = np.array([np.count_nonzero(cdf < u) for u in uniform])
+    assert np.all(sample_cdf(cdf, uniform) == reference)
+
+def test_sample_grouped():
+    random = np.random.RandomState(0)
+
+    sizes = random.randint(1, 20, size = 50)
+    offsets = np.zeros((len(sizes) + 1,), dtype = int)
+    offsets[1:] = np.cumsum(sizes)
+
+    cdf = np.hstack([calculate_cdf(random.random_sample(size = size)) for size in sizes])
+
+    groups = random.randint(len(sizes), size = 1000)
+    uniform = random.random_sample(size = 1000)
+
+    reference = np.array([
+        offsets[group] + np.count_nonzero(cdf[offsets[group]:offsets[group + 1]] < u)
+        for group, u in zip(groups, uniform)
+    ])
+
+    assert np.all(sample_grouped(cdf, offsets, groups, uniform) == reference)
+    assert len(sample_grouped(cdf, offsets, [], [])) == 0
@@ -1,6 +1,9 @@
 import synpp
 import os
 import hashlib
+import glob, gzip
+import numpy as np
+import pandas as pd
 from . import testdata
 
 def test_simulation(tmpdir):
@@ -31,3 +34,74 @@ def test_simulation(tmpdir):
     assert os.path.isfile("%s/ile_de_france_households.xml.gz" % output_path)
     assert os.path.isfile("%s/ile_de_france_facilities.xml.gz" % output_path)
     assert os.path.isfile("%s/ile_de_france_vehicles.xml.gz" % output_path)
+
+def test_population_parquet(tmpdir):
+    data_path = str(tmpdir.mkdir("data"))
+    testdata.create(data_path)
+
+    cache_path = str(tmpdir.mkdir("cache"))
+    output_path = str(tmpdir.mkdir("output"))
+
+    config = dict(
+        data_path = data_path, output_path = output_path,
+        regions = [10, 11], sampling_rate = 1.0, hts = "entd",
+        random_seed = 1000, processes = 1,
+        secloc_maximum_iterations = 10,
+        population_parquet = True
+    )
+
+    stages = [
+        dict(descriptor = "matsim.scenario.population")
+    ]
+
+    synpp.run(stages, config, working_directory = cache_path)
+
+    stage_path = glob.glob("%s/matsim.scenario.population__*/" % cache_path)[0]
+
+    df_persons = pd.read_parquet("%s/plans_persons.parquet" % stage_path)
+    df_elements = pd.read_parquet("%s/plans_elements.parquet" % stage_path)
+
+    with gzip.open("%s/population.xml.gz" % stage_path) as f:
+        content = f.read().decode("utf-8")
+
+    assert len(df_persons) == content.count("<person ")
+    assert np.sum(df_elements["element_type"] == "activity") == content.count("<activity ")
+    assert np.sum(df_elements["element_type"] == "leg") == content.count("<leg ")
+
+    assert df_persons["element_count"].sum() == len(df_elements)
+    assert np.all(df_elements["person_id"].values[df_persons["element_offset"].values] == df_persons["person_id"].values)
+
+def test_population_writers(tmpdir):
+    data_path = str(tmpdir.mkdir("data"))
+    testdata.create(data_path)
+
+    cache_path = str(tmpdir.mkdir("cache"))
+    output_path = str(tmpdir.mkdir("output"))
+
+    config = dict(
+        data_path = data_path, output_path = output_path,
+        regions = [10, 11], sampling_rate = 1.0, hts = "entd",
+        random_seed = 1000, processes = 2,
+        secloc_maximum_iterations = 10
+    )
+
+    stages = [
+        dict(descriptor = "matsim.scenario.population", config = dict(population_writer = "default")),
+        dict(descriptor = "matsim.scenario.population", config = dict(population_writer = "columnar")),
+        dict(descriptor = "matsim.scenario.population", config = dict(population_writer = "columnar", sharded_gzip = True))
+    ]
+
+    synpp.run(stages, config, working_directory = cache_path)
+
+    stage_paths = glob.glob("%s/matsim.scenario.population__*/" % cache_path)
+    assert len(stage_paths) == 3
+
+    contents = []
+
+    for stage_path in stage_paths:
+        with gzip.open("%s/population.xml.gz" % stage_path) as f:
+            contents.append(f.read())
+
+    assert contents[0].count(b"<person ") > 0
+    assert contents[0] == contents[1]
+    assert contents[0] == contents[2]
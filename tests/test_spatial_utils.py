@@ -0,0 +1,31 @@
+import numpy as np
+import shapely
+import shapely.geometry as geo
+
+from data.spatial.utils import sample_from_shape, triangulate
+
+SHAPES = [
+    geo.Polygon([(0, 0), (10, 0), (10, 10), (5, 2), (0, 10)], [[(1, 1), (2, 1), (2, 2), (1, 2)]]),
+    geo.LineString([(0, 0), (1000, 1000), (2000, 0)]).buffer(2.0),
+    geo.MultiPolygon([geo.box(0, 0, 1, 1), geo.box(5, 5, 7, 6)])
+]
+
+def test_triangulate():
+    for shape in SHAPES:
+        triangles = triangulate(shape)
+        a, b, c = triangles[:,0], triangles[:,1], triangles[:,2]
+
+        area = 0.5 * np.abs((b[:,0] - a[:,0]) * (c[:,1] - a[:,1]) - (c[:,0] - a[:,0]) * (b[:,1] - a[:,1]))
+        assert np.isclose(np.sum(area), shape.area)
+
+def test_sample_from_shape():
+    for shape in SHAPES:
+        for method in ("rejection", "triangulation", "auto"):
+            coordinates = sample_from_shape(shape, 1000, np.random.RandomState(0), method = method)
+
+            assert coordinates.shape == (1000, 2)
+            assert np.all(shapely.contains_xy(shape.buffer(1e-6), coordinates[:,0], coordinates[:,1]))
+
+    # Samples are proportional to area
+    coordinates = sample_from_shape(SHAPES[2], 10000, np.random.RandomState(0), method = "triangulation")
+    assert np.abs(np.mean(coordinates[:,0] < 2.0) - 1.0 / 3.0) < 0.02
@@ -7,7 +7,10 @@ import py7zr, zipfile
 import glob
 import subprocess
 
-def create(output_path):
+def create(output_path, municipality_grid = 5, iris_municipalities = None,
+    census_households = 300, census_weight = 1.0, hts_households = 300,
+    bpe_observations = 500, commute_flow_observations = 500,
+    address_observations = 2000, sirene_observations = 2000):
     """
     This script creates test fixtures for the Île-de-France / France pipeline.
 
@@ -49,25 +52,34 @@ def create(output_path):
     few municipalities are covered by IRIS:
     - 1B013, 1B014, 1B018, 1B019
     - 2D007, 2D008, 2D012, 2D013
+
+    The default arguments produce the fixtures of the unit tests. For benchmarks,
+    the data can be scaled: municipality_grid gives the number of municipalities
+    per side of a department (at least 5), iris_municipalities the names of the
+    municipalities that are covered by IRIS, and the remaining arguments the
+    number of observations per data set. Each census household represents
+    census_weight households.
     """
 
-    BPE_OBSERVATIONS = 500
-    HTS_HOUSEHOLDS = 300
+    assert municipality_grid >= 5
+
+    BPE_OBSERVATIONS = bpe_observations
+    HTS_HOUSEHOLDS = hts_households
     HTS_HOUSEHOLD_MEMBERS = 3
 
-    CENSUS_HOUSEHOLDS = 300
+    CENSUS_HOUSEHOLDS = census_households
     CENSUS_HOUSEHOLD_MEMBERS = 3
 
-    COMMUTE_FLOW_OBSERVATIONS = 500
-    ADDRESS_OBSERVATIONS = 2000
-    SIRENE_OBSERVATIONS = 2000
+    COMMUTE_FLOW_OBSERVATIONS = commute_flow_observations
+    ADDRESS_OBSERVATIONS = address_observations
+    SIRENE_OBSERVATIONS = sirene_observations
 
     random = np.random.RandomState(0)
 
     REGION_LENGTH = 50 * 1e3
     DEPARTMENT_LENGTH = 25 * 1e3
-    MUNICIPALITY_LENGTH = 5 * 1e3
-    IRIS_LENGTH = 500
+    MUNICIPALITY_LENGTH = DEPARTMENT_LENGTH / municipality_grid
+    IRIS_LENGTH = MUNICIPALITY_LENGTH / 10
 
     anchor_x = 638589
     anchor_y = 6861081
@@ -79,7 +91,7 @@ def create(output_path):
     WITH_IRIS = set([
         "1B013", "1B014", "1B018", "1B019",
         "2D007", "2D008", "2D012", "2D013"
-    ])
+    ] if iris_municipalities is None else iris_municipalities)
 
     for region_column in np.arange(2):
         region_prefix = region_column + 1
@@ -99,11 +111,11 @@ def create(output_path):
                 department_x = region_x + department_column * DEPARTMENT_LENGTH
                 department_y = region_y - department_row * DEPARTMENT_LENGTH
 
-                for municipality_index in np.arange(25):
+                for municipality_index in np.arange(municipality_grid**2):
                     municipality_name = "%s%03d" % (department_name, municipality_index + 1)
 
-                    municipality_row = municipality_index // 5
-                    municipality_column = municipality_index % 5
+                    municipality_row = municipality_index // municipality_grid
+                    municipality_column = municipality_index % municipality_grid
 
                     municipality_x = department_x + municipality_column * MUNICIPALITY_LENGTH
                     municipality_y = department_y - municipality_row * MUNICIPALITY_LENGTH
@@ -548,7 +560,7 @@ def create(output_path):
                 DEPT = department, IRIS = iris, REGION = region, ETUD = random.choice([1, 2]),
                 ILETUD = 4 if department != destination_department else 0,
                 ILT = 4 if department != destination_department else 0,
-                IPONDI = float(1.0),
+                IPONDI = float(census_weight),
                 SEXE = random.choice([1, 2]),
                 TACT = random.choice([1, 2]),
                 TRANS = 4, VOIT = random.randint(3), DEROU = random.randint(2)